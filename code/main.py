@@ -24,6 +24,7 @@
 
 # packages
 import signal
+import collections
 import tomli
 import time
 import logging
@@ -38,27 +39,87 @@ from variable_blackboard import Blackboard
 from barcode_scan import BarcodeScanner
 from wrapper import MQTTServiceWrapper
 from multi_barcode_scan import BarcodeScannerManager
+from node_link import NodeGateway
+from scan_replay import ScanLogReplayer
+from utilities.links import link_options
+from utilities.watchdog import RECYCLE_EXIT_CODE
 
 logger = logging.getLogger("main")
 terminate_flag = False
 
-def create_building_blocks(config):
-    bbs = {}
-
-    bs_out = {"type": zmq.PUSH, "address": "tcp://127.0.0.1:4000", "bind": True}
-    inter_in = {"type": zmq.PULL, "address": "tcp://127.0.0.1:4000", "bind": False}
-    inter_out = {"type": zmq.PUSH, "address": "tcp://127.0.0.1:4001", "bind": True}
-    wrapper_in = {"type": zmq.PULL, "address": "tcp://127.0.0.1:4001", "bind": False}
+# an ingestion worker stopping this often is taken out of the split for a while,
+# so its scanners are read by the other workers instead of waiting on its restarts
+WORKER_FAILURE_LIMIT = 3
+WORKER_FAILURE_WINDOW = 60
+WORKER_DOWN_TIME = 120
 
-    bbs["bs"] = {
-        "class": BarcodeScannerManager,
-        "args": [config, {"out": bs_out}],
-    }
+def create_building_blocks(config, config_watcher=None, replay=None):
+    bbs = {}
 
-    bbs["inter"] = {
-        "class": Blackboard,
-        "args": [config, {"in": inter_in, "out": inter_out}],
-    }
+    distributed_conf = config.get("distributed", {})
+    role = distributed_conf.get("role", "standalone")
+    shard_count = config.get("blackboard", {}).get("shards", 1)
+    api_conf = config.get("blackboard", {}).get("api", {})
+
+    # consumers bind and producers connect so that several shards can share a link
+    ingestion_options = link_options(config, "ingestion")
+    output_options = link_options(config, "output")
+
+    shard_links = [
+        {"type": zmq.PUSH, "address": blackboard_address(shard), "bind": False, **ingestion_options}
+        for shard in range(shard_count)
+    ]
+
+    if role == "node":
+        # ingestion only - scans are sent to the central blackboard
+        if replay is not None:
+            logger.error("--replay is not supported in the node role - reading the scanners instead")
+        central_link = {
+            "type": zmq.PUSH,
+            "address": distributed_conf["central_address"],
+            "bind": False,
+            **ingestion_options,
+        }
+        add_ingestion_workers(bbs, config, {"out": [central_link]})
+        logger.debug(f"bbs {bbs}")
+        return bbs
+
+    if replay is not None:
+        # recorded key events stand in for the scanners
+        log_files, speed = replay
+        bbs["bs"] = {
+            "class": ScanLogReplayer,
+            "args": [config, {"out": shard_links}, log_files, speed],
+            "run_once": True,
+        }
+    else:
+        add_ingestion_workers(bbs, config, {"out": shard_links})
+
+    if role == "central":
+        gateway_in = {
+            "type": zmq.PULL,
+            "address": distributed_conf.get("listen_address", "tcp://*:4100"),
+            "bind": True,
+            **ingestion_options,
+        }
+        bbs["gateway"] = {
+            "class": NodeGateway,
+            "args": [config, {"in": gateway_in, "out": shard_links}],
+        }
+
+    inter_out = {"type": zmq.PUSH, "address": "tcp://127.0.0.1:4001", "bind": False, **output_options}
+    wrapper_in = {"type": zmq.PULL, "address": "tcp://127.0.0.1:4001", "bind": True, **output_options}
+
+    for shard in range(shard_count):
+        inter_in = {"type": zmq.PULL, "address": blackboard_address(shard), "bind": True, **ingestion_options}
+        inter_conf = {"in": inter_in, "out": inter_out}
+        if api_conf.get("enabled", True):
+            inter_conf["api"] = {"type": zmq.REP, "address": api_address(api_conf, shard), "bind": True}
+        key = "inter" if shard_count == 1 else f"inter_{shard}"
+        bbs[key] = {
+            "class": Blackboard,
+            "args": [config, inter_conf, config_watcher, shard],
+        }
     bbs["wrapper"] = {
         "class": MQTTServiceWrapper,
         "args": [config, wrapper_in],
@@ -68,6 +129,31 @@ def create_building_blocks(config):
     return bbs
 
 
+def add_ingestion_workers(bbs, config, zmq_conf):
+    # the scanners are split between the workers, which all send to the same links
+    worker_count = config.get("input", {}).get("workers", 1)
+    for worker in range(worker_count):
+        key = "bs" if worker_count == 1 else f"bs_{worker}"
+        bbs[key] = {
+            "class": BarcodeScannerManager,
+            "args": [config, zmq_conf, worker, worker_count, []],
+            "worker": worker,
+            "failures": collections.deque(maxlen=WORKER_FAILURE_LIMIT),
+            "down_until": None,
+        }
+
+
+def blackboard_address(shard):
+    # shard 0 keeps the original port
+    port = 4000 if shard == 0 else 4010 + shard
+    return f"tcp://127.0.0.1:{port}"
+
+
+def api_address(api_conf, shard):
+    # one port per shard, counting up from the configured port
+    return f"tcp://{api_conf.get('host', '127.0.0.1')}:{api_conf.get('port', 4200) + shard}"
+
+
 def start_building_blocks(bbs):
     for key in bbs:
         start_building_block(bbs[key])
@@ -83,7 +169,7 @@ def start_building_block(bb):
     bb["process"] = process
 
 
-def monitor_building_blocks(bbs):
+def monitor_building_blocks(bbs, config_watcher=None):
     while True:
         time.sleep(1)
         if terminate_flag:
@@ -93,16 +179,115 @@ def monitor_building_blocks(bbs):
                 process.join()
             return
 
+        refresh_config(bbs, config_watcher)
+        bring_workers_back(bbs)
         for key in bbs:
             process = bbs[key]["process"]
+            if bbs[key].get("down_until") is not None:  # taken out of the split, restarted later
+                continue
+            if process.is_alive() is False and bbs[key].get("run_once", False):
+                logger.info(f"Building block {key} finished with exit: {process.exitcode}")
+                drain_building_blocks(bbs)
+                return
             if process.is_alive() is False:
-                logger.warning(
-                    f"Building block {key} stopped with exit: {process.exitcode}"
-                )
+                if process.exitcode == RECYCLE_EXIT_CODE:  # asked to be restarted, state was saved
+                    logger.info(f"Building block {key} recycled to release memory")
+                else:
+                    logger.warning(
+                        f"Building block {key} stopped with exit: {process.exitcode}"
+                    )
+                    if worker_failing(bbs, key):
+                        logger.warning(
+                            f"Building block {key} keeps stopping - "
+                            f"handing its scanners to the other workers for {WORKER_DOWN_TIME}s"
+                        )
+                        bbs[key]["down_until"] = time.monotonic() + WORKER_DOWN_TIME
+                        rebalance_workers(bbs)
+                        continue
                 logger.info(f"Restarting Building block {key}")
                 start_building_block(bbs[key])
 
 
+def refresh_config(bbs, config_watcher):
+    """Gives restarted blocks the config files as they are now, not the config main started with"""
+    if config_watcher is None:
+        return
+    new_config = config_watcher.check()
+    if new_config is None:  # unchanged, or invalid - the current config stays in use
+        return
+    logger.info("Config files changed - blocks restarted from now on use the new config")
+    for bb in bbs.values():
+        bb["args"][0] = new_config  # every block takes the config first
+
+
+def worker_failing(bbs, key):
+    """Records a stop of an ingestion worker, true once it stops too often and another worker
+    is still up to take over its part"""
+    bb = bbs[key]
+    if "worker" not in bb:
+        return False
+    now = time.monotonic()
+    bb["failures"].append(now)
+    if len(bb["failures"]) < WORKER_FAILURE_LIMIT or now - bb["failures"][0] > WORKER_FAILURE_WINDOW:
+        return False
+    live = [other for other in bbs.values() if "worker" in other and other["down_until"] is None]
+    return len(live) > 1
+
+
+def rebalance_workers(bbs):
+    """Restarts the live ingestion workers with the current list of down workers,
+    so each recalculates its part of the scanner map"""
+    workers = [bb for bb in bbs.values() if "worker" in bb]
+    down = sorted(bb["worker"] for bb in workers if bb["down_until"] is not None)
+    logger.info(f"Rebalancing the ingestion workers, down: {down}")
+    for bb in workers:
+        bb["args"][4] = down
+        process = bb["process"]
+        if process.is_alive():
+            process.terminate()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+    for bb in workers:
+        if bb["down_until"] is None:
+            start_building_block(bb)
+
+
+def bring_workers_back(bbs):
+    """Returns ingestion workers to the split once their down time is over"""
+    due = [
+        bb for bb in bbs.values()
+        if bb.get("down_until") is not None and time.monotonic() >= bb["down_until"]
+    ]
+    if not due:
+        return
+    for bb in due:
+        bb["down_until"] = None
+        bb["failures"].clear()
+    rebalance_workers(bbs)
+
+
+def drain_building_blocks(bbs, timeout=120):
+    """Stops the blocks once they have passed on all their work. Blocks are stopped in pipeline
+    order (as created), so each one's input has stopped by the time it is asked to finish"""
+    for key, bb in bbs.items():
+        process = bb["process"]
+        if not process.is_alive():
+            continue
+        drain_requested = getattr(process, "drain_requested", None)
+        if drain_requested is None:  # a source - nothing queued to pass on
+            process.terminate()
+            process.join()
+            continue
+        logger.info(f"Waiting for building block {key} to pass on its work")
+        drain_requested.set()
+        process.join(timeout)
+        if process.is_alive():
+            logger.warning(f"Building block {key} did not finish within {timeout}s - terminating")
+            process.terminate()
+
+
 def graceful_signal_handler(sig, _frame):
     logger.info(
         f"Received {signal.Signals(sig).name}. Triggering graceful termination."
@@ -122,13 +307,21 @@ def harsh_signal_handler(sig, _frame):
         sys.exit(0)
 
 
-def handle_args():
-    levels = {
-        "debug": logging.DEBUG,
-        "info": logging.INFO,
-        "warning": logging.WARNING,
-        "error": logging.ERROR,
-    }
+def forward_signal(bbs, sig, main_pid, handler_attribute, keys=None):
+    # blocks dump their flight recorder on SIGUSR1 and start profiling on SIGUSR2
+    # only forwarded from the main process
+    if os.getpid() != main_pid:
+        return
+    for key, bb in bbs.items():
+        if keys is not None and key not in keys:
+            continue
+        process = bb.get("process")
+        if getattr(process, handler_attribute, None) is not None and process.is_alive():
+            logger.info(f"Forwarding {signal.Signals(sig).name} to {key}")
+            os.kill(process.pid, sig)
+
+
+def get_args():
     parser = argparse.ArgumentParser(
         description="Validate config file for sensing data collection service module.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -142,16 +335,38 @@ def handle_args():
     )
     parser.add_argument("--module_config", help="Module config file", type=str)
     parser.add_argument("--user_config", help="User config file", type=str)
-    args = parser.parse_args()
+    parser.add_argument(
+        "--replay",
+        help="Replay recorded key event logs instead of reading the scanners",
+        nargs="+",
+        type=str,
+    )
+    parser.add_argument(
+        "--replay_speed",
+        help="Replay speed relative to the recording (1 = real time), 0 for as fast as possible",
+        default=0,
+        type=float,
+    )
+    return parser.parse_args()
+
+
+def handle_args():
+    levels = {
+        "debug": logging.DEBUG,
+        "info": logging.INFO,
+        "warning": logging.WARNING,
+        "error": logging.ERROR,
+    }
+    args = get_args()
 
     log_level = levels.get(args.log, logging.INFO)
     module_conf_file = args.module_config
     user_conf_file = args.user_config
 
-    return module_conf_file, user_conf_file, log_level
+    return args, module_conf_file, user_conf_file, log_level
 
 if __name__ == "__main__":
-    module_conf_file, user_conf_file, log_level = handle_args()
+    args, module_conf_file, user_conf_file, log_level = handle_args()
     logging.basicConfig(level=log_level)
     conf = config_manager.get_config(module_conf_file, user_conf_file)
 
@@ -163,9 +378,20 @@ if __name__ == "__main__":
         signal.signal(signal.SIGTERM, graceful_signal_handler)
         signal.signal(signal.SIGALRM, harsh_signal_handler)
 
-        bbs = create_building_blocks(conf)
+        config_watcher = config_manager.ConfigWatcher(module_conf_file, user_conf_file)
+        replay = (args.replay, args.replay_speed) if args.replay else None
+        bbs = create_building_blocks(conf, config_watcher, replay)
         start_building_blocks(bbs)
-        monitor_building_blocks(bbs)
+        main_pid = os.getpid()
+        signal.signal(
+            signal.SIGUSR1, lambda sig, _frame: forward_signal(bbs, sig, main_pid, "flight_recorder")
+        )
+        profile_keys = conf.get("diagnostics", {}).get("profiler", {}).get("blocks")
+        signal.signal(
+            signal.SIGUSR2,
+            lambda sig, _frame: forward_signal(bbs, sig, main_pid, "profiler", profile_keys),
+        )
+        monitor_building_blocks(bbs, config_watcher)
 
     else:
         logger.info(
@@ -1,19 +1,29 @@
 import time
-import datetime
 
 
 import evdev
 import asyncio
 import zmq
-import zmq.asyncio
 import json
 import traceback
 
 import logging
 import multiprocessing
+import sys
+import termios
 from KeyParser.Keyparser import Parser
-
-context = zmq.asyncio.Context()
+from utilities.scan_filters import ScanDeduplicator, DeviceRateLimiter
+from utilities.sharding import shard_for, partition
+from node_link import NodeUplink
+from tcp_readers import TCPReaderSource
+from serial_scanners import SerialScanner, serial_scan_generator
+from utilities.links import connect_link, LinkSender
+from utilities.key_events import event_timestamp, KeyEventRecorder
+from utilities.flight_recorder import FlightRecorder, dump_on_crash
+from utilities.profiler import SamplingProfiler
+from utilities.watchdog import MemoryWatchdog, RECYCLE_EXIT_CODE
+
+context = zmq.Context()  # sends never block, so the event loop doesn't need zmq.asyncio
 logger = logging.getLogger("main.multi_barcode_scan")
 
 try:
@@ -32,6 +42,8 @@ class DeviceManager(dict):
         super().__init__(init_device_set)
         self.target_paths = {}
         self.event_loop_generators = {}
+        self.recorder = None  # KeyEventRecorder when recording raw key events
+        self.serial_conf = {}  # tty settings for scanners in USB-COM mode
 
     @classmethod
     def get_udev_context(cls):
@@ -50,6 +62,29 @@ class DeviceManager(dict):
                         logger.error(f"Device at {device.device_node} not available")
         return None
 
+    @classmethod
+    def find_serial_scanner_by_path(cls, path, serial_conf):
+        # scanners in USB-COM (CDC-ACM) mode appear as a tty on the same path instead
+        for device in cls.get_udev_context().list_devices(subsystem="tty", ID_BUS="usb"):
+            if device.device_node is not None and device.properties.get("ID_PATH") == path:
+                logger.info(f"Found serial device {device.device_node}")
+                try:
+                    return SerialScanner(device.device_node, serial_conf)
+                except (OSError, ValueError, termios.error) as e:
+                    logger.error(f"Serial device at {device.device_node} not available: {e}")
+        return None
+
+    def find_device(self, path):
+        device = self.find_scanner_by_path(path)
+        if device is None:
+            device = self.find_serial_scanner_by_path(path, self.serial_conf)
+        return device
+
+    def scan_generator(self, device, loc_id):
+        if isinstance(device, SerialScanner):
+            return serial_scan_generator(device, loc_id)
+        return key_event_generator(device, loc_id, self.recorder)
+
     def set_target_device_paths(self, devices_path_map):
         for loc_id, path in devices_path_map.items():
             self.target_paths[loc_id] = path
@@ -58,88 +93,180 @@ class DeviceManager(dict):
         for loc_id, path in self.target_paths.items():
             if loc_id in self: # already found and bound
                 continue
-            device = self.find_scanner_by_path(path)
+            device = self.find_device(path)
             if device is not None:
                 device.grab()
                 self[loc_id] = device
 
     def device_lost(self, loc_id):
         if loc_id in self:
-            del self[loc_id]
+            device = self.pop(loc_id)
+            if isinstance(device, SerialScanner):  # release the tty so it can be reopened
+                device.close()
         if loc_id in self.event_loop_generators:
             del self.event_loop_generators[loc_id]
 
     def initialise_event_generators(self):
         for device_id, device in self.items():
-            self.event_loop_generators[device_id] = key_event_generator(device)
+            self.event_loop_generators[device_id] = self.scan_generator(device, device_id)
 
     def recover_disconnected_devices(self):
         for loc_id, path in self.target_paths.items():
             if loc_id not in self:
-                device = self.find_scanner_by_path(path)
+                device = self.find_device(path)
                 logger.info(f"attempt to recover device for path {path} got device {device}")
                 if device is not None:
                     device.grab()
                     self[loc_id] = device
-                    self.event_loop_generators[loc_id] = key_event_generator(device)
+                    self.event_loop_generators[loc_id] = self.scan_generator(device, loc_id)
                     logger.info(f"Reconnected to device for location_id {loc_id}")
 
 
 class BarcodeScannerManager(multiprocessing.Process):
 
-    def __init__(self, config, zmq_conf):
+    def __init__(self, config, zmq_conf, worker=0, worker_count=1, down=()):
         super().__init__()
-
-        self.scanner_map_exists, self.scanner_map = load_scanner_map()
+        self.worker = worker
+        self.worker_count = worker_count
+
+        # each worker reads a disjoint part of the scanner map - recalculated whenever it is (re)started.
+        # down lists workers that main has taken out of the split, their scanners are shared out
+        self.scanner_map_exists, scanner_map = load_scanner_map()
+        self.scanner_map = partition(scanner_map, worker, worker_count, down)
+        block_name = "ingestion" if worker_count == 1 else f"ingestion_{worker}"
+        if worker_count > 1:
+            logger.info(f"Ingestion worker {worker} reading {sorted(self.scanner_map)}")
+
+        self.tcp_source = TCPReaderSource(config, worker, worker_count, down)
+        self.deduplicator = ScanDeduplicator(config)
+        self.rate_limiter = DeviceRateLimiter(config)
+        self.stats_interval = config.get("input", {}).get("stats", {}).get("interval", 60)
+        self.record_conf = config.get("input", {}).get("record", {})
+        self.serial_conf = config.get("input", {}).get("serial", {})
+        self.flight_recorder = FlightRecorder(block_name, config)
+        self.profiler = SamplingProfiler(block_name, config)
+        self.memory_watchdog = MemoryWatchdog(block_name, config)
+
+        # set when running as a remote ingestion node
+        is_node = config.get("distributed", {}).get("role", "standalone") == "node"
+        if is_node:
+            self.uplink = NodeUplink(config, worker if worker_count > 1 else None)
+        else:
+            self.uplink = None
 
         self.zmq_conf = zmq_conf
         self.zmq_out = None
+        self.senders = []
 
     def do_connect(self):
-        self.zmq_out = context.socket(self.zmq_conf["out"]["type"])
-        if self.zmq_conf["out"]["bind"]:
-            self.zmq_out.bind(self.zmq_conf["out"]["address"])
-        else:
-            self.zmq_out.connect(self.zmq_conf["out"]["address"])
-
+        # one output link per blackboard shard
+        self.zmq_out = []
+        self.senders = []
+        for index, link_conf in enumerate(self.zmq_conf["out"]):
+            socket_options = NodeUplink.SOCKET_OPTIONS if self.uplink is not None else None
+            socket = connect_link(context, link_conf, socket_options)
+            self.zmq_out.append(socket)
+            # workers share the links so each needs its own label - it names the spill file
+            label = f"{link_conf['name']}_{index}"
+            if self.worker_count > 1:
+                label = f"{label}_w{self.worker}"
+            self.senders.append(LinkSender(socket, link_conf, label, can_block=False))
+
+    @dump_on_crash
     def run(self):
+        self.profiler.install()
         self.do_connect()
         logger.info("connected")
 
-        if not self.scanner_map_exists:
+        if not self.scanner_map_exists and not self.tcp_source.configured():
             logger.error("Scanner map not configured - unable to run! hibernating")
             while True:
                 time.sleep(3600)
 
         device_manager = DeviceManager()
         device_manager.set_target_device_paths(self.scanner_map)
+        device_manager.serial_conf = self.serial_conf
+        if self.record_conf.get("enabled", False):
+            # workers record to separate files - each file numbers its own locations
+            device_manager.recorder = KeyEventRecorder(
+                self.record_conf.get("directory", "/app/data/recordings"),
+                prefix="keys" if self.worker_count == 1 else f"keys_w{self.worker}",
+            )
 
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
 
-        device_scan_task = asyncio.Task(
-            device_scan_loop(device_manager, self.dispatch), loop=loop
-        )
+        loops = {
+            "Device scan loop": lambda: device_scan_loop(device_manager, self.dispatch),
+            "Device recovery loop": lambda: recovery_loop(device_manager),
+            "Stats loop": lambda: stats_loop(
+                [self.deduplicator, self.rate_limiter, self.tcp_source, *self.senders], self.stats_interval
+            ),
+            "Quarantine loop": lambda: quarantine_loop(self.rate_limiter, self.send_alerts),
+            "Link flush loop": lambda: link_flush_loop(self.senders),
+            "Memory loop": lambda: memory_loop(
+                self.memory_watchdog, lambda: self.structure_sizes(device_manager), self.recycle
+            ),
+        }
+        if self.tcp_source.configured():
+            loops["TCP reader loop"] = lambda: self.tcp_source.run(self.dispatch)
+        if self.uplink is not None:
+            loops["Heartbeat loop"] = lambda: heartbeat_loop(
+                self.uplink, [*self.scanner_map, *self.tcp_source.locations()], self.senders[0]
+            )
 
-        device_recovery_task = asyncio.Task(recovery_loop(device_manager), loop=loop)
+        tasks = {name: asyncio.Task(coro(), loop=loop) for name, coro in loops.items()}
 
         while True:
-            # monitor task
+            # monitor tasks
             done, pending = loop.run_until_complete(
-                asyncio.wait([device_scan_task, device_recovery_task], return_when=asyncio.FIRST_COMPLETED)
+                asyncio.wait(tasks.values(), return_when=asyncio.FIRST_COMPLETED)
             )
-            if device_scan_task in done:
-                logger.error("Device scan loop ended unexpectedly - restarting")
-                device_scan_task = asyncio.Task(
-                    device_scan_loop(device_manager, self.dispatch), loop=loop
-                )
-            if device_recovery_task in done:
-                logger.error("Device revovery loop ended unexpectedly - restarting")
-                device_recovery_task = asyncio.Task(recovery_loop(device_manager), loop=loop)
+            for name, task in tasks.items():
+                if task in done:
+                    self.flight_recorder.record("task_restart", name, repr(task.exception()))
+                    logger.error(f"{name} ended unexpectedly - restarting")
+                    tasks[name] = asyncio.Task(loops[name](), loop=loop)
+
+    def structure_sizes(self, device_manager):
+        return {
+            "devices": len(device_manager),
+            "tcp_connections": len(self.tcp_source.connections),
+            "dedup_locations": len(self.deduplicator.caches),
+            "queued_scans": sum(len(sender.queue) for sender in self.senders),
+        }
+
+    def recycle(self):
+        # nothing to keep - just send what is queued before main restarts this block
+        for sender in self.senders:
+            sender.flush()
+        logger.warning("Ingestion recycling to release memory")
+        sys.exit(RECYCLE_EXIT_CODE)
 
     async def dispatch(self, payload):
+        self.flight_recorder.record("scan", payload["id"], payload["barcode"])
+        if not self.rate_limiter.allow(payload["id"]):
+            self.flight_recorder.record("rate_limited", payload["id"])
+            self.send_alerts()  # in case this scan led to a quarantine
+            return
+        if self.deduplicator.is_duplicate(payload["id"], payload["barcode"]):
+            self.flight_recorder.record("duplicate", payload["id"])
+            logger.debug(f"Suppressed duplicate scan {payload}")
+            return
+        self.send(payload)
+
+    def send_alerts(self):
+        for alert in self.rate_limiter.pop_alerts():
+            self.flight_recorder.record("alert", alert["id"], alert["alert"])
+            self.send(alert)
+
+    def send(self, payload):
+        if self.uplink is not None:
+            payload = self.uplink.wrap(payload)
         logger.debug(f"ZMQ dispatch of {payload}")
-        await self.zmq_out.send_json(payload)
+        shard = shard_for(payload["id"], len(self.senders))
+        self.senders[shard].send([json.dumps(payload).encode()])
+        self.flight_recorder.record("sent", payload["id"], shard, self.senders[shard].pending)
 
 ###################
 # Scanner map loading and writing
@@ -173,29 +300,57 @@ async def recovery_loop(device_manager:DeviceManager, interval_seconds:int=10):
         device_manager.recover_disconnected_devices()
         await asyncio.sleep(interval_seconds)
 
+async def heartbeat_loop(uplink:NodeUplink, locations, sender:LinkSender):
+    while True:
+        sender.send([json.dumps(uplink.heartbeat(locations)).encode()])
+        await asyncio.sleep(uplink.heartbeat_interval)
+
+
+async def link_flush_loop(senders, interval_seconds=0.05):
+    # sends anything queued while a downstream block was slow
+    while True:
+        for sender in senders:
+            if sender.pending:
+                sender.flush()
+        await asyncio.sleep(interval_seconds)
+
+
+async def memory_loop(watchdog:MemoryWatchdog, get_sizes, recycle):
+    while True:
+        await asyncio.sleep(watchdog.interval)
+        if watchdog.check(get_sizes()):
+            recycle()
+
+
+async def quarantine_loop(rate_limiter:DeviceRateLimiter, send_alerts, interval_seconds=1):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        rate_limiter.release_due()
+        send_alerts()
+
+
+async def stats_loop(reporters, interval_seconds=60):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        for reporter in reporters:
+            reporter.log_stats()
+
 ###################
 # EVENT LOOPS
 ###################
 
 
-async def key_event_generator(device):
+async def key_event_generator(device, location_id=None, recorder=None):
     parser = Parser()
     # handles key events from the barcode scanner
     async for event in device.async_read_loop():
         if event.type == 1:  # key event
+            if recorder is not None:
+                recorder.record(location_id, event.sec, event.usec, event.code, event.value)
             parser.parse(event.code, event.value)
-            if parser.complete_available():
+            while parser.complete_available():  # drained so completed strings can't build up
                 msg_content = parser.get_next_string()
-
-                __dt = -1 * (
-                    time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
-                )
-                tz = datetime.timezone(datetime.timedelta(seconds=__dt))
-
-                timestamp = (
-                    datetime.datetime.fromtimestamp(event.sec, tz=tz)
-                    + datetime.timedelta(microseconds=event.usec)
-                ).isoformat()
+                timestamp = event_timestamp(event.sec, event.usec)
                 yield msg_content, timestamp
 
 
@@ -213,9 +368,11 @@ async def multi_device_scan_generator(device_manager: DeviceManager):
         device_id: asyncio.Task(gen.__anext__())
         for device_id, gen in device_manager.event_loop_generators.items()
     }
-    
+    rotation = 0
+
     while True:
         # schedule any generators that don't have a pending task
+        # - each device has at most one scan handled per round, so a busy device can't starve the rest
         for device_id, generator in device_manager.event_loop_generators.items():
             if device_id not in next_event_tasks or next_event_tasks[device_id].done():
                 next_event_tasks[device_id] = asyncio.Task(
@@ -230,31 +387,28 @@ async def multi_device_scan_generator(device_manager: DeviceManager):
         done, _pending = await asyncio.wait(
             next_event_tasks.values(), return_when=asyncio.FIRST_COMPLETED
         )
-        for task in done:
-            device_id = None
-            # get device id for completed task
-            for dev_id, dev_task in next_event_tasks.items():
-                if dev_task == task:
-                    device_id = dev_id
-                    break
+        done_devices = [device_id for device_id, task in next_event_tasks.items() if task in done]
+        # devices that completed together take turns at going first
+        rotation = (rotation + 1) % len(done_devices)
+        for device_id in done_devices[rotation:] + done_devices[:rotation]:
+            task = next_event_tasks[device_id]
             # process completed task
-            if device_id is not None:
-                try:
-                    barcode, timestamp = task.result()
-                    payload = {
-                        "id": device_id,
-                        "barcode": barcode,
-                        "timestamp": timestamp,
-                    }
-                    yield payload
-                except StopAsyncIteration:
-                    logger.error(
-                        f"Device {device_id} event generator stopped unexpectedly"
-                    )
+            try:
+                barcode, timestamp = task.result()
+                payload = {
+                    "id": device_id,
+                    "barcode": barcode,
+                    "timestamp": timestamp,
+                }
+                yield payload
+            except StopAsyncIteration:
+                logger.error(
+                    f"Device {device_id} event generator stopped unexpectedly"
+                )
+                continue
+            except OSError as e:
+                if e.errno == 19:  # device disconnected
+                    logger.error(f"Device {device_id} disconnected")
+                    device_manager.device_lost(device_id)
+                    del next_event_tasks[device_id]
                     continue
-                except OSError as e:
-                    if e.errno == 19:  # device disconnected
-                        logger.error(f"Device {device_id} disconnected")
-                        device_manager.device_lost(device_id)
-                        del next_event_tasks[device_id]
-                        continue
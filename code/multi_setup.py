@@ -156,7 +156,7 @@ async def setup_locations(location_list, old_scanner_map, all_devices):
 
 if __name__ == "__main__":
     try:
-        module_conf_file, user_conf_file, log_level = handle_args()
+        _args, module_conf_file, user_conf_file, log_level = handle_args()
         logging.basicConfig(level=logging.WARNING)
         conf = config_manager.get_config(module_conf_file, user_conf_file)
 
@@ -0,0 +1,261 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import multiprocessing
+import logging
+import json
+import time
+import uuid
+import sys
+import zmq
+
+from utilities.sharding import shard_for
+from utilities.links import connect_link, LinkSender
+from utilities.flight_recorder import FlightRecorder, dump_on_crash
+from utilities.profiler import SamplingProfiler
+from utilities.watchdog import MemoryWatchdog, RECYCLE_EXIT_CODE
+
+context = zmq.Context()
+logger = logging.getLogger("main.node_link")
+
+
+class NodeUplink:
+    """Node side of the link between a remote ingestion node and the central blackboard.
+
+    Every message is tagged with the node id, a session id (new for each run of the node, so
+    the central side can tell a restart from a replay) and a sequence number.
+    """
+
+    # for connect_link - zmq reconnects by itself, back off up to 30s and detect dead connections
+    SOCKET_OPTIONS = {
+        zmq.RECONNECT_IVL: 1000,
+        zmq.RECONNECT_IVL_MAX: 30000,
+        zmq.TCP_KEEPALIVE: 1,
+        zmq.TCP_KEEPALIVE_IDLE: 30,
+    }
+
+    def __init__(self, config, worker=None):
+        distributed_conf = config.get("distributed", {})
+        self.node_id = distributed_conf.get("node_id")
+        if worker is not None:  # each ingestion worker has its own session and sequence
+            self.node_id = f"{self.node_id}.{worker}"
+        self.heartbeat_interval = distributed_conf.get("heartbeat_interval", 5)
+        self.session = uuid.uuid4().hex
+        self.seq = 0
+
+    def wrap(self, payload):
+        self.seq += 1
+        return {**payload, "node": self.node_id, "session": self.session, "seq": self.seq}
+
+    def heartbeat(self, locations):
+        return {
+            "node": self.node_id,
+            "session": self.session,
+            "seq": self.seq,  # last sequence number sent - lets the central side spot losses
+            "heartbeat": True,
+            "locations": locations,
+        }
+
+
+class NodeGateway(multiprocessing.Process):
+    """Central side of the node links - receives scans from remote ingestion nodes,
+    drops duplicates, tracks node liveness and routes scans to the blackboard shards."""
+
+    def __init__(self, config, zmq_conf):
+        super().__init__()
+
+        distributed_conf = config.get("distributed", {})
+        self.node_timeout = distributed_conf.get("node_timeout", 15)
+        self.stats_interval = config.get("input", {}).get("stats", {}).get("interval", 60)
+
+        self.nodes = {}  # <node_id>:<node state>
+        self.invalid = 0  # messages dropped because they were malformed
+
+        self.flight_recorder = FlightRecorder("gateway", config)
+        self.profiler = SamplingProfiler("gateway", config)
+        self.memory_watchdog = MemoryWatchdog("gateway", config)
+
+        self.zmq_conf = zmq_conf
+        self.zmq_in = None
+        self.senders = []
+
+    def do_connect(self):
+        self.zmq_in = connect_link(context, self.zmq_conf["in"])
+
+        # one output link per blackboard shard
+        self.senders = []
+        for index, link_conf in enumerate(self.zmq_conf["out"]):
+            socket = connect_link(context, link_conf)
+            label = f"gateway_{link_conf.get('name', 'ingestion')}_{index}"
+            self.senders.append(LinkSender(socket, link_conf, label, can_block=False))
+
+    @dump_on_crash
+    def run(self):
+        self.profiler.install()
+        self.do_connect()
+        logger.info("connected")
+        next_stats = time.monotonic() + self.stats_interval
+        while True:
+            pending = [sender for sender in self.senders if sender.pending]
+            for sender in pending:
+                sender.flush()
+            if self.zmq_in.poll(50 if pending else 1000, zmq.POLLIN):
+                try:
+                    msg = json.loads(self.zmq_in.recv(zmq.NOBLOCK))
+                except zmq.ZMQError:
+                    continue
+                except ValueError:
+                    logger.warning("Received message that was not valid json")
+                    continue
+                payload = self.handle_message(msg, time.monotonic())
+                if payload is not None:
+                    shard = shard_for(payload["id"], len(self.senders))
+                    self.senders[shard].send([json.dumps(payload).encode()])
+                    self.flight_recorder.record("sent", payload["id"], shard, self.senders[shard].pending)
+
+            now = time.monotonic()
+            self.check_liveness(now)
+            if now >= next_stats:
+                next_stats = now + self.stats_interval
+                self.log_stats()
+            if self.memory_watchdog.due() and self.memory_watchdog.check(self.structure_sizes()):
+                self.recycle()
+
+    def structure_sizes(self):
+        return {
+            "nodes": len(self.nodes),
+            "queued_scans": sum(len(sender.queue) for sender in self.senders),
+        }
+
+    def recycle(self):
+        # node tracking restarts from the next message of each node - send what is queued first
+        for sender in self.senders:
+            sender.flush()
+        logger.warning("Gateway recycling to release memory")
+        sys.exit(RECYCLE_EXIT_CODE)
+
+    def handle_message(self, msg, now):
+        """Updates node tracking and returns the scan to forward (or None)"""
+        problem = self.check_message(msg)
+        if problem is not None:
+            self.invalid += 1
+            self.flight_recorder.record("invalid", problem)
+            logger.warning(f"Dropped invalid message ({problem}): {str(msg)[:200]}")
+            return None
+        node_id = msg.get("node")
+        if node_id is None:  # not from a node - forward as is
+            return msg
+
+        node = self.nodes.get(node_id)
+        if node is None or node["session"] != msg.get("session"):
+            if node is not None:
+                logger.info(f"Node {node_id} restarted")
+            else:
+                logger.info(f"Node {node_id} connected")
+            node = {
+                "session": msg.get("session"),
+                "last_seq": 0,
+                "last_seen": now,
+                "alive": True,
+                "forwarded": 0,
+                "duplicates": 0,
+                "missed": 0,
+                "locations": [],
+            }
+            self.nodes[node_id] = node
+        elif not node["alive"]:
+            logger.info(f"Node {node_id} is back")
+
+        node["last_seen"] = now
+        node["alive"] = True
+        seq = msg.get("seq", 0)
+
+        if msg.get("heartbeat"):
+            node["locations"] = msg.get("locations", [])
+            if seq > node["last_seq"]:
+                self.flight_recorder.record("missed", node_id, node["last_seq"], seq)
+                node["missed"] += seq - node["last_seq"]
+                logger.warning(f"Node {node_id} lost {seq - node['last_seq']} scans")
+                node["last_seq"] = seq
+            return None
+
+        if seq <= node["last_seq"]:
+            self.flight_recorder.record("duplicate", node_id, seq)
+            node["duplicates"] += 1
+            logger.debug(f"Dropped duplicate seq {seq} from node {node_id}")
+            return None
+
+        if seq > node["last_seq"] + 1:
+            self.flight_recorder.record("missed", node_id, node["last_seq"], seq)
+            node["missed"] += seq - node["last_seq"] - 1
+            logger.warning(f"Node {node_id} lost {seq - node['last_seq'] - 1} scans")
+        node["last_seq"] = seq
+        node["forwarded"] += 1
+        return msg
+
+    @staticmethod
+    def check_message(msg):
+        """Returns what is wrong with a message from the network, or None if it can be handled"""
+        if not isinstance(msg, dict):
+            return "not an object"
+        node_id = msg.get("node")
+        if node_id is not None:
+            if not isinstance(node_id, str):
+                return "node is not a string"
+            seq = msg.get("seq", 0)
+            if isinstance(seq, bool) or not isinstance(seq, int):
+                return "seq is not an integer"
+            if msg.get("heartbeat"):
+                return None if isinstance(msg.get("locations", []), list) else "locations is not a list"
+        if not isinstance(msg.get("id"), str):
+            return "id is not a string"
+        if "alert" not in msg and not isinstance(msg.get("barcode"), str):
+            return "barcode is not a string"
+        return None
+
+    def check_liveness(self, now):
+        for node_id, node in self.nodes.items():
+            if node["alive"] and now - node["last_seen"] > self.node_timeout:
+                node["alive"] = False
+                self.flight_recorder.record("node_lost", node_id)
+                logger.warning(
+                    f"Node {node_id} lost - no messages for {self.node_timeout}s "
+                    f"(locations {node['locations']})"
+                )
+
+    def stats(self):
+        return {
+            node_id: {
+                key: node[key] for key in ["alive", "forwarded", "duplicates", "missed"]
+            }
+            for node_id, node in self.nodes.items()
+        }
+
+    def log_stats(self):
+        if self.nodes:
+            logger.info(f"Node stats: {self.stats()}")
+        if self.invalid:
+            logger.warning(f"Dropped {self.invalid} invalid messages")
+        for sender in self.senders:
+            sender.log_stats()
@@ -0,0 +1,122 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import multiprocessing
+import logging
+import json
+import time
+import zmq
+
+from KeyParser.Keyparser import Parser
+from utilities.key_events import event_timestamp, read_key_events
+from utilities.links import connect_link, LinkSender
+from utilities.sharding import shard_for
+from utilities.flight_recorder import FlightRecorder, dump_on_crash
+from utilities.profiler import SamplingProfiler
+from utilities.watchdog import MemoryWatchdog
+
+context = zmq.Context()
+logger = logging.getLogger("main.scan_replay")
+
+
+class ScanLogReplayer(multiprocessing.Process):
+    """Stands in for the scanner manager and feeds recorded key events back through the
+    Parser and the rest of the pipeline.
+
+    speed is relative to the original timing (1 = real time, 10 = ten times faster),
+    0 replays as fast as possible.
+    """
+
+    def __init__(self, config, zmq_conf, log_files, speed=0):
+        super().__init__()
+        self.log_files = log_files
+        self.speed = speed
+
+        self.flight_recorder = FlightRecorder("replay", config)
+        self.profiler = SamplingProfiler("replay", config)
+        self.memory_watchdog = MemoryWatchdog("replay", config)
+        self.parsers = {}  # <location_id>:Parser
+
+        self.zmq_conf = zmq_conf
+        self.senders = []
+
+    def do_connect(self):
+        # one output link per blackboard shard - nothing may be dropped during a replay
+        self.senders = []
+        for index, link_conf in enumerate(self.zmq_conf["out"]):
+            socket = connect_link(context, link_conf)
+            self.senders.append(LinkSender(socket, {**link_conf, "policy": "block"}, f"replay_{index}"))
+
+    @dump_on_crash
+    def run(self):
+        self.profiler.install()
+        self.do_connect()
+        logger.info("connected")
+
+        start = time.monotonic()
+        count = 0
+        for payload in self.replay():
+            shard = shard_for(payload["id"], len(self.senders))
+            self.senders[shard].send([json.dumps(payload).encode()])
+            self.flight_recorder.record("sent", payload["id"], shard)
+            count += 1
+            # reported only - a replay runs once, so main would not restart it to finish
+            if self.memory_watchdog.due() and self.memory_watchdog.check(self.structure_sizes()):
+                logger.warning("Replay is over the memory recycle limit - carrying on to finish the replay")
+
+        logger.info(f"Replayed {count} scans in {time.monotonic() - start:.1f}s")
+        for sender in self.senders:
+            sender.socket.close(linger=-1)  # wait until everything is delivered
+
+    def structure_sizes(self):
+        return {"parsers": len(self.parsers)}
+
+    def replay(self):
+        parsers = self.parsers
+        first_event = None
+        replay_start = time.monotonic()
+
+        for filename in self.log_files:
+            logger.info(f"Replaying {filename}")
+            self.flight_recorder.record("file", filename)
+            for location_id, sec, usec, code, value in read_key_events(filename):
+                if self.speed > 0:
+                    event_time = sec + usec / 1e6
+                    if first_event is None:
+                        first_event = event_time
+                    delay = (event_time - first_event) / self.speed - (time.monotonic() - replay_start)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                parser = parsers.get(location_id)
+                if parser is None:
+                    parser = Parser()
+                    parsers[location_id] = parser
+                parser.parse(code, value)
+                while parser.complete_available():
+                    yield {
+                        "id": location_id,
+                        "barcode": parser.get_next_string(),
+                        "timestamp": event_timestamp(sec, usec),
+                    }
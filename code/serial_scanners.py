@@ -0,0 +1,127 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import asyncio
+import errno
+import fcntl
+import logging
+import os
+import termios
+
+from utilities.framing import Framer
+from utilities.key_events import current_timestamp
+
+logger = logging.getLogger("main.serial_scanners")
+
+PARITY_FLAGS = {
+    "none": 0,
+    "even": termios.PARENB,
+    "odd": termios.PARENB | termios.PARODD,
+}
+BYTESIZE_FLAGS = {5: termios.CS5, 6: termios.CS6, 7: termios.CS7, 8: termios.CS8}
+
+
+class SerialScanner:
+    """A scanner in USB-COM (CDC-ACM) mode - it sends each barcode as bytes on a tty rather than
+    as key presses, so a whole barcode arrives in one read and there is nothing to decode.
+
+    Stands in for an evdev InputDevice in the DeviceManager: grab() stops other processes
+    opening the tty and close() releases it.
+    """
+
+    def __init__(self, device_node, serial_conf=None):
+        serial_conf = serial_conf if serial_conf is not None else {}
+        self.device_node = device_node
+        self.framer = Framer.from_config({"delimiter": "\r", **serial_conf})
+        self.read_size = serial_conf.get("read_size", 4096)
+        self.fd = os.open(device_node, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            configure_tty(self.fd, serial_conf)
+        except (termios.error, ValueError):
+            os.close(self.fd)
+            raise
+
+    def grab(self):
+        fcntl.ioctl(self.fd, termios.TIOCEXCL)
+
+    async def read(self):
+        """Waits until the tty is readable and returns what is available.
+        Raises OSError(ENODEV) when the scanner has gone, as evdev does for a lost input device."""
+        loop = asyncio.get_running_loop()
+        while True:
+            readable = loop.create_future()
+            loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(self.fd)
+            try:
+                data = os.read(self.fd, self.read_size)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                if e.errno == errno.EIO:  # tty hung up - the scanner was unplugged
+                    raise OSError(errno.ENODEV, f"{self.device_node} disconnected") from e
+                raise
+            if not data:
+                raise OSError(errno.ENODEV, f"{self.device_node} disconnected")
+            return data
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def configure_tty(fd, serial_conf):
+    # raw mode - no echo, line editing or translation of CR/LF
+    iflag, oflag, cflag, lflag, _ispeed, _ospeed, cc = termios.tcgetattr(fd)
+    baud = serial_conf.get("baud", 9600)
+    speed = getattr(termios, f"B{baud}", None)
+    if speed is None:
+        raise ValueError(f"Unsupported baud rate {baud}")
+
+    iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP
+               | termios.INLCR | termios.IGNCR | termios.ICRNL | termios.IXON)
+    oflag &= ~termios.OPOST
+    lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+    cflag &= ~(termios.CSIZE | termios.PARENB | termios.PARODD | termios.CSTOPB)
+    cflag |= termios.CREAD | termios.CLOCAL
+    cflag |= BYTESIZE_FLAGS[serial_conf.get("bytesize", 8)]
+    cflag |= PARITY_FLAGS[serial_conf.get("parity", "none")]
+    if serial_conf.get("stopbits", 1) == 2:
+        cflag |= termios.CSTOPB
+    cc[termios.VMIN] = 0
+    cc[termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+
+
+async def serial_scan_generator(scanner, location_id=None):
+    # the serial counterpart of key_event_generator - yields (barcode, timestamp)
+    while True:
+        data = await scanner.read()
+        for barcode in scanner.framer.feed(data):
+            logger.debug(f"Serial scan at {location_id}: {barcode}")
+            yield barcode, current_timestamp()
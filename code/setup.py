@@ -152,7 +152,7 @@ def save_scanner_id(scanner_spec):
 
 
 if __name__ == "__main__":
-    module_conf_file, user_conf_file, log_level = handle_args()
+    _args, module_conf_file, user_conf_file, log_level = handle_args()
     logging.basicConfig(level=logging.WARNING)
     conf = config_manager.get_config(module_conf_file, user_conf_file)
     
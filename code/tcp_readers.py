@@ -0,0 +1,183 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import asyncio
+import logging
+import random
+import socket
+
+from utilities.framing import Framer
+from utilities.key_events import current_timestamp
+from utilities.sharding import partition
+
+logger = logging.getLogger("main.tcp_readers")
+
+FRAMING_KEYS = ("framing", "delimiter", "max_length", "encoding")
+
+
+class TCPReaderSource:
+    """Reads barcodes from fixed-mount readers that send them over TCP.
+
+    Readers listed under input.tcp.readers are connected to (client side) and reconnected with
+    exponential backoff. Readers that connect in themselves (server side) are mapped to a location
+    by their address using input.tcp.server.peers. Scans are passed to dispatch in the same form
+    as those read from USB scanners.
+    """
+
+    def __init__(self, config, worker=0, worker_count=1, down=()):
+        tcp_conf = config.get("input", {}).get("tcp", {})
+        self.framing_conf = {key: tcp_conf[key] for key in FRAMING_KEYS if key in tcp_conf}
+        # like the scanner map, the readers are split between the ingestion workers
+        self.readers = partition(tcp_conf.get("readers", {}), worker, worker_count, down)
+        self.server_conf = tcp_conf.get("server", {})
+        self.peers = self.server_conf.get("peers", {})  # <peer host>:<location_id>
+        # several workers share the listening port - the kernel spreads the connections over them
+        self.reuse_port = worker_count > 1
+        self.backoff_initial = tcp_conf.get("backoff", {}).get("initial", 1)
+        self.backoff_max = tcp_conf.get("backoff", {}).get("max", 60)
+        self.read_size = tcp_conf.get("read_size", 65536)
+
+        self.connections = {}  # <location_id>:StreamWriter
+        self.scans = 0
+        self.reconnects = 0
+        self.refused = 0
+
+    def configured(self):
+        return bool(self.readers or self.peers)
+
+    def locations(self):
+        return [*self.readers, *self.peers.values()]
+
+    async def run(self, dispatch):
+        tasks = [
+            asyncio.create_task(self.client_loop(location_id, reader_conf, dispatch))
+            for location_id, reader_conf in self.readers.items()
+        ]
+        server = None
+        if self.peers:
+            host, port = split_address(self.server_conf.get("listen", "0.0.0.0:2100"))
+            server = await asyncio.start_server(
+                lambda reader, writer: self.handle_connection(reader, writer, dispatch),
+                host,
+                port,
+                reuse_port=self.reuse_port,
+            )
+            logger.info(f"Listening for readers on {host}:{port}")
+            tasks.append(asyncio.create_task(server.serve_forever()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # so that restarting this loop doesn't leave the old connections running
+            for task in tasks:
+                task.cancel()
+            for writer in self.connections.values():
+                writer.close()
+            self.connections.clear()
+            if server is not None:
+                server.close()
+
+    async def client_loop(self, location_id, reader_conf, dispatch):
+        host, port = split_address(reader_conf["address"])
+        framer = Framer.from_config({**self.framing_conf, **reader_conf})
+        delay = self.backoff_initial
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                # jittered so that readers lost together (e.g. a switch restart) don't retry in step
+                wait = delay * random.uniform(0.5, 1)
+                logger.warning(
+                    f"Unable to connect to reader for {location_id} at {host}:{port} ({e}) "
+                    f"- retrying in {wait:.1f}s"
+                )
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.backoff_max)
+                continue
+
+            logger.info(f"Connected to reader for {location_id} at {host}:{port}")
+            delay = self.backoff_initial
+            framer.reset()
+            await self.read_stream(location_id, reader, writer, framer, dispatch)
+            logger.warning(f"Connection to reader for {location_id} lost - reconnecting")
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+
+    async def handle_connection(self, reader, writer, dispatch):
+        host = writer.get_extra_info("peername")[0]
+        location_id = self.peers.get(host)
+        if location_id is None:
+            logger.warning(f"Refused connection from unknown reader at {host}")
+            self.refused += 1
+            writer.close()
+            return
+        previous = self.connections.get(location_id)
+        if previous is not None:  # the reader reconnected before the old connection timed out
+            previous.close()
+        logger.info(f"Reader for {location_id} connected from {host}")
+        framer = Framer.from_config({**self.framing_conf, **self.server_conf})
+        await self.read_stream(location_id, reader, writer, framer, dispatch)
+        logger.info(f"Reader for {location_id} at {host} disconnected")
+
+    async def read_stream(self, location_id, reader, writer, framer, dispatch):
+        self.connections[location_id] = writer
+        sock = writer.get_extra_info("socket")
+        if sock is not None:  # notice readers that are powered off without closing the connection
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        try:
+            while True:
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                for barcode in framer.feed(data):
+                    self.scans += 1
+                    await dispatch(make_scan(location_id, barcode))
+        except OSError as e:
+            logger.error(f"Error reading from reader for {location_id}: {e}")
+        finally:
+            if self.connections.get(location_id) is writer:
+                del self.connections[location_id]
+            writer.close()
+
+    def stats(self):
+        return {
+            "connected": len(self.connections),
+            "configured": len(self.readers) + len(self.peers),
+            "scans": self.scans,
+            "reconnects": self.reconnects,
+            "refused": self.refused,
+        }
+
+    def log_stats(self):
+        if self.configured():
+            logger.info(f"TCP readers: {self.stats()}")
+
+
+def make_scan(location_id, barcode):
+    return {"id": location_id, "barcode": barcode, "timestamp": current_timestamp()}
+
+
+def split_address(address):
+    host, _, port = address.rpartition(":")
+    return host, int(port)
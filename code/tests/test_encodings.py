@@ -0,0 +1,33 @@
+import json
+import unittest
+from utilities import encodings
+from utilities.encodings import make_encoder
+
+
+class TestEncodings(unittest.TestCase):
+    payload = {"job_id": "1234", "count": 3, "location": None}
+
+    def test_json(self):
+        self.assertEqual(self.payload, json.loads(make_encoder("json")(self.payload)))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            make_encoder("xml")
+
+    @unittest.skipIf(encodings.msgpack is None, "msgpack not installed")
+    def test_msgpack(self):
+        self.assertEqual(self.payload, encodings.msgpack.unpackb(make_encoder("msgpack")(self.payload)))
+
+    @unittest.skipIf(encodings.cbor2 is None, "cbor2 not installed")
+    def test_cbor(self):
+        self.assertEqual(self.payload, encodings.cbor2.loads(make_encoder("cbor")(self.payload)))
+
+    def test_missing_package(self):
+        for encoding, module in [("msgpack", "msgpack"), ("cbor", "cbor2")]:
+            if getattr(encodings, module) is None:
+                with self.assertRaises(ValueError):
+                    make_encoder(encoding)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,85 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile
+import json
+import os
+import signal
+
+from utilities.flight_recorder import FlightRecorder, dump_on_crash
+
+
+class TestFlightRecorder(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = {"diagnostics": {"flight_recorder": {
+            "size": 3, "directory": self.tmp_dir.name, "latency_threshold": 0.1}}}
+        self.recorder = FlightRecorder("test", self.config)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_dump(self, filename):
+        with open(filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_ring_and_dump(self):
+        for i in range(5):
+            self.recorder.record("in", "loc_1", f"job_{i}")
+        lines = self.read_dump(self.recorder.dump("test"))
+        self.assertEqual("test", lines[0]["reason"])
+        self.assertEqual([["loc_1", "job_2"], ["loc_1", "job_3"], ["loc_1", "job_4"]],
+                         [line["details"] for line in lines[1:]])
+
+    def test_latency(self):
+        self.recorder.check_latency("batch", 0.05)
+        self.assertEqual([], os.listdir(self.tmp_dir.name))
+        self.recorder.check_latency("batch", 0.2)
+        self.recorder.check_latency("batch", 0.3)  # within dump_interval of the first
+        self.assertEqual(1, len(os.listdir(self.tmp_dir.name)))
+        self.assertEqual("slow", self.recorder.events[-1][1])
+
+    def test_signal_and_crash(self):
+        class Block:
+            flight_recorder = self.recorder
+
+            @dump_on_crash
+            def run(self):
+                os.kill(os.getpid(), signal.SIGUSR1)
+                raise RuntimeError("boom")
+
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            with self.assertRaises(RuntimeError):
+                Block().run()
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+        reasons = sorted(self.read_dump(os.path.join(self.tmp_dir.name, filename))[0]["reason"]
+                         for filename in os.listdir(self.tmp_dir.name))
+        self.assertEqual(["SIGUSR1", "crash: RuntimeError('boom')"], reasons)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
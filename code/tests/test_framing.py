@@ -0,0 +1,48 @@
+import unittest
+from utilities.framing import Framer
+
+
+class TestDelimiterFraming(unittest.TestCase):
+    def test_bulk_and_partial_reads(self):
+        framer = Framer(delimiter=b"\r\n")
+        self.assertEqual(["A1", "B2"], framer.feed(b"A1\r\nB2\r\nC"))
+        self.assertEqual([], framer.feed(b"3"))
+        self.assertEqual(["C3"], framer.feed(b"\r\n"))
+
+    def test_keeps_group_separator(self):
+        framer = Framer()
+        self.assertEqual(["0109501101530003\x1d10AB"], framer.feed(b"0109501101530003\x1d10AB\r\n"))
+
+    def test_blank_lines_ignored(self):
+        self.assertEqual(["A1"], Framer().feed(b"\n\r\nA1\n\n"))
+
+    def test_overflow(self):
+        framer = Framer(max_length=8)
+        self.assertEqual([], framer.feed(b"0123456789"))
+        self.assertEqual(1, framer.overflows)
+        self.assertEqual(["A1"], framer.feed(b"A1\n"))
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            Framer("etx")
+
+
+class TestSTXETXFraming(unittest.TestCase):
+    def test_frames(self):
+        framer = Framer("stx_etx")
+        self.assertEqual(["A1", "B2"], framer.feed(b"\x02A1\x03noise\r\n\x02B2\x03\x02C"))
+        self.assertEqual(["C3"], framer.feed(b"3\x03"))
+        self.assertEqual(b"", bytes(framer.buffer))
+
+    def test_missing_etx(self):
+        # a frame that lost its ETX is dropped, the next one is kept
+        framer = Framer("stx_etx")
+        self.assertEqual(["B2"], framer.feed(b"\x02A1\x02B2\x03"))
+
+    def test_from_config(self):
+        framer = Framer.from_config({"framing": "delimiter", "delimiter": "\r"})
+        self.assertEqual(["A1", "B2"], framer.feed(b"A1\rB2\r"))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,55 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from utilities.gs1 import parse_gs1
+
+
+class TestParseGS1(unittest.TestCase):
+    def test_separated(self):
+        self.assertEqual({'01': '09501101530003', '17': '251231', '10': 'AB12', '21': 'XYZ'},
+                         parse_gs1("]C101095011015300031725123110AB12\x1d21XYZ"))
+        # four digit AI, FNC1 after a fixed length element and a substitute separator
+        self.assertEqual({'00': '123456789012345675', '3103': '000125', '10': 'B7'},
+                         parse_gs1("|00123456789012345675|310300012510B7", separators=("|",)))
+
+    def test_variable_length_limit(self):
+        # a batch is at most 20 characters so the next AI can follow without a separator
+        self.assertEqual({'10': "A" * 20, '21': '5'}, parse_gs1("10" + "A" * 20 + "215"))
+
+    def test_bracketed(self):
+        self.assertEqual({'01': '09501101530003', '10': 'AB12'}, parse_gs1("(01)09501101530003(10)AB12"))
+        with self.assertRaises(ValueError):
+            parse_gs1("(01)0950110153(10)AB12")  # GTIN too short
+
+    def test_invalid(self):
+        for barcode in ["job_1234", "0109501101", "10\x1d21X", "", "(10)AB(5)C"]:
+            with self.subTest(barcode=barcode):
+                with self.assertRaises(ValueError):
+                    parse_gs1(barcode)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+from utilities.history import HistoryStore
+
+
+class FakeClock:
+    def __init__(self, now=1700000000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestHistoryStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.store = HistoryStore({"directory": self.tmp_dir.name, "retention_days": 1}, 0, self.clock)
+
+    def tearDown(self):
+        self.store.stop()
+        if self.store.reader is not None:
+            self.store.reader.close()
+        self.tmp_dir.cleanup()
+
+    def write(self, scans):
+        self.store.start()
+        for scan in scans:
+            self.store.record(*scan)
+        self.store.stop()
+
+    def test_queries(self):
+        self.write([
+            ("Cutting", "job_1234", "2024-05-01T08:00:00+00:00"),
+            ("Welding", "job_1234", "2024-05-01T09:00:00+00:00"),
+            ("Cutting", "job_1234", "2024-05-01T10:00:00+00:00"),
+            ("Cutting", "job_9", "2024-05-01T11:00:00+00:00"),
+        ])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, "scans_0.db")))
+        last = self.store.query(barcode="job_1234", location_id="Cutting", limit=1)
+        self.assertEqual([{"location": "Cutting", "barcode": "job_1234", "timestamp": "2024-05-01T10:00:00+00:00"}], last)
+        in_range = self.store.query(location_id="Cutting", start="2024-05-01T09:30:00+00:00",
+                                    end="2024-05-01T12:00:00+00:00")
+        self.assertEqual(["job_9", "job_1234"], [scan["barcode"] for scan in in_range])
+        self.assertEqual(3, len(self.store.query(barcode="job_1234")))
+        with self.assertRaises(ValueError):
+            self.store.query(start="yesterday")
+
+    def test_retention(self):
+        self.clock.now = 1714550400 + 2 * 86400  # two days after the scans
+        self.write([
+            ("Cutting", "job_1", "2024-05-01T08:00:00+00:00"),
+            ("Cutting", "job_2", None),  # no timestamp - the time it was recorded is used
+        ])
+        self.assertEqual(["job_2"], [scan["barcode"] for scan in self.store.query()])
+        self.assertEqual(1, self.store.deleted)
+
+    def test_bounded_queue(self):
+        store = HistoryStore({"directory": self.tmp_dir.name, "queue_size": 2})  # not started
+        for i in range(3):
+            store.record("Cutting", f"job_{i}", None)
+        self.assertEqual(2, len(store.queue))
+        self.assertEqual(1, store.dropped)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
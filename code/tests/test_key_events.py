@@ -0,0 +1,56 @@
+import unittest
+import glob
+import os
+import tempfile
+from utilities.key_events import KeyEventRecorder, read_key_events
+from scan_replay import ScanLogReplayer
+
+# shift+a, b, enter -> "Ab"
+KEYS_AB = [(42, 1), (30, 1), (42, 0), (30, 0), (48, 1), (48, 0), (28, 1), (28, 0)]
+# a, s, d, enter -> "asd"
+KEYS_ASD = [(30, 1), (30, 0), (31, 1), (31, 0), (32, 1), (32, 0), (28, 1), (28, 0)]
+
+
+class TestKeyEventLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        recorder = KeyEventRecorder(self.tmp_dir.name)
+        # interleave two locations
+        for i, (ab, asd) in enumerate(zip(KEYS_AB, KEYS_ASD)):
+            recorder.record("cutting", 1700000000, i, *ab)
+            recorder.record("painting", 1700000000, i, *asd)
+        recorder.close()
+        self.log_files = glob.glob(os.path.join(self.tmp_dir.name, "keys_*.bin"))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        self.assertEqual(1, len(self.log_files))
+        events = list(read_key_events(self.log_files[0]))
+        self.assertEqual(16, len(events))
+        self.assertEqual(("cutting", 1700000000, 0, 42, 1), events[0])
+        self.assertEqual(("painting", 1700000000, 7, 28, 0), events[-1])
+
+    def test_existing_log_kept(self):
+        size = os.path.getsize(self.log_files[0])
+        for prefix in ["keys", "keys_w1"]:
+            recorder = KeyEventRecorder(self.tmp_dir.name, prefix=prefix)
+            recorder.record("cutting", 1700000000, 0, 30, 1)
+            recorder.close()
+        self.assertEqual(size, os.path.getsize(self.log_files[0]))
+        self.assertEqual(3, len(glob.glob(os.path.join(self.tmp_dir.name, "keys_*.bin"))))
+
+    def test_replay(self):
+        replayer = ScanLogReplayer({}, {}, self.log_files)
+        scans = [(scan["id"], scan["barcode"]) for scan in replayer.replay()]
+        self.assertEqual([("cutting", "Ab"), ("painting", "asd")], scans)
+
+    def test_truncated(self):
+        with open(self.log_files[0], "rb+") as f:
+            f.truncate(os.path.getsize(self.log_files[0]) - 3)
+        self.assertEqual(15, len(list(read_key_events(self.log_files[0]))))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
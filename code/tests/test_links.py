@@ -0,0 +1,74 @@
+import unittest
+import os
+import tempfile
+import zmq
+import utilities.links as links
+from utilities.links import LinkSender, connect_link
+
+
+class TestLinkSender(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        links.SPILL_DIR = self.tmp_dir.name
+        self.address = f"ipc://{os.path.join(self.tmp_dir.name, 'link')}"
+        self.context = zmq.Context()
+        # no receiver yet - the socket fills up after hwm messages
+        self.socket = connect_link(self.context, {"type": zmq.PUSH, "address": self.address, "bind": False, "hwm": 1})
+        self.socket.setsockopt(zmq.LINGER, 0)
+
+    def tearDown(self):
+        self.socket.close()
+        self.context.term()
+        self.tmp_dir.cleanup()
+
+    def send_all(self, sender, count):
+        for i in range(count):
+            sender.send([str(i).encode()])
+
+    def receive_all(self, sender):
+        receiver = connect_link(self.context, {"type": zmq.PULL, "address": self.address, "bind": True})
+        received = []
+        for _ in range(100):
+            sender.flush()
+            while receiver.poll(10):
+                received.append(int(receiver.recv()))
+        receiver.close()
+        return received
+
+    def test_socket_options(self):
+        socket = connect_link(self.context, {"type": zmq.PUSH, "address": self.address, "bind": False},
+                              {zmq.RECONNECT_IVL_MAX: 30000, zmq.LINGER: 0})
+        self.assertEqual(30000, socket.getsockopt(zmq.RECONNECT_IVL_MAX))
+        socket.close()
+
+    def test_drop_newest(self):
+        sender = LinkSender(self.socket, {"policy": "drop_newest"}, "test")
+        self.send_all(sender, 10)
+        self.assertGreater(sender.dropped, 0)
+        received = self.receive_all(sender)
+        self.assertEqual(list(range(len(received))), received)
+
+    def test_drop_oldest(self):
+        sender = LinkSender(self.socket, {"policy": "drop_oldest", "queue_size": 3}, "test")
+        self.send_all(sender, 10)
+        self.assertEqual(3, sender.stats()["queued"])
+        received = self.receive_all(sender)
+        self.assertEqual([7, 8, 9], received[-3:])
+        self.assertEqual(10, len(received) + sender.dropped)
+
+    def test_spill(self):
+        sender = LinkSender(self.socket, {"policy": "spill", "queue_size": 3}, "test")
+        self.send_all(sender, 20)
+        self.assertEqual(0, sender.dropped)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, "test.spill")))
+        self.assertEqual(list(range(20)), self.receive_all(sender))
+        self.assertFalse(sender.pending)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "test.spill")))
+
+    def test_no_blocking_allowed(self):
+        sender = LinkSender(self.socket, {"policy": "block"}, "test", can_block=False)
+        self.assertEqual("drop_oldest", sender.policy)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
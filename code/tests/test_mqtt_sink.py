@@ -0,0 +1,203 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+from wrapper import MQTTSink, MQTTServiceWrapper
+
+
+class FakeRecorder:
+    def record(self, *_args):
+        pass
+
+
+def read_varint(data, index):
+    value, shift = 0, 0
+    while True:
+        byte = data[index]
+        index += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, index
+
+
+def read_string(data, index):
+    (length,) = struct.unpack_from(">H", data, index)
+    return data[index + 2:index + 2 + length].decode(), index + 2 + length
+
+
+def read_properties(data, index):
+    length, index = read_varint(data, index)
+    end = index + length
+    properties = {}
+    while index < end:
+        identifier = data[index]
+        index += 1
+        if identifier == 0x11:  # session expiry interval
+            properties["session_expiry"] = struct.unpack_from(">I", data, index)[0]
+            index += 4
+        elif identifier == 0x23:  # topic alias
+            properties["alias"] = struct.unpack_from(">H", data, index)[0]
+            index += 2
+        elif identifier == 0x03:  # content type
+            properties["content_type"], index = read_string(data, index)
+        elif identifier == 0x26:  # user property
+            key, index = read_string(data, index)
+            value, index = read_string(data, index)
+            properties.setdefault("user", []).append((key, value))
+        else:
+            raise ValueError(f"Unexpected property {identifier}")
+    return properties, end
+
+
+class FakeBroker(threading.Thread):
+    """Accepts an MQTT v5 client, allows 10 topic aliases and records what it is sent.
+    With drop_after, the first connection is closed after that many publishes and the client's
+    reconnection is accepted."""
+
+    def __init__(self, expected_publishes, drop_after=None):
+        super().__init__(daemon=True)
+        self.expected_publishes = expected_publishes
+        self.drop_after = drop_after
+        self.received = threading.Event()
+        self.dropped = threading.Event()
+        self.finish = threading.Event()  # the connection is kept until the client has stopped
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.connect = None
+        self.publishes = []
+        self.connection_count = 0
+
+    def run(self):
+        self.server.settimeout(5)
+        try:
+            while self.serve(self.server.accept()[0]):
+                pass  # dropped - accept the reconnection
+        except socket.timeout:
+            return
+        finally:
+            self.server.close()
+
+    def serve(self, connection):
+        """Returns True if the connection was dropped"""
+        self.connection_count += 1
+        connection.settimeout(5)
+        buffer = b""
+        try:
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    return False
+                buffer += data
+                while len(buffer) >= 2:
+                    length, start = read_varint(buffer, 1)
+                    if len(buffer) < start + length:
+                        break
+                    packet_type, body = buffer[0] >> 4, buffer[start:start + length]
+                    buffer = buffer[start + length:]
+                    if packet_type == 1:  # CONNECT
+                        _protocol, index = read_string(body, 0)
+                        flags = body[index + 1]
+                        properties, _index = read_properties(body, index + 4)
+                        self.connect = {"clean_start": bool(flags & 0x02), **properties}
+                        connection.sendall(b"\x20\x06\x00\x00\x03\x22\x00\x0a")  # CONNACK, 10 aliases
+                    elif packet_type == 3:  # PUBLISH, QoS 0
+                        topic, index = read_string(body, 0)
+                        properties, index = read_properties(body, index)
+                        self.publishes.append((self.connection_count, topic, properties, body[index:]))
+                        if len(self.publishes) == self.drop_after and not self.dropped.is_set():
+                            self.dropped.set()
+                            return True
+                        if len(self.publishes) == self.expected_publishes:
+                            self.received.set()
+                            self.finish.wait(5)
+                            return False
+        except socket.timeout:
+            return False
+        finally:
+            connection.close()
+
+
+class TestMQTTv5Sink(unittest.TestCase):
+    def start_sink(self, broker):
+        sink = MQTTSink("mqtt", {
+            "broker": "127.0.0.1", "port": broker.port, "base_topic_template": "",
+            "reconnect": {"initial": 0.01, "backoff": 2, "limit": 1},
+            "version": 5, "client_id": "barcode_test", "session_expiry": 3600,
+            "user_properties": {"site": "A"},
+        }, FakeRecorder())
+        sink.start()
+        self.wait_for_aliases(sink)
+        return sink
+
+    def wait_for_aliases(self, sink):
+        deadline = time.monotonic() + 5
+        while sink.topic_aliases.maximum == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)  # wait for the CONNACK
+
+    def stop(self, sink, broker):
+        broker.received.wait(5)
+        sink.stop()
+        broker.finish.set()
+        broker.join(5)
+
+    def test_aliases_session_and_properties(self):
+        broker = FakeBroker(4)
+        broker.start()
+        sink = self.start_sink(broker)
+        for i in range(3):
+            sink.put("Cutting/feeds/jobs", f'{{"job_id": "{i}"}}'.encode(), {})
+        sink.put("Cutting/stats", b"\xa0", {"encoding": "cbor", "content_type": "application/cbor"})
+        self.stop(sink, broker)
+
+        self.assertEqual({"clean_start": False, "session_expiry": 3600}, broker.connect)
+        self.assertEqual(
+            [("Cutting/feeds/jobs", None), ("Cutting/feeds/jobs", 1), ("", 1), ("Cutting/stats", None)],
+            [(topic, properties.get("alias")) for _connection, topic, properties, _payload in broker.publishes],
+        )
+        self.assertEqual(b'{"job_id": "2"}', broker.publishes[2][3])
+        _connection, _topic, properties, payload = broker.publishes[3]
+        self.assertEqual(b"\xa0", payload)
+        self.assertEqual("application/cbor", properties["content_type"])
+        self.assertEqual([("site", "A"), ("encoding", "cbor")], properties["user"])
+
+    def test_aliases_reset_on_reconnect(self):
+        broker = FakeBroker(5, drop_after=3)
+        broker.start()
+        sink = self.start_sink(broker)
+        for i in range(3):
+            sink.put("Cutting/feeds/jobs", f'{{"job_id": "{i}"}}'.encode(), {})
+        broker.dropped.wait(5)
+        deadline = time.monotonic() + 5
+        while broker.connection_count < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for i in range(3, 5):
+            sink.put("Cutting/feeds/jobs", f'{{"job_id": "{i}"}}'.encode(), {})
+        self.stop(sink, broker)
+
+        self.assertEqual(2, broker.connection_count)
+        # the new connection doesn't know the old aliases, so the topic is sent again
+        self.assertEqual(
+            [(1, "Cutting/feeds/jobs"), (1, "Cutting/feeds/jobs"), (1, ""),
+             (2, "Cutting/feeds/jobs"), (2, "Cutting/feeds/jobs")],
+            [(connection, topic) for connection, topic, _properties, _payload in broker.publishes],
+        )
+
+
+class TestSinkRouting(unittest.TestCase):
+    def test_configured_sections_built_and_unknown_counted(self):
+        wrapper = MQTTServiceWrapper({"service_layer": {
+            "sinks": ["file"], "file": {"directory": "/tmp"}, "zmq": {"address": "inproc://routing"},
+        }}, {})
+        wrapper.sinks = wrapper.make_sinks()
+        self.assertEqual({"file", "zmq"}, set(wrapper.sinks))
+
+        wrapper.route("topic", b"{}", {"sinks": ["zmq", "missing"]})
+        wrapper.route("topic", b"{}", {"sinks": ["missing"]})
+        self.assertEqual(1, len(wrapper.sinks["zmq"].queue))
+        self.assertEqual({"missing": 2}, dict(wrapper.unknown_sinks))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
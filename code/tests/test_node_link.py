@@ -0,0 +1,107 @@
+import unittest
+import multiprocessing
+import os
+import tempfile
+import time
+import zmq
+from node_link import NodeUplink, NodeGateway
+from utilities.links import connect_link
+
+
+def run_node(node_id, address, count):
+    context = zmq.Context()
+    socket = connect_link(context, {"type": zmq.PUSH, "address": address, "bind": False},
+                          NodeUplink.SOCKET_OPTIONS)
+    uplink = NodeUplink({"distributed": {"node_id": node_id}})
+    for i in range(count):
+        msg = uplink.wrap({"id": f"{node_id}_loc", "barcode": f"job_{i}", "timestamp": "now"})
+        socket.send_json(msg)
+        if i % 2 == 0:
+            socket.send_json(msg)  # resend - should be dropped by the gateway
+    socket.send_json(uplink.heartbeat([f"{node_id}_loc"]))
+    socket.close(linger=5000)
+    context.term()
+
+
+class TestNodeGateway(unittest.TestCase):
+    def setUp(self):
+        self.gateway = NodeGateway({}, {})
+
+    def test_duplicates_and_gaps(self):
+        uplink = NodeUplink({"distributed": {"node_id": "n1"}})
+        first = uplink.wrap({"id": "loc", "barcode": "a"})
+        self.assertEqual(first, self.gateway.handle_message(first, 0))
+        self.assertIsNone(self.gateway.handle_message(first, 0))
+        uplink.wrap({"id": "loc", "barcode": "b"})  # lost in transit
+        third = uplink.wrap({"id": "loc", "barcode": "c"})
+        self.assertEqual(third, self.gateway.handle_message(third, 0))
+        self.assertEqual({"n1": {"alive": True, "forwarded": 2, "duplicates": 1, "missed": 1}},
+                         self.gateway.stats())
+
+    def test_restart_and_liveness(self):
+        first = NodeUplink({"distributed": {"node_id": "n1"}}).wrap({"id": "loc", "barcode": "a"})
+        restarted = NodeUplink({"distributed": {"node_id": "n1"}}).wrap({"id": "loc", "barcode": "a"})
+        self.assertIsNotNone(self.gateway.handle_message(first, 0))
+        self.assertIsNotNone(self.gateway.handle_message(restarted, 1))
+        self.gateway.check_liveness(100)
+        self.assertFalse(self.gateway.nodes["n1"]["alive"])
+
+    def test_invalid_dropped(self):
+        uplink = NodeUplink({"distributed": {"node_id": "n1"}})
+        for msg in [["loc", "a"], {**uplink.wrap({"id": "loc", "barcode": "a"}), "seq": "1"},
+                    uplink.wrap({"barcode": "a"}), uplink.wrap({"id": "loc", "barcode": ["a"]}),
+                    {"node": "n1", "session": "s", "heartbeat": True, "seq": None}]:
+            self.assertIsNone(self.gateway.handle_message(msg, 0), msg)
+        self.assertEqual(5, self.gateway.invalid)
+        self.assertEqual(5, sum(event == "invalid" for _, event, _ in self.gateway.flight_recorder.events))
+        alert = uplink.wrap({"id": "loc", "alert": "quarantined", "timestamp": "now"})
+        self.assertEqual(alert, self.gateway.handle_message(alert, 0))
+
+
+class TestMultiNode(unittest.TestCase):
+    def test_several_nodes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gateway_address = f"ipc://{os.path.join(tmp_dir, 'gateway')}"
+            shard_addresses = [f"ipc://{os.path.join(tmp_dir, f'shard_{i}')}" for i in range(2)]
+
+            gateway = NodeGateway({}, {
+                "in": {"type": zmq.PULL, "address": gateway_address, "bind": True},
+                "out": [{"type": zmq.PUSH, "address": address, "bind": False} for address in shard_addresses],
+            })
+            gateway.start()
+            nodes = [multiprocessing.Process(target=run_node, args=(f"node_{i}", gateway_address, 10))
+                     for i in range(3)]
+            for node in nodes:
+                node.start()
+
+            context = zmq.Context()
+            shards = []
+            for address in shard_addresses:
+                socket = context.socket(zmq.PULL)
+                socket.bind(address)
+                shards.append(socket)
+
+            received = []
+            deadline = time.monotonic() + 10
+            while len(received) < 30 and time.monotonic() < deadline:
+                for socket in shards:
+                    while socket.poll(10):
+                        received.append(socket.recv_json())
+
+            for node in nodes:
+                node.join()
+            gateway.terminate()
+            gateway.join()
+            for socket in shards:
+                socket.close(linger=0)
+            context.term()
+
+        self.assertEqual(30, len(received))
+        self.assertEqual(30, len({(msg["node"], msg["barcode"]) for msg in received}))
+        for node_id in ["node_0", "node_1", "node_2"]:
+            seqs = [msg["seq"] for msg in received if msg["node"] == node_id]
+            self.assertEqual(list(range(1, 11)), seqs)  # per node ordering is kept
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,67 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile
+import os
+import time
+
+from utilities.profiler import SamplingProfiler
+
+
+def busy_loop(seconds):
+    end = time.monotonic() + seconds
+    total = 0
+    while time.monotonic() < end:
+        total += sum(range(100))
+    return total
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.profiler = SamplingProfiler("test", {"diagnostics": {"profiler": {
+            "directory": self.tmp_dir.name, "interval": 0.001, "max_duration": 0.3}}})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_profile(self):
+        prefix = self.profiler.start(duration=10, trace_memory=True)  # capped at max_duration
+        self.assertIsNone(self.profiler.start())  # one at a time
+        busy_loop(0.4)
+        self.profiler.thread.join()
+
+        with open(f"{prefix}.collapsed") as f:
+            stacks = f.read().splitlines()
+        busy = [line for line in stacks if "busy_loop (test_profiler.py" in line]
+        self.assertTrue(busy)
+        self.assertTrue(busy[0].startswith("MainThread;"))
+        with open(f"{prefix}.txt") as f:
+            self.assertIn("busy_loop", f.read())
+        self.assertTrue(os.path.exists(f"{prefix}.tracemalloc.txt"))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,117 @@
+import unittest
+from utilities.ttl_cache import TTLCache
+from utilities.scan_filters import ScanDeduplicator, DeviceRateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TTLCache(max_size=2, ttl=5, clock=self.clock)
+
+    def test_expiry(self):
+        self.cache.put("a", 1)
+        self.clock.now = 4
+        self.assertEqual(1, self.cache.get("a"))
+        self.clock.now = 5
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(0, len(self.cache))
+
+    def test_lru_eviction(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.get("a")
+        self.cache.put("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertEqual(3, self.cache.get("c"))
+
+
+class TestScanDeduplicator(unittest.TestCase):
+    def setUp(self):
+        config = {
+            "input": {"dedup": {"window": 2, "locations": {"dock": 10}, "variables": {"mode": 0}}},
+            "variable": {
+                "id": {"name": "id", "type": "single", "pattern": "job_(.*)"},
+                "mode": {"name": "mode", "type": "retain", "pattern": "dir_(.*)"},
+            },
+        }
+        self.clock = FakeClock()
+        self.deduplicator = ScanDeduplicator(config, self.clock)
+
+    def is_duplicate(self, location_id, barcode):
+        return self.deduplicator.is_duplicate(location_id, barcode)
+
+    def test_window(self):
+        self.assertFalse(self.is_duplicate("cutting", "job_1"))
+        self.assertTrue(self.is_duplicate("cutting", "job_1"))
+        self.assertFalse(self.is_duplicate("painting", "job_1"))
+        self.clock.now = 1.5
+        self.assertTrue(self.is_duplicate("cutting", "job_1"))  # restarts window
+        self.clock.now = 3
+        self.assertTrue(self.is_duplicate("cutting", "job_1"))
+        self.clock.now = 6
+        self.assertFalse(self.is_duplicate("cutting", "job_1"))
+
+    def test_overrides(self):
+        self.assertFalse(self.is_duplicate("cutting", "dir_send"))
+        self.assertFalse(self.is_duplicate("cutting", "dir_send"))
+        self.assertFalse(self.is_duplicate("dock", "job_1"))
+        self.clock.now = 5
+        self.assertTrue(self.is_duplicate("dock", "job_1"))
+
+    def test_stats(self):
+        self.is_duplicate("cutting", "job_1")
+        self.is_duplicate("cutting", "job_1")
+        self.assertEqual({"cutting": {"passed": 1, "suppressed": 1}}, self.deduplicator.stats())
+
+
+class TestDeviceRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        config = {"input": {"rate_limit": {
+            "rate": 2, "burst": 3, "quarantine": {"threshold": 5, "window": 10, "duration": 60}}}}
+        self.limiter = DeviceRateLimiter(config, self.clock)
+
+    def test_token_bucket(self):
+        self.assertEqual([True, True, True, False], [self.limiter.allow("dock") for _ in range(4)])
+        self.assertTrue(self.limiter.allow("cutting"))  # other devices unaffected
+        self.clock.now = 1
+        self.assertEqual([True, True, False], [self.limiter.allow("dock") for _ in range(3)])
+        self.assertEqual([], self.limiter.pop_alerts())
+
+    def test_quarantine_and_release(self):
+        for second in range(10):  # 10 scans a second, well over the limit
+            self.clock.now = second
+            for _ in range(10):
+                self.limiter.allow("dock")
+            if "dock" in self.limiter.quarantined:
+                break
+        self.assertEqual(0, second)
+        alerts = self.limiter.pop_alerts()
+        self.assertEqual(["quarantined"], [alert["alert"] for alert in alerts])
+        self.assertEqual(5, alerts[0]["detail"]["refused_scans"])
+
+        self.clock.now = 30
+        self.assertFalse(self.limiter.allow("dock"))  # everything dropped while quarantined
+        self.limiter.release_due()
+        self.assertEqual([], self.limiter.pop_alerts())
+        self.clock.now = 60
+        self.limiter.release_due()
+        self.assertEqual([{"dropped_scans": 3}], [alert["detail"] for alert in self.limiter.pop_alerts()])
+        self.assertTrue(self.limiter.allow("dock"))
+
+    def test_disabled(self):
+        limiter = DeviceRateLimiter({}, self.clock)
+        self.assertTrue(all(limiter.allow("dock") for _ in range(100)))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
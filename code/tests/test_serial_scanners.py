@@ -0,0 +1,72 @@
+import asyncio
+import errno
+import os
+import termios
+import unittest
+from serial_scanners import SerialScanner, serial_scan_generator
+
+
+class TestSerialScanner(unittest.TestCase):
+    def setUp(self):
+        # the pty slave stands in for the scanner's tty, writing to the master "scans"
+        self.master, slave = os.openpty()
+        self.tty = os.ttyname(slave)
+        os.close(slave)
+
+    def tearDown(self):
+        if self.master is not None:
+            os.close(self.master)
+
+    def test_whole_barcodes(self):
+        scanner = SerialScanner(self.tty, {"baud": 115200})
+
+        async def scenario():
+            generator = serial_scan_generator(scanner, "dock")
+            os.write(self.master, b"A1\rB2")
+            scans = [await generator.__anext__()]
+            os.write(self.master, b"\r\n\x1d01\r")
+            scans.append(await generator.__anext__())
+            scans.append(await generator.__anext__())
+            return scans
+
+        try:
+            scans = asyncio.run(asyncio.wait_for(scenario(), 5))
+        finally:
+            scanner.close()
+        self.assertEqual(["A1", "B2", "\x1d01"], [barcode for barcode, _timestamp in scans])
+
+    def test_raw_mode(self):
+        # (a pty keeps the speed and line settings but not parity or stop bits)
+        scanner = SerialScanner(self.tty, {"baud": 19200, "parity": "even", "stopbits": 2})
+        try:
+            iflag, _oflag, _cflag, lflag, ispeed, _ospeed, _cc = termios.tcgetattr(scanner.fd)
+        finally:
+            scanner.close()
+        self.assertEqual(termios.B19200, ispeed)
+        self.assertFalse(lflag & termios.ICANON)
+        self.assertFalse(lflag & termios.ECHO)
+        self.assertFalse(iflag & termios.ICRNL)
+
+    def test_unsupported_baud(self):
+        with self.assertRaises(ValueError):
+            SerialScanner(self.tty, {"baud": 12345})
+
+    def test_disconnect(self):
+        scanner = SerialScanner(self.tty)
+
+        async def scenario():
+            generator = serial_scan_generator(scanner, "dock")
+            os.close(self.master)  # hang up
+            self.master = None
+            await generator.__anext__()
+
+        try:
+            with self.assertRaises(OSError) as raised:
+                asyncio.run(asyncio.wait_for(scenario(), 5))
+        finally:
+            scanner.close()
+        self.assertEqual(errno.ENODEV, raised.exception.errno)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
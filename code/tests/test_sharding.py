@@ -0,0 +1,51 @@
+import unittest
+from utilities.sharding import shard_for, partition
+
+
+class TestShardFor(unittest.TestCase):
+    def setUp(self):
+        self.locations = [f"loc_{i}" for i in range(400)]
+
+    def test_single_shard(self):
+        self.assertEqual(0, shard_for("loc_1", 1))
+
+    def test_spread(self):
+        counts = [0] * 4
+        for location in self.locations:
+            counts[shard_for(location, 4)] += 1
+        for count in counts:
+            self.assertGreater(count, 50)
+
+    def test_minimal_movement(self):
+        # adding a shard only moves locations onto the new shard
+        for location in self.locations:
+            before = shard_for(location, 4)
+            after = shard_for(location, 5)
+            self.assertIn(after, [before, 4])
+
+
+class TestPartition(unittest.TestCase):
+    def test_disjoint_and_complete(self):
+        scanner_map = {f"loc_{i}": f"usb-0:1.{i}" for i in range(50)}
+        parts = [partition(scanner_map, part, 3) for part in range(3)]
+        self.assertEqual(50, sum(len(part) for part in parts))
+        merged = {}
+        for part in parts:
+            merged.update(part)
+        self.assertEqual(scanner_map, merged)
+
+    def test_down_part_shared_out(self):
+        scanner_map = {f"loc_{i}": f"usb-0:1.{i}" for i in range(50)}
+        before = [partition(scanner_map, part, 3) for part in range(3)]
+        after = [partition(scanner_map, part, 3, down=[1]) for part in range(3)]
+        self.assertEqual({}, after[1])
+        self.assertEqual(scanner_map, {**after[0], **after[2]})
+        for part in [0, 2]:  # only the down part's scanners move
+            self.assertEqual(before[part], {key: after[part][key] for key in before[part]})
+
+    def test_single_part(self):
+        self.assertEqual({"dock": "usb-0:1.1"}, partition({"dock": "usb-0:1.1"}, 0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
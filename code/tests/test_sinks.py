@@ -0,0 +1,119 @@
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import zmq
+from utilities.sinks import Sink, FileSink, ZMQPubSink
+
+
+class RecordingSink(Sink):
+    def __init__(self, sink_conf, release=None):
+        super().__init__("recording", sink_conf)
+        self.batches_written = []
+        self.release = release
+
+    def write_batch(self, batch):
+        if self.release is not None:
+            self.release.wait(5)
+        self.batches_written.append([topic for topic, _payload, _meta in batch])
+
+
+class TestSink(unittest.TestCase):
+    def test_batches_in_order(self):
+        release = threading.Event()
+        sink = RecordingSink({"batch_size": 3}, release)
+        sink.start()
+        for i in range(7):
+            sink.put(f"t{i}", b"{}", {})
+        release.set()
+        sink.stop()
+        written = [topic for batch in sink.batches_written for topic in batch]
+        self.assertEqual([f"t{i}" for i in range(7)], written)
+        self.assertTrue(all(len(batch) <= 3 for batch in sink.batches_written))
+
+    def test_drop_oldest(self):
+        sink = RecordingSink({"policy": "drop_oldest", "queue_size": 2})  # not started - nothing is taken
+        for i in range(4):
+            sink.put(f"t{i}", b"{}", {})
+        self.assertEqual(["t2", "t3"], [topic for topic, _payload, _meta in sink.queue])
+        self.assertEqual(2, sink.dropped)
+
+    def test_block_waits_for_space(self):
+        release = threading.Event()
+        sink = RecordingSink({"queue_size": 1, "batch_size": 1}, release)
+        sink.start()
+        for i in range(2):
+            sink.put(f"t{i}", b"{}", {})  # t0 is taken by the blocked write, t1 fills the queue
+        time.sleep(0.1)
+        putter = threading.Thread(target=sink.put, args=("t2", b"{}", {}))
+        putter.start()
+        time.sleep(0.1)
+        self.assertTrue(putter.is_alive())
+        release.set()
+        putter.join(5)
+        sink.stop()
+        self.assertEqual(["t0", "t1", "t2"], [topic for batch in sink.batches_written for topic in batch])
+
+
+class TestFileSink(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_jsonl(self):
+        sink = FileSink("audit", {"directory": self.tmp_dir.name})
+        sink.open()
+        sink.write_batch([("loc_1/job", b'{"job_id": "1"}', {}), ("loc_1/job", b'{"job_id": "2"}', {})])
+        sink.close()
+        (path,) = glob.glob(os.path.join(self.tmp_dir.name, "audit_*_0.jsonl"))
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([{"topic": "loc_1/job", "payload": {"job_id": "1"}},
+                          {"topic": "loc_1/job", "payload": {"job_id": "2"}}], lines)
+
+    def test_jsonl_binary_payload(self):
+        sink = FileSink("audit", {"directory": self.tmp_dir.name})
+        sink.open()
+        sink.write_batch([("loc_1/job", b"\xa1\x00", {"content_type": "application/cbor"})])
+        sink.close()
+        (path,) = glob.glob(os.path.join(self.tmp_dir.name, "audit_*.jsonl"))
+        with open(path) as f:
+            line = json.loads(f.readline())
+        self.assertEqual({"topic": "loc_1/job", "content_type": "application/cbor", "payload_base64": "oQA="}, line)
+
+    def test_rotation(self):
+        sink = FileSink("audit", {"directory": self.tmp_dir.name, "format": "binary", "max_size": 0.0002})
+        sink.open()
+        for i in range(3):
+            sink.write_batch([("topic", b"x" * 60, {})])
+        sink.close()
+        files = sorted(glob.glob(os.path.join(self.tmp_dir.name, "audit_*.bin")))
+        self.assertEqual(2, len(files))  # 2 records fit in the first file
+        self.assertEqual(2 * (6 + 5 + 60), os.path.getsize(files[0]))
+
+
+class TestZMQPubSink(unittest.TestCase):
+    def test_publish(self):
+        context = zmq.Context()
+        sink = ZMQPubSink("local", {"address": "tcp://127.0.0.1:4399"}, context)
+        sink.start()
+        subscriber = context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b"loc_1/")
+        subscriber.connect("tcp://127.0.0.1:4399")
+        time.sleep(0.2)  # let the subscription through
+        sink.put("loc_2/job", b"ignored", {})
+        sink.put("loc_1/job", b'{"job_id": "1"}', {})
+        self.assertTrue(subscriber.poll(5000))
+        self.assertEqual([b"loc_1/job", b'{"job_id": "1"}'], subscriber.recv_multipart())
+        sink.stop()
+        subscriber.close(linger=0)
+        context.term()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,111 @@
+import asyncio
+import socket
+import unittest
+from tcp_readers import TCPReaderSource
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def collect(source, count, timeout=5):
+    scans = []
+    done = asyncio.Event()
+
+    async def dispatch(payload):
+        scans.append(payload)
+        if len(scans) >= count:
+            done.set()
+
+    task = asyncio.create_task(source.run(dispatch))
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    return scans
+
+
+class TestClientReaders(unittest.TestCase):
+    def test_reads_and_reconnects(self):
+        async def scenario():
+            connections = []
+
+            async def reader_stand_in(reader, writer):
+                # first connection sends two barcodes in one write then drops, the second sends one
+                connections.append(writer)
+                writer.write(b"A1\r\nB2\r\n" if len(connections) == 1 else b"C3\r\n")
+                await writer.drain()
+                writer.close()
+
+            server = await asyncio.start_server(reader_stand_in, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            source = TCPReaderSource({"input": {"tcp": {
+                "delimiter": "\r\n",
+                "backoff": {"initial": 0.01},
+                "readers": {"conveyor_1": {"address": f"127.0.0.1:{port}"}},
+            }}})
+            async with server:
+                scans = await collect(source, 3)
+            return source, scans
+
+        source, scans = asyncio.run(scenario())
+        self.assertEqual(["A1", "B2", "C3"], [scan["barcode"] for scan in scans])
+        self.assertEqual({"conveyor_1"}, {scan["id"] for scan in scans})
+        self.assertIn("timestamp", scans[0])
+        self.assertGreaterEqual(source.reconnects, 1)
+
+    def test_partitioned(self):
+        readers = {f"line_{i}": {"address": f"10.0.0.{i}:2001"} for i in range(10)}
+        sources = [TCPReaderSource({"input": {"tcp": {"readers": readers}}}, worker, 3) for worker in range(3)]
+        self.assertEqual(10, sum(len(source.readers) for source in sources))
+
+
+class TestServerReaders(unittest.TestCase):
+    def test_peer_mapping(self):
+        port = free_port()
+
+        async def scenario():
+            source = TCPReaderSource({"input": {"tcp": {
+                "framing": "stx_etx",
+                "server": {"listen": f"127.0.0.1:{port}", "peers": {"127.0.0.1": "dock"}},
+            }}})
+
+            async def reader_stand_in():
+                await asyncio.sleep(0.1)  # let the source start listening
+                _reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b"\x02A1\x03\x02B")
+                await writer.drain()
+                writer.write(b"2\x03")
+                await writer.drain()
+
+            asyncio.create_task(reader_stand_in())
+            return await collect(source, 2)
+
+        scans = asyncio.run(scenario())
+        self.assertEqual([("dock", "A1"), ("dock", "B2")], [(scan["id"], scan["barcode"]) for scan in scans])
+
+    def test_unknown_peer(self):
+        port = free_port()
+
+        async def scenario():
+            source = TCPReaderSource({"input": {"tcp": {
+                "server": {"listen": f"127.0.0.1:{port}", "peers": {"10.0.0.1": "dock"}},
+            }}})
+            task = asyncio.create_task(source.run(None))
+            await asyncio.sleep(0.1)
+            reader, _writer = await asyncio.open_connection("127.0.0.1", port)
+            closed = await asyncio.wait_for(reader.read(), 5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return source, closed
+
+        source, closed = asyncio.run(scenario())
+        self.assertEqual(b"", closed)
+        self.assertEqual(1, source.refused)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,41 @@
+import unittest
+from utilities.topic_aliases import TopicAliases
+
+
+class TestTopicAliases(unittest.TestCase):
+    def test_busy_topics(self):
+        aliases = TopicAliases(2)
+        self.assertEqual(("a", None), aliases.alias_for("a"))  # first use - no alias
+        self.assertEqual(("a", 1), aliases.alias_for("a"))  # second - sets up the alias
+        self.assertEqual(("", 1), aliases.alias_for("a"))
+        self.assertEqual(("once", None), aliases.alias_for("once"))
+        self.assertEqual(("", 1), aliases.alias_for("a"))
+
+    def test_least_recently_used_reassigned(self):
+        aliases = TopicAliases(2)
+        for topic in ["a", "a", "b", "b", "a", "c"]:
+            aliases.alias_for(topic)
+        self.assertEqual(("c", 2), aliases.alias_for("c"))  # b was least recently used
+        self.assertEqual(("b", None), aliases.alias_for("b"))
+
+    def test_disabled_and_reset(self):
+        aliases = TopicAliases(0)
+        self.assertEqual([("a", None)] * 3, [aliases.alias_for("a") for _ in range(3)])
+        aliases.reset(5)
+        aliases.alias_for("a")
+        self.assertEqual(("a", 1), aliases.alias_for("a"))
+        aliases.reset(5)
+        self.assertEqual(("a", None), aliases.alias_for("a"))
+
+    def test_forget(self):
+        aliases = TopicAliases(2)
+        for topic in ["a", "a", "b", "b"]:
+            aliases.alias_for(topic)
+        aliases.forget("a")
+        aliases.alias_for("c")
+        self.assertEqual(("c", 1), aliases.alias_for("c"))  # reuses a's alias, not b's
+        self.assertEqual(("", 2), aliases.alias_for("b"))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
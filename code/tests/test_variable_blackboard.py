@@ -22,9 +22,19 @@
 #   If not, see <https://www.gnu.org/licenses/>.
 
 import unittest
+import collections
 import tomli
 import datetime
+import copy
+import os
+import tempfile
+import json
+import time
+import zmq
 from variable_blackboard import Blackboard
+from utilities.watchdog import RECYCLE_EXIT_CODE
+import utilities.config_manager as config_manager
+from utilities import wire
 
 
 def get_config(file):
@@ -129,5 +139,542 @@ class TestInternalSteps(unittest.TestCase):
         self.assertEqual(self.blackboard.singles_to_clear, {'id', 'timestamp'})
 
 
+class TestConfigReload(unittest.TestCase):
+    def setUp(self):
+        self.config = get_config("testing_config")
+        self.blackboard = Blackboard(copy.deepcopy(self.config), {})
+        board = self.blackboard.blackboard("loc_1")
+        board['type'] = "apple"
+        board['id'] = "1234"
+        board['mode'] = "I"
+        self.blackboard.trigger_tracking['mode_change_event'].add('mode')
+
+    def test_state_preserved(self):
+        new_config = copy.deepcopy(self.config)
+        new_config['variable']['batch'] = {'name': 'batch', 'type': 'retain', 'pattern': 'b_(.*)', 'initial': 'none'}
+        self.blackboard.apply_config(new_config)
+        self.assertEqual({'id': '1234', 'type': 'apple', 'raw_mode': 'receive', 'location': 'Cutting',
+                          'mode': 'I', 'batch': 'none'},
+                         self.blackboard.blackboard("loc_1"))
+        self.assertEqual({'mode'}, self.blackboard.trigger_tracking['mode_change_event'])
+        self.assertEqual(('batch', '12'), self.blackboard.extract_variable("b_12"))
+
+    def test_removed_and_static(self):
+        new_config = copy.deepcopy(self.config)
+        del new_config['variable']['type']
+        new_config['variable']['location']['value'] = "Painting"
+        new_config['output'][1]['triggers'] = ["id"]
+        self.blackboard.apply_config(new_config)
+        self.assertEqual({'id': '1234', 'raw_mode': 'receive', 'location': 'Painting', 'mode': 'I'},
+                         self.blackboard.blackboard("loc_1"))
+        self.assertEqual(set(), self.blackboard.trigger_tracking['mode_change_event'])
+
+    def test_invalid_config_refused(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            user_file = os.path.join(tmp_dir, "config.toml")
+            module_file = os.path.join(tmp_dir, "module_config.toml")
+            with open(module_file, "w") as f:
+                f.write('[service_layer.mqtt]\nbroker="localhost"\nport=1883\n')
+            with open(user_file, "w") as f:
+                f.write('[variable.id]\nname="id"\ntype="single"\n')
+
+            with self.assertNoLogs("config", "INFO"):  # the starting point is recorded, not reloaded
+                watcher = config_manager.ConfigWatcher(module_file, user_file)
+            self.assertEqual([user_file, module_file], watcher.files)
+            self.assertIsNone(watcher.check())  # unchanged
+
+            with open(user_file, "w") as f:
+                f.write('[variable.id]\nname="id"\ntype="sometimes"\n')
+            os.utime(user_file, ns=(1, 1))
+            self.assertIsNone(watcher.check())  # invalid
+
+            with open(user_file, "w") as f:
+                f.write('[variable.id]\nname="id"\ntype="retain"\n')
+            os.utime(user_file, ns=(2, 2))
+            self.assertEqual("retain", watcher.check()['variable']['id']['type'])
+
+
+class ConnectedBlackboardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        in_address = f"ipc://{os.path.join(self.tmp_dir.name, 'in')}"
+        out_address = f"ipc://{os.path.join(self.tmp_dir.name, 'out')}"
+        api_address = f"ipc://{os.path.join(self.tmp_dir.name, 'api')}"
+        self.blackboard = Blackboard(self.get_test_config(), {
+            "in": {"type": zmq.PULL, "address": in_address, "bind": True},
+            "out": {"type": zmq.PUSH, "address": out_address, "bind": False, "name": "output"},
+            "api": {"type": zmq.REP, "address": api_address, "bind": True},
+        })
+        self.blackboard.do_connect()
+        self.context = zmq.Context()
+        self.scanner = self.context.socket(zmq.PUSH)
+        self.scanner.connect(in_address)
+        self.wrapper = self.context.socket(zmq.PULL)
+        self.wrapper.bind(out_address)
+        self.client = self.context.socket(zmq.REQ)
+        self.client.connect(api_address)
+
+    def tearDown(self):
+        for socket in [self.scanner, self.wrapper, self.client,
+                       self.blackboard.zmq_in, self.blackboard.zmq_out, self.blackboard.zmq_api]:
+            socket.close(linger=0)
+        self.context.term()
+        self.tmp_dir.cleanup()
+
+
+class TestBatchProcessing(ConnectedBlackboardTestCase):
+    def get_test_config(self):
+        config = get_config("testing_config")
+        config['blackboard'] = {'batch': {'max_messages': 3}}
+        return config
+
+    def test_drain_and_dispatch(self):
+        for i in range(5):
+            self.scanner.send_json({"id": "loc_1", "barcode": f"job_{i}", "timestamp": "now"})
+        time.sleep(0.1)
+
+        messages = self.blackboard.get_input_messages()
+        self.assertEqual(["job_0", "job_1", "job_2"], [msg["barcode"] for msg in messages])
+
+        outputs = []
+        for msg in messages:
+            outputs.extend(self.blackboard.process_message(msg))
+        self.blackboard.dispatch(outputs)
+
+        frames = self.wrapper.recv_multipart()
+        self.assertEqual(9, len(frames))  # topic, meta and payload per output
+        self.assertEqual(["0", "1", "2"], [json.loads(payload)["job_id"] for _topic, payload, _meta in wire.unpack(frames)])
+        self.assertEqual(2, len(self.blackboard.get_input_messages()))
+
+
+class TestRecycle(ConnectedBlackboardTestCase):
+    def get_test_config(self):
+        config = get_config("testing_config")
+        config['output'].append({
+            'name': 'job_stats', 'type': 'aggregate', 'topic': '{{location}}/stats', 'triggers': ['id'],
+            'window': {'type': 'tumbling', 'length': 3600}, 'aggregate': {'jobs': {'function': 'count'}}})
+        return config
+
+    def test_queued_messages_and_windows_kept(self):
+        self.blackboard.process_message({"id": "loc_1", "barcode": "job_1", "timestamp": "now"})
+        for i in range(2, 4):  # still queued when the shard recycles
+            self.scanner.send_json({"id": "loc_1", "barcode": f"job_{i}", "timestamp": "now"})
+        time.sleep(0.1)
+        self.blackboard.state_file = os.path.join(self.tmp_dir.name, "state", "blackboard_0.json")
+        with self.assertRaises(SystemExit) as raised:
+            self.blackboard.recycle()
+        self.assertEqual(RECYCLE_EXIT_CODE, raised.exception.code)
+
+        frames = self.wrapper.recv_multipart()
+        self.assertEqual(["2", "3"], [json.loads(payload)["job_id"] for _topic, payload, _meta in wire.unpack(frames)])
+        restarted = Blackboard(self.get_test_config(), {})
+        restarted.state_file = self.blackboard.state_file
+        restarted.load_state()
+        window = restarted.windowed_outputs['job_stats']
+        self.assertEqual(3, window.aggregate(window.windows["loc_1"], window.slot_id(time.time()))["jobs"])
+
+
+class TestDrain(unittest.TestCase):
+    def test_returns_once_outputs_sent(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_address = f"ipc://{os.path.join(tmp_dir, 'in')}"
+            out_address = f"ipc://{os.path.join(tmp_dir, 'out')}"
+            blackboard = Blackboard(get_config("testing_config"), {
+                "in": {"type": zmq.PULL, "address": in_address, "bind": True},
+                "out": {"type": zmq.PUSH, "address": out_address, "bind": False, "name": "output"},
+            })
+            blackboard.state_file = os.path.join(tmp_dir, "state.json")
+            context = zmq.Context()
+            scanner = context.socket(zmq.PUSH)
+            scanner.connect(in_address)
+            wrapper = context.socket(zmq.PULL)
+            wrapper.bind(out_address)
+            for i in range(3):  # queued until the blackboard binds
+                scanner.send_json({"id": "loc_1", "barcode": f"job_{i}", "timestamp": "now"})
+            blackboard.drain_requested.set()
+            blackboard.run()  # returns rather than running forever
+
+            received = []
+            while wrapper.poll(100):
+                received.extend(json.loads(payload)["job_id"] for _topic, payload, _meta in
+                                wire.unpack(wrapper.recv_multipart()))
+            for socket in [scanner, wrapper, blackboard.zmq_in, blackboard.zmq_out]:
+                socket.close(linger=0)
+            context.term()
+        self.assertEqual(["0", "1", "2"], received)
+
+
+class TestAsyncHooks(ConnectedBlackboardTestCase):
+    def get_test_config(self):
+        config = get_config("testing_config")
+        config['variable']['lookup'] = {'name': 'lookup', 'type': 'single', 'pattern': 'look_(.*)'}
+        config['processing']['process']['slow'] = {
+            'apply_to': 'lookup', 'module': 'slow_lookup', 'output_as': ['looked_up'], 'extra_args': [0.2],
+            'execution': 'thread', 'timeout': 1, 'fallback': ['unknown']}
+        config['output'].append({'name': 'lookup_event', 'topic': '{{location_id}}/lookup',
+                                 'triggers': ['looked_up'], 'payload': {'result': 'looked_up'}})
+        return config
+
+    def wait_for_hooks(self, outputs):
+        deadline = time.monotonic() + 5
+        while self.blackboard.jobs_in_pool and time.monotonic() < deadline:
+            self.blackboard.poller.poll(100)
+            self.blackboard.collect_completed_hooks(outputs)
+
+    def test_location_order_kept(self):
+        outputs = []
+        self.blackboard.handle_message({"id": "loc_1", "barcode": "look_a", "timestamp": "now"}, outputs)
+        self.blackboard.handle_message({"id": "loc_1", "barcode": "job_1", "timestamp": "now"}, outputs)
+        self.blackboard.handle_message({"id": "loc_2", "barcode": "job_2", "timestamp": "now"}, outputs)
+        # loc_2 isn't held up by the hook running for loc_1
+        self.assertEqual([{'topic': 'Cutting/feeds/jobs', 'payload': {
+            'job_id': '2', 'job_type': 'banana', 'location': 'Cutting', 'timestamp': 'now'}}], outputs)
+
+        self.wait_for_hooks(outputs)
+        # then the held back loc_1 messages in order
+        self.assertEqual(['Cutting/feeds/jobs', 'loc_1/lookup', 'Cutting/feeds/jobs'],
+                         [output['topic'] for output in outputs])
+        self.assertEqual('1', outputs[2]['payload']['job_id'])
+        self.assertEqual({'result': 'A'}, outputs[1]['payload'])
+
+    def test_timeout_fallback(self):
+        self.blackboard.processes['slow']['extra_args'] = [2]
+        self.blackboard.processes['slow']['timeout'] = 0.2
+        outputs = []
+        self.blackboard.handle_message({"id": "loc_1", "barcode": "look_a", "timestamp": "now"}, outputs)
+        self.wait_for_hooks(outputs)
+        self.assertEqual([{'topic': 'loc_1/lookup', 'payload': {'result': 'unknown'}}], outputs)
+
+    def test_reload_while_running(self):
+        outputs = []
+        self.blackboard.handle_message({"id": "loc_1", "barcode": "look_a", "timestamp": "now"}, outputs)
+        new_config = self.get_test_config()
+        new_config['variable']['location']['value'] = "Painting"
+        new_config['output'][-1]['payload']['where'] = 'location'
+        self.blackboard.apply_config(new_config)
+        self.wait_for_hooks(outputs)
+        # formed from the reloaded board rather than the one the hook started with
+        self.assertEqual([{'topic': 'loc_1/lookup', 'payload': {'result': 'A', 'where': 'Painting'}}], outputs)
+
+    def test_stuck_pool_replaced(self):
+        self.blackboard.hook_conf = {'threads': 1}
+        self.blackboard.processes['slow']['extra_args'] = [1]
+        self.blackboard.processes['slow']['timeout'] = 0.2
+        outputs = []
+        self.blackboard.handle_message({"id": "loc_1", "barcode": "look_a", "timestamp": "now"}, outputs)
+        self.wait_for_hooks(outputs)
+        self.assertEqual(1, self.blackboard.structure_sizes()['hung_hooks'])
+        self.assertIsNone(self.blackboard.thread_pool)  # its only worker is stuck
+
+        # a new pool runs the next hook rather than queueing it behind the stuck one
+        self.blackboard.processes['slow']['extra_args'] = [0.01]
+        self.blackboard.handle_message({"id": "loc_2", "barcode": "look_b", "timestamp": "now"}, outputs)
+        self.wait_for_hooks(outputs)
+        self.assertEqual({'result': 'B'}, outputs[-1]['payload'])
+
+
+class TestHookCache(unittest.TestCase):
+    def setUp(self):
+        from functions import count_calls
+        self.calls = count_calls.calls
+        self.calls.clear()
+        self.config = get_config("testing_config")
+        self.config['variable']['part'] = {'name': 'part', 'type': 'retain', 'pattern': 'part_(.*)', 'initial': ''}
+        self.config['processing']['process']['count'] = {
+            'apply_to': 'part', 'module': 'count_calls', 'output_as': ['part_info'], 'cache': {'size': 2, 'ttl': 60}}
+        self.blackboard = Blackboard(copy.deepcopy(self.config), {})
+        self.now = 0
+        self.blackboard.hook_caches['count']['cache'].clock = lambda: self.now
+
+    def test_hits_and_misses(self):
+        for part in ["a", "b", "a", "a", "c", "b"]:
+            self.blackboard.process_message({"id": "loc_1", "barcode": f"part_{part}", "timestamp": "now"})
+        self.assertEqual("b_4", self.blackboard.blackboard("loc_1")["part_info"])
+        self.assertEqual(["a", "b", "c", "b"], self.calls)  # size 2 - b was evicted by c
+        entry = self.blackboard.hook_caches['count']
+        self.assertEqual((2, 4), (entry['hits'], entry['misses']))
+
+    def test_ttl_and_reload(self):
+        self.blackboard.process_hooks("part", "a")
+        self.now = 61
+        self.assertEqual({"part_info": "a_2"}, self.blackboard.process_hooks("part", "a"))
+        # unchanged process keeps its cache over a reload, a changed one starts again
+        self.blackboard.apply_config(copy.deepcopy(self.config))
+        self.assertEqual({"part_info": "a_2"}, self.blackboard.process_hooks("part", "a"))
+        self.config['processing']['process']['count']['extra_args'] = [1]
+        self.blackboard.apply_config(copy.deepcopy(self.config))
+        self.assertEqual({"part_info": "a_3"}, self.blackboard.process_hooks("part", "a"))
+
+    def test_unhashable_values(self):
+        value = {"lot": "x", "serials": [1, 2]}
+        self.assertEqual({"part_info": f"{value}_1"}, self.blackboard.process_hooks("part", value))
+        self.assertEqual({"part_info": f"{value}_1"}, self.blackboard.process_hooks("part", dict(value)))
+        self.assertEqual({"part_info": "1_2"}, self.blackboard.process_hooks("part", 1))
+        self.assertEqual({"part_info": "1_3"}, self.blackboard.process_hooks("part", "1"))
+
+
+class TestProcessGraph(unittest.TestCase):
+    def setUp(self):
+        from functions import count_calls
+        self.calls = count_calls.calls
+        self.calls.clear()
+        self.config = get_config("testing_config")
+        # listed before the process producing its input
+        self.config['processing']['process'] = {
+            'describe': {'apply_to': 'mode', 'module': 'count_calls', 'output_as': ['mode_info']},
+            **self.config['processing']['process'],
+        }
+        self.config['output'].append({'name': 'mode_info_event', 'topic': 'info',
+                                      'triggers': ['mode_info'], 'payload': {'info': 'mode_info'}})
+        self.blackboard = Blackboard(copy.deepcopy(self.config), {})
+
+    def scan(self, barcode):
+        outputs = self.blackboard.process_message({"id": "loc_1", "barcode": barcode, "timestamp": "now"})
+        return [output['topic'] for output in outputs]
+
+    def test_chain(self):
+        self.assertEqual(['enum_mode', 'describe'], self.blackboard.downstream_processes['raw_mode'])
+        self.assertEqual(['info'], self.scan("dir_receive"))
+        self.assertEqual("I_1", self.blackboard.blackboard("loc_1")["mode_info"])
+        # mode unchanged - describe isn't rerun and nothing is triggered
+        self.assertEqual([], self.scan("dir_receive"))
+        self.assertEqual(['Cutting/feeds/jobs', 'Cutting/control/mode_change'], self.scan("job_1"))
+        self.assertEqual(['info'], self.scan("dir_send"))
+        self.assertEqual(["I", "O"], self.calls)
+
+    def test_cycle_refused(self):
+        new_config = copy.deepcopy(self.config)
+        new_config['processing']['process']['loop'] = {
+            'apply_to': 'mode_info', 'module': 'count_calls', 'output_as': ['raw_mode']}
+        with self.assertRaises(ValueError):
+            self.blackboard.apply_config(new_config)
+        self.assertNotIn('loop', self.blackboard.processes)
+
+
+class TestOutputSinks(unittest.TestCase):
+    def test_sinks_in_meta(self):
+        config = get_config("testing_config")
+        config['output'][0]['sinks'] = ['file', 'mqtt']
+        blackboard = Blackboard(config, {})
+        blackboard.process_message({"id": "loc_1", "barcode": "dir_receive", "timestamp": "now"})
+        outputs = blackboard.process_message({"id": "loc_1", "barcode": "job_1", "timestamp": "now"})
+        self.assertEqual([{'sinks': ['file', 'mqtt']}, None], [output.get('meta') for output in outputs])
+
+
+class TestOutputEncodings(unittest.TestCase):
+    def test_encoding_checked(self):
+        config = get_config("testing_config")
+        config['output'][0]['encoding'] = 'xml'
+        with self.assertRaises(ValueError):
+            Blackboard(config, {})
+
+    def test_encoding_in_meta(self):
+        config = get_config("testing_config")
+        config['output'][0]['encoding'] = 'json'  # the default - nothing extra is sent
+        blackboard = Blackboard(config, {})
+        blackboard.encoders['cbor'] = lambda payload: b"cbor"  # stands in for cbor2
+        outputs = blackboard.process_message({"id": "loc_1", "barcode": "job_1", "timestamp": "now"})
+        self.assertNotIn('meta', outputs[0])
+        self.assertEqual(b'{"job_id": "1"', blackboard.encode_payload(outputs[0])[:14])
+        blackboard.outputs['scan_event']['encoding'] = 'cbor'
+        outputs = blackboard.process_message({"id": "loc_1", "barcode": "job_2", "timestamp": "now"})
+        self.assertEqual({'encoding': 'cbor', 'content_type': 'application/cbor'}, outputs[0]['meta'])
+        self.assertEqual(b"cbor", blackboard.encode_payload(outputs[0]))
+
+
+class TestScanHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        config = get_config("testing_config")
+        config['blackboard'] = {'history': {'enabled': True, 'directory': self.tmp_dir.name}}
+        self.blackboard = Blackboard(config, {})
+
+    def tearDown(self):
+        self.blackboard.history.stop()
+        self.tmp_dir.cleanup()
+
+    def test_history_request(self):
+        timestamp = datetime.datetime.now().isoformat()  # within the retention time
+        self.blackboard.history.start()
+        for barcode in ["dir_receive", "job_1", "job_2"]:
+            self.blackboard.handle_message({"id": "loc_1", "barcode": barcode, "timestamp": timestamp}, [])
+        self.blackboard.history.stop()
+        reply = self.blackboard.handle_request(json.dumps({"command": "history", "barcode": "job_1"}))
+        self.assertEqual({"ok": True, "result": [
+            {"location": "loc_1", "barcode": "job_1", "timestamp": timestamp}]}, reply)
+        self.blackboard.history.reader.close()
+
+    def test_history_refused(self):
+        for request in [{"limit": None}, {"limit": 0}, {"limit": "10"}, {"barcode": ["job_1"]}]:
+            reply = self.blackboard.handle_request(json.dumps({"command": "history", **request}))
+            self.assertFalse(reply["ok"], request)
+
+
+class TestGS1Variables(unittest.TestCase):
+    def setUp(self):
+        config = get_config("testing_config")
+        config['variable']['gtin'] = {'name': 'gtin', 'type': 'retain', 'source': 'gs1', 'ai': '01'}
+        config['variable']['batch'] = {'name': 'batch', 'type': 'single', 'source': 'gs1', 'ai': '10'}
+        config['variable']['serial'] = {'name': 'serial', 'type': 'single', 'source': 'gs1', 'ai': '21'}
+        config['blackboard'] = {'gs1': {'separators': ['|']}}
+        config['output'].append({'name': 'item_event', 'topic': 'items', 'triggers': ['serial'],
+                                 'payload': {'gtin': 'gtin', 'batch': 'batch', 'serial': 'serial'}})
+        self.blackboard = Blackboard(config, {})
+
+    def test_many_variables_per_scan(self):
+        outputs = self.blackboard.process_message(
+            {"id": "loc_1", "barcode": "0109501101530003|10AB12|21XYZ|17251231", "timestamp": "now"})
+        self.assertEqual([{'topic': 'items', 'payload': {'gtin': '09501101530003', 'batch': 'AB12', 'serial': 'XYZ'}}],
+                         outputs)
+        self.assertEqual('09501101530003', self.blackboard.blackboard("loc_1")['gtin'])
+
+    def test_patterns_first(self):
+        self.assertEqual([('id', '10')], self.blackboard.extract_variables("job_10"))
+        self.assertEqual([(None, None)], self.blackboard.extract_variables("not_gs1"))
+
+
+class TestAggregateOutputs(unittest.TestCase):
+    def setUp(self):
+        config = get_config("testing_config")
+        config['output'].append({
+            'name': 'job_stats', 'type': 'aggregate', 'topic': '{{location}}/stats', 'triggers': ['id'],
+            'window': {'type': 'tumbling', 'length': 60}, 'payload': {'location': 'location'},
+            'aggregate': {'jobs': {'function': 'distinct', 'variable': 'id'}}})
+        self.blackboard = Blackboard(config, {})
+        self.now = 1000
+        self.blackboard.windowed_outputs['job_stats'].clock = lambda: self.now
+        self.blackboard.windowed_outputs['job_stats'].next_close = 1020
+
+    def test_published_on_close(self):
+        for job in ["job_1", "job_2", "job_1"]:
+            outputs = self.blackboard.process_message({"id": "loc_1", "barcode": job, "timestamp": "now"})
+            self.assertEqual(['Cutting/feeds/jobs'], [output['topic'] for output in outputs])
+        self.now = 1021
+        outputs = []
+        self.blackboard.close_windows(outputs)
+        self.assertEqual([{'topic': 'Cutting/stats', 'payload': {'location': 'Cutting', 'jobs': 2}}], outputs)
+
+    def test_close_keeps_lru_order(self):
+        for location_id in ["loc_1", "loc_2", "loc_3", "loc_1"]:
+            self.blackboard.process_message({"id": location_id, "barcode": "job_1", "timestamp": "now"})
+        del self.blackboard._blackboard["loc_3"]  # evicted while its window was open
+        self.now = 1021
+        outputs = []
+        self.blackboard.close_windows(outputs)
+        self.assertEqual(3, len(outputs))
+        self.assertEqual(["loc_2", "loc_1"], list(self.blackboard._blackboard))
+
+
+class TestQueryApi(ConnectedBlackboardTestCase):
+    def get_test_config(self):
+        config = get_config("testing_config")
+        config['diagnostics'] = {'profiler': {'directory': self.tmp_dir.name}}
+        return config
+
+    def request(self, **request):
+        self.client.send_json(request)
+        self.blackboard.get_input_messages()
+        return self.client.recv_json()
+
+    def test_get_and_set(self):
+        self.blackboard.process_message({"id": "loc_1", "barcode": "type_apple", "timestamp": "now"})
+        self.assertEqual('apple', self.request(command="get", location="loc_1")['result']['type'])
+        self.assertEqual(['loc_1'], list(self.request(command="list")['result']))
+
+        reply = self.request(command="set", location="loc_1", variable="type", value="pear")
+        self.assertEqual('pear', reply['result']['type'])
+        outputs = self.blackboard.process_message({"id": "loc_1", "barcode": "job_1", "timestamp": "now"})
+        self.assertEqual('pear', outputs[0]['payload']['job_type'])
+
+    def test_set_reruns_processes(self):
+        self.blackboard.process_message({"id": "loc_1", "barcode": "dir_send", "timestamp": "now"})
+        reply = self.request(command="set", location="loc_1", variable="raw_mode", value="receive")
+        self.assertEqual(('receive', 'I'), (reply['result']['raw_mode'], reply['result']['mode']))
+
+    def test_set_refused_while_busy(self):
+        self.blackboard.waiting_messages["loc_1"] = collections.deque()
+        self.assertFalse(self.request(command="set", location="loc_1", variable="type", value="pear")['ok'])
+
+    def test_alert(self):
+        outputs = []
+        self.blackboard.handle_message({"id": "loc_1", "alert": "quarantined", "timestamp": "now",
+                                        "detail": {"refused_scans": 50}}, outputs)
+        self.assertEqual([{'topic': 'loc_1/alerts/scanner', 'payload': {
+            'location_id': 'loc_1', 'alert': 'quarantined', 'timestamp': 'now', 'refused_scans': 50}}], outputs)
+        self.assertNotIn("loc_1", self.blackboard._blackboard)
+
+    def test_refused(self):
+        self.assertFalse(self.request(command="get", location="loc_9")['ok'])
+        self.assertFalse(self.request(command="set", location="loc_1", variable="id", value="1")['ok'])
+        self.assertFalse(self.request(command="drop")['ok'])
+
+    def test_malformed(self):
+        self.assertFalse(self.request(command="get", location=[1])['ok'])
+        self.assertFalse(self.request(command="set", location="loc_1", variable=["type"], value="x")['ok'])
+        self.assertFalse(self.request(command="get", location={"id": "loc_1"})['ok'])
+
+    def test_profile(self):
+        prefix = self.request(command="profile", duration=0.1)['result']['files']
+        self.assertFalse(self.request(command="profile")['ok'])  # already running
+        self.blackboard.profiler.thread.join()
+        self.assertTrue(os.path.exists(f"{prefix}.collapsed"))
+
+    def test_profile_refused(self):
+        for duration in [-1, 0, "10", True]:
+            self.assertFalse(self.request(command="profile", duration=duration)['ok'], duration)
+        self.assertIsNone(self.blackboard.profiler.thread)
+
+    def test_triggers(self):
+        self.blackboard.process_message({"id": "loc_1", "barcode": "dir_send", "timestamp": "now"})
+        progress = self.request(command="triggers")['result']['mode_change_event']
+        self.assertEqual({'triggers': ['mode', 'id'], 'trigger_policy': 'all', 'seen': ['mode']}, progress)
+
+
+class TestBoundedState(unittest.TestCase):
+    def setUp(self):
+        config = get_config("testing_config")
+        config['blackboard'] = {'max_locations': 2}
+        self.blackboard = Blackboard(config, {})
+
+    def scan(self, location_id, barcode):
+        return self.blackboard.process_message({"id": location_id, "barcode": barcode, "timestamp": "now"})
+
+    def test_least_recent_location_dropped(self):
+        self.scan("loc_1", "type_apple")
+        self.scan("loc_2", "type_pear")
+        self.scan("loc_1", "job_1")
+        self.scan("loc_3", "job_2")
+        self.assertEqual(['loc_1', 'loc_3'], list(self.blackboard._blackboard))
+        self.assertEqual(1, self.blackboard.evicted_locations)
+
+    def test_singles_cleared_per_location(self):
+        config = get_config("testing_config")
+        config['variable']['operator'] = {'name': 'operator', 'type': 'single', 'pattern': 'op_(.*)'}
+        config['output'].append({'name': 'operator_event', 'topic': 'operator', 'triggers': ['type'],
+                                 'payload': {'operator': 'operator'}})
+        self.blackboard.apply_config(config)
+        self.scan("loc_1", "op_bob")
+        self.scan("loc_2", "op_amy")
+        self.scan("loc_2", "type_box")  # uses operator at loc_2
+        self.assertEqual(set(), self.blackboard.singles_to_clear)
+        self.scan("loc_1", "job_1")  # doesn't clear operator at loc_1
+        outputs = self.scan("loc_1", "type_box")
+        self.assertEqual({'operator': 'bob'}, outputs[0]['payload'])
+
+    def test_state_saved_for_recycle(self):
+        self.scan("loc_1", "type_apple")
+        self.scan("loc_1", "dir_send")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.blackboard.state_file = os.path.join(tmp_dir, "state", "blackboard_0.json")
+            self.blackboard.save_state()
+
+            restarted = Blackboard(get_config("testing_config"), {})
+            restarted.state_file = self.blackboard.state_file
+            restarted.load_state()
+            self.assertFalse(os.path.exists(restarted.state_file))
+        self.assertEqual('apple', restarted.blackboard("loc_1")['type'])
+        self.assertEqual({'mode'}, restarted.trigger_tracking['mode_change_event'])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
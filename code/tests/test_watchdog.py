@@ -0,0 +1,73 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+import tempfile
+import os
+
+from utilities.watchdog import MemoryWatchdog, rss_bytes
+
+
+class TestMemoryWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.now = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_watchdog(self, **memory_conf):
+        memory_conf["directory"] = self.tmp_dir.name
+        return MemoryWatchdog("test", {"diagnostics": {"memory": memory_conf}}, clock=lambda: self.now)
+
+    def test_due(self):
+        watchdog = self.make_watchdog(interval=10)
+        self.assertFalse(watchdog.due())
+        self.now = 10
+        self.assertTrue(watchdog.due())
+        watchdog.check({})
+        self.assertFalse(watchdog.due())
+
+    def test_recycle(self):
+        self.assertGreater(rss_bytes(), 0)
+        self.assertFalse(self.make_watchdog().check({}))  # off by default
+        self.assertTrue(self.make_watchdog(recycle_rss=1).check({}))
+
+    def test_growth_report(self):
+        watchdog = self.make_watchdog(growth_threshold=1)
+        watchdog.check({"items": 0})
+        watchdog.baseline -= 2 * 1024 * 1024  # as if it had grown by 2MB
+        watchdog.check({"items": 1})
+        self.assertIsNotNone(watchdog.snapshot)
+        grown = [bytearray(1000) for _ in range(100)]
+        watchdog.check({"items": len(grown)})
+        self.assertIsNone(watchdog.snapshot)
+        reports = os.listdir(self.tmp_dir.name)
+        self.assertEqual(1, len(reports))
+        with open(os.path.join(self.tmp_dir.name, reports[0])) as f:
+            self.assertIn("test_watchdog.py", f.read())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
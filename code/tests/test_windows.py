@@ -0,0 +1,136 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import unittest
+
+from utilities.windows import WindowedOutput
+
+
+class WindowTestCase(unittest.TestCase):
+    def make_output(self, window, publish="close"):
+        self.now = 1000.0
+        return WindowedOutput({
+            "window": window,
+            "publish": publish,
+            "aggregate": {
+                "scans": {"function": "count"},
+                "jobs": {"function": "distinct", "variable": "id"},
+                "per_minute": {"function": "rate"},
+                "last_job": {"function": "last", "variable": "id"},
+            },
+        }, clock=lambda: self.now)
+
+
+class TestTumbling(WindowTestCase):
+    def test_close(self):
+        output = self.make_output({"type": "tumbling", "length": 60})
+        self.assertEqual(1020, output.next_close)
+        for job in ["a", "b", "a"]:
+            self.assertIsNone(output.record("loc_1", {"id": job}))
+        self.assertEqual([], output.close_due())
+
+        self.now = 1021
+        output.record("loc_1", {"id": "c"})  # in the next window
+        self.assertEqual([("loc_1", {"scans": 3, "jobs": 2, "per_minute": 3, "last_job": "a"})],
+                         output.close_due())
+        self.assertEqual([], output.close_due())  # only once
+
+        self.now = 1081
+        self.assertEqual(1, output.close_due()[0][1]["scans"])
+        # idle - one empty window is published then the location is dropped
+        self.now = 1141
+        self.assertEqual([("loc_1", {"scans": 0, "jobs": 0, "per_minute": 0, "last_job": None})],
+                         output.close_due())
+        self.now = 1201
+        self.assertEqual([], output.close_due())
+        self.assertEqual({}, output.windows)
+
+    def test_unhashable_values(self):
+        output = self.make_output({"type": "tumbling", "length": 60})
+        for job in [["a", 1], {"lot": "b"}, ["a", 1], "a"]:
+            output.record("loc_1", {"id": job})
+        self.now = 1021
+        self.assertEqual({"scans": 4, "jobs": 3, "per_minute": 4, "last_job": "a"}, output.close_due()[0][1])
+
+    def test_scan_before_close_due(self):
+        output = self.make_output({"type": "tumbling", "length": 60})
+        self.now = 1020.5  # the window ending at 1020 has not been closed yet
+        output.record("loc_1", {"id": "a"})
+        self.assertEqual([], output.close_due())  # no empty window for a location that never had one
+        self.assertIn("loc_1", output.windows)
+        self.now = 1081
+        self.assertEqual(1, output.close_due()[0][1]["scans"])
+
+
+class TestSaveRestore(WindowTestCase):
+    def test_restored_after_restart(self):
+        output = self.make_output({"type": "sliding", "length": 60, "buckets": 6})
+        for job in ["a", "b"]:
+            output.record("loc_1", {"id": job})
+        saved = json.loads(json.dumps(output.save()))
+
+        restarted = self.make_output({"type": "sliding", "length": 60, "buckets": 6})
+        self.now = 1031  # the window ending at 1020 closed while the shard was down
+        self.assertTrue(restarted.restore(saved))
+        location, aggregates = restarted.close_due()[0]
+        self.assertEqual(("loc_1", 2, 2), (location, aggregates["scans"], aggregates["jobs"]))
+        restarted.record("loc_1", {"id": "a"})
+        self.assertEqual(2, restarted.aggregate(restarted.windows["loc_1"], restarted.slot_id(self.now))["jobs"])
+
+    def test_changed_settings_ignored(self):
+        output = self.make_output({"type": "tumbling", "length": 60})
+        output.record("loc_1", {"id": "a"})
+        restarted = self.make_output({"type": "tumbling", "length": 300})
+        self.assertFalse(restarted.restore(output.save()))
+        self.assertEqual({}, restarted.windows)
+
+
+class TestSliding(WindowTestCase):
+    def test_slots_expire(self):
+        output = self.make_output({"type": "sliding", "length": 60, "buckets": 6})
+        for second in range(0, 60, 5):  # a scan every 5s for a minute
+            self.now = 1000 + second
+            output.record("loc_1", {"id": str(second)})
+        self.now = 1071
+        # window is now 1010-1070 so the scans at 1000 and 1005 have dropped out
+        location, aggregates = output.close_due()[0]
+        self.assertEqual(10, aggregates["scans"])
+        self.assertEqual("55", aggregates["last_job"])
+        self.assertEqual(7, len(output.windows["loc_1"]))  # ring size is fixed
+
+    def test_publish_on_change(self):
+        output = self.make_output({"type": "sliding", "length": 60, "buckets": 6}, publish="change")
+        self.assertEqual(1, output.record("loc_1", {"id": "a"})["scans"])
+        self.assertEqual(2, output.record("loc_1", {"id": "a"})["scans"])
+        self.now = 1100
+        self.assertEqual([], output.close_due())  # nothing published on close
+
+    def test_bad_function(self):
+        with self.assertRaises(ValueError):
+            WindowedOutput({"aggregate": {"x": {"function": "median"}}})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
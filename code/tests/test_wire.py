@@ -0,0 +1,28 @@
+import unittest
+from utilities import wire
+
+
+class TestWire(unittest.TestCase):
+    def test_round_trip(self):
+        frames = wire.pack([
+            ("loc_1/job", b'{"job_id": "1"}', None),
+            ("loc_1/alerts/scanner", b"\x00raw", {"qos": 1}),
+        ])
+        self.assertEqual([b"loc_1/job", b"", b'{"job_id": "1"}'], frames[:3])
+        self.assertEqual(
+            [("loc_1/job", b'{"job_id": "1"}', {}), ("loc_1/alerts/scanner", b"\x00raw", {"qos": 1})],
+            list(wire.unpack(frames)),
+        )
+
+    def test_payload_untouched(self):
+        payload = b'{"b": 1, "a": 2}'
+        (_topic, unpacked, _meta), = wire.unpack(wire.pack([("t", payload, None)]))
+        self.assertIs(payload, unpacked)
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(wire.unpack([b"topic", b""]))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -35,29 +35,23 @@ import time
 
 logger = logging.getLogger("config")
 
+SCHEMA_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "..", "config_schema.json"
+)
+
 
 def get_config(arg_module_file=None, arg_user_file=None):
-    user_config_file, user_config_src = select_file(
-        arg_user_file, "USER_CONFIG_FILE", "./user_config/config.toml"
-    )
+    user_config_file, user_config_src = select_user_file(arg_user_file)
 
     user_config = load_config(user_config_file, user_config_src)
-    user_config_specified_module_config_file = user_config.get(
-        "module_config_file", None)
 
-    other_module_config_sources = [
-        (user_config_specified_module_config_file, "user config")]
-    module_config_file, module_config_src = select_file(
-        arg_module_file,
-        "MODULE_CONFIG_FILE",
-        "./module_config/module_config.toml",
-        other_sources=other_module_config_sources,
+    module_config_file, module_config_src = select_module_file(
+        arg_module_file, user_config
     )
 
     module_config = load_config(module_config_file, module_config_src)
 
-    with open("./config_schema.json", "rb") as f:
-        schema = json.load(f)
+    schema = load_schema()
 
     do_validate(module_config, schema, "module")
 
@@ -70,6 +64,31 @@ def get_config(arg_module_file=None, arg_user_file=None):
     return combined_config
 
 
+def select_user_file(arg_user_file):
+    return select_file(
+        arg_user_file, "USER_CONFIG_FILE", "./user_config/config.toml"
+    )
+
+
+def select_module_file(arg_module_file, user_config):
+    user_config_specified_module_config_file = user_config.get(
+        "module_config_file", None)
+
+    other_module_config_sources = [
+        (user_config_specified_module_config_file, "user config")]
+    return select_file(
+        arg_module_file,
+        "MODULE_CONFIG_FILE",
+        "./module_config/module_config.toml",
+        other_sources=other_module_config_sources,
+    )
+
+
+def load_schema():
+    with open(SCHEMA_FILE, "rb") as f:
+        return json.load(f)
+
+
 def select_file(arg_file, env_var, default, other_sources=[]):
     config_file = (default, "default")
     
@@ -116,6 +135,93 @@ def do_validate(config, schema, label=""):
             time.sleep(36000)        
 
 
+def is_valid(config, schema, label=""):
+    try:
+        jsonschema.validate(instance=config, schema=schema,
+                            format_checker=jsonschema.Draft202012Validator.FORMAT_CHECKER)
+        return True
+    except jsonschema.ValidationError as v_err:
+        logger.error(
+            f"CONFIG ERROR on {label} - {v_err.json_path} >> {v_err.message}")
+        return False
+
+
+class ConfigWatcher:
+    """Detects changes to the user and module config files so that a running
+    building block can pick up a new config without restarting.
+
+    Unlike get_config, a missing or invalid config never blocks - check()
+    simply returns None and the caller keeps using the config it already has.
+    """
+
+    def __init__(self, arg_module_file=None, arg_user_file=None):
+        self.arg_module_file = arg_module_file
+        self.arg_user_file = arg_user_file
+        # record the starting point only - the config is already loaded
+        self.files = self.config_files()
+        self.stamps = get_stamps(self.files)
+
+    def config_files(self):
+        user_config_file, _src = select_user_file(self.arg_user_file)
+        try:
+            with open(user_config_file, "rb") as f:
+                user_config = tomllib.load(f)
+        except (OSError, tomllib.TOMLDecodeError):
+            return [user_config_file]
+        module_config_file, _src = select_module_file(self.arg_module_file, user_config)
+        return [user_config_file, module_config_file]
+
+    def check(self):
+        user_config_file, _src = select_user_file(self.arg_user_file)
+        files = [user_config_file, *self.files[1:]]
+        stamps = get_stamps(files)
+        if stamps == self.stamps:
+            return None
+
+        config, self.files = self.reload(user_config_file)
+        self.stamps = get_stamps(self.files)
+        return config
+
+    def reload(self, user_config_file):
+        try:
+            with open(user_config_file, "rb") as f:
+                user_config = tomllib.load(f)
+            module_config_file, _src = select_module_file(
+                self.arg_module_file, user_config
+            )
+            with open(module_config_file, "rb") as f:
+                module_config = tomllib.load(f)
+            schema = load_schema()
+        except (OSError, tomllib.TOMLDecodeError) as e:
+            logger.error(f"Unable to reload config: {e}")
+            return None, [user_config_file, *self.files[1:]]
+
+        files = [user_config_file, module_config_file]
+
+        if not is_valid(module_config, schema, "module"):
+            return None, files
+
+        combined_config = combine(module_config, user_config)
+        env_var_overwrite(combined_config)
+
+        if not is_valid(combined_config, schema, "combined"):
+            return None, files
+
+        logger.info(f"Reloaded Config: {combined_config}")
+        return combined_config, files
+
+
+def get_stamps(files):
+    stamps = []
+    for filename in files:
+        try:
+            stat = os.stat(filename)
+            stamps.append((filename, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamps.append((filename, None, None))
+    return stamps
+
+
 def combine(A, B):
     output = A.copy()
     do_combine(output, B)
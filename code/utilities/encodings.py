@@ -0,0 +1,63 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import json
+import logging
+
+logger = logging.getLogger("main.encodings")
+
+# optional - only needed by outputs that use them
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+DEFAULT_ENCODING = "json"
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "cbor": "application/cbor",
+}
+
+
+def make_encoder(encoding):
+    """Returns a function encoding a payload to bytes. Raises ValueError if the encoding is
+    unknown or its package isn't installed, so that a config using it is refused."""
+    if encoding == "json":
+        return lambda payload: json.dumps(payload).encode()
+    if encoding == "msgpack":
+        if msgpack is None:
+            raise ValueError("The msgpack encoding needs the msgpack package to be installed")
+        packer = msgpack.Packer()  # reused for every payload
+        return packer.pack
+    if encoding == "cbor":
+        if cbor2 is None:
+            raise ValueError("The cbor encoding needs the cbor2 package to be installed")
+        return cbor2.dumps
+    raise ValueError(f"Unknown encoding '{encoding}' - expected one of {list(CONTENT_TYPES)}")
@@ -0,0 +1,113 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import datetime
+import functools
+import json
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger("main.diagnostics")
+
+DIAGNOSTICS_DIR = "/app/data/diagnostics"
+
+
+class FlightRecorder:
+    """Fixed size ring buffer of a block's recent events, written out for post-mortem debugging.
+
+    Recording is an append of a tuple to a bounded deque, so it can stay on in production where
+    debug logging can't. The buffer is dumped to a json lines file when the block crashes, when the
+    process receives SIGUSR1 or when a timed stage exceeds the latency threshold.
+    """
+
+    def __init__(self, block_name, config):
+        recorder_conf = config.get("diagnostics", {}).get("flight_recorder", {})
+        self.block_name = block_name
+        self.enabled = recorder_conf.get("enabled", True)
+        self.events = collections.deque(maxlen=recorder_conf.get("size", 2000))
+        self.directory = recorder_conf.get("directory", DIAGNOSTICS_DIR)
+        self.latency_threshold = recorder_conf.get("latency_threshold", 0)  # seconds, 0 = off
+        self.dump_interval = recorder_conf.get("dump_interval", 60)  # between latency dumps
+        self.last_latency_dump = None
+
+    def record(self, event, *details):
+        if self.enabled:
+            self.events.append((time.time(), event, details))
+
+    def check_latency(self, stage, duration):
+        if not self.latency_threshold or duration <= self.latency_threshold:
+            return
+        self.record("slow", stage, duration)
+        now = time.monotonic()
+        if self.last_latency_dump is None or now - self.last_latency_dump >= self.dump_interval:
+            self.last_latency_dump = now
+            self.dump(f"{stage} took {duration * 1000:.1f}ms")
+
+    def install(self):
+        """Dumps on SIGUSR1 - call in the block's own process"""
+        signal.signal(signal.SIGUSR1, self.signal_handler)
+
+    def signal_handler(self, _sig, _frame):
+        self.dump("SIGUSR1")
+
+    def dump(self, reason):
+        if not self.enabled:
+            return None
+        now = datetime.datetime.now()
+        filename = os.path.join(
+            self.directory,
+            f"flight_{self.block_name}_{os.getpid()}_{now.strftime('%Y%m%d_%H%M%S_%f')}.jsonl",
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(filename, "w") as f:
+                header = {"block": self.block_name, "pid": os.getpid(), "reason": reason,
+                          "time": now.isoformat(), "events": len(self.events)}
+                f.write(json.dumps(header) + "\n")
+                for timestamp, event, details in list(self.events):
+                    f.write(json.dumps({"t": timestamp, "event": event, "details": details}, default=str) + "\n")
+        except OSError as e:
+            logger.error(f"Unable to write flight recorder dump {filename}: {e}")
+            return None
+        logger.warning(f"Flight recorder for {self.block_name} dumped to {filename} ({reason})")
+        return filename
+
+
+def dump_on_crash(run):
+    """Decorates a block's run method so that its flight recorder is installed and dumped if it crashes"""
+
+    @functools.wraps(run)
+    def wrapper(self, *args, **kwargs):
+        self.flight_recorder.install()
+        try:
+            return run(self, *args, **kwargs)
+        except Exception as e:
+            self.flight_recorder.record("crash", repr(e))
+            self.flight_recorder.dump(f"crash: {e!r}")
+            raise
+
+    return wrapper
@@ -0,0 +1,111 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import logging
+
+logger = logging.getLogger("main.framing")
+
+STX = b"\x02"
+ETX = b"\x03"
+FRAMING_MODES = ("delimiter", "stx_etx")
+# not str.strip() - that would also remove the GS1 group separator (\x1d)
+STRIP_CHARS = " \t\r\n"
+
+
+class Framer:
+    """Splits the byte stream from a reader (TCP or serial) into whole barcodes.
+
+    mode "delimiter" - each barcode ends with `delimiter` (e.g. CR or LF)
+    mode "stx_etx" - each barcode is wrapped in STX ... ETX, anything outside a frame is ignored
+    Works on whatever the reads return, so one read can hold several barcodes or part of one.
+    An incomplete frame that grows past max_length bytes is dropped.
+    """
+
+    def __init__(self, mode="delimiter", delimiter=b"\n", max_length=4096, encoding="utf-8"):
+        if mode not in FRAMING_MODES:
+            raise ValueError(f"Unknown framing mode '{mode}' - expected one of {FRAMING_MODES}")
+        if mode == "delimiter" and not delimiter:
+            raise ValueError("Delimiter framing needs a delimiter")
+        self.mode = mode
+        self.delimiter = delimiter
+        self.max_length = max_length
+        self.encoding = encoding
+        self.buffer = bytearray()
+        self.overflows = 0
+
+    @classmethod
+    def from_config(cls, conf):
+        return cls(
+            conf.get("framing", "delimiter"),
+            conf.get("delimiter", "\n").encode(),
+            conf.get("max_length", 4096),
+            conf.get("encoding", "utf-8"),
+        )
+
+    def feed(self, data):
+        """Adds bytes read from the reader, returns the barcodes completed by them"""
+        self.buffer += data
+        frames = self.split_stx_etx() if self.mode == "stx_etx" else self.split_delimited()
+        if len(self.buffer) > self.max_length:
+            logger.warning(f"Dropped {len(self.buffer)} bytes without a complete barcode")
+            self.overflows += 1
+            self.buffer.clear()
+
+        barcodes = []
+        for frame in frames:
+            if len(frame) > self.max_length:
+                self.overflows += 1
+                continue
+            barcode = frame.decode(self.encoding, errors="replace").strip(STRIP_CHARS)
+            if barcode:
+                barcodes.append(barcode)
+        return barcodes
+
+    def reset(self):
+        # e.g. after a reconnect - a partial frame from the old connection can't be completed
+        self.buffer.clear()
+
+    def split_delimited(self):
+        *frames, rest = self.buffer.split(self.delimiter)
+        if frames:
+            self.buffer = bytearray(rest)
+        return frames
+
+    def split_stx_etx(self):
+        frames = []
+        position = 0
+        while True:
+            end = self.buffer.find(ETX, position)
+            if end < 0:
+                break
+            # the last STX before the ETX - an earlier one without an ETX was a broken frame
+            start = self.buffer.rfind(STX, position, end)
+            if start >= 0:
+                frames.append(bytes(self.buffer[start + 1:end]))
+            position = end + 1
+
+        start = self.buffer.find(STX, position)
+        del self.buffer[:start if start >= 0 else len(self.buffer)]
+        return frames
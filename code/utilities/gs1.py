@@ -0,0 +1,148 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import re
+
+GROUP_SEPARATOR = "\x1d"  # how FNC1 is transmitted between elements
+SYMBOLOGY_IDENTIFIERS = ("]C1", "]d2", "]e0", "]Q3", "]J1")  # GS1-128, DataMatrix, DataBar, QR, DotCode
+
+# <AI>: (<fixed length>, <max data length>)
+# The AIs are prefix free (e.g. there is no AI starting "01" other than "01") so the AI at any point
+# in the data is found by trying the 2, 3 and then 4 digit prefix.
+AI_TABLE = {
+    "00": (True, 18),  # SSCC
+    "01": (True, 14),  # GTIN
+    "02": (True, 14),  # GTIN of contained trade items
+    "10": (False, 20),  # batch / lot
+    "11": (True, 6),  # production date YYMMDD
+    "12": (True, 6),  # due date
+    "13": (True, 6),  # packaging date
+    "15": (True, 6),  # best before
+    "16": (True, 6),  # sell by
+    "17": (True, 6),  # expiry
+    "20": (True, 2),  # variant
+    "21": (False, 20),  # serial number
+    "22": (False, 20),  # consumer product variant
+    "240": (False, 30),  # additional product id
+    "241": (False, 30),  # customer part number
+    "242": (False, 6),  # made-to-order variation
+    "243": (False, 20),  # packaging component number
+    "250": (False, 30),  # secondary serial number
+    "251": (False, 30),  # reference to source entity
+    "253": (False, 30),  # GDTI
+    "254": (False, 20),  # GLN extension
+    "255": (False, 25),  # GCN
+    "30": (False, 8),  # variable count
+    "37": (False, 8),  # count of trade items
+    "400": (False, 30),  # customer purchase order number
+    "401": (False, 30),  # GINC
+    "402": (True, 17),  # GSIN
+    "403": (False, 30),  # routing code
+    "420": (False, 20),  # ship to postal code
+    "421": (False, 12),  # ship to postal code with country
+    "422": (True, 3),  # country of origin
+    "7003": (True, 10),  # expiry date and time
+    "8004": (False, 30),  # GIAI
+    "8005": (True, 6),  # price per unit of measure
+    "8020": (False, 25),  # payment slip reference
+    "90": (False, 30),  # mutually agreed
+}
+AI_TABLE.update({f"{ai}": (False, 90) for ai in range(91, 100)})  # company internal
+AI_TABLE.update({f"{ai}": (True, 13) for ai in range(410, 418)})  # GLNs
+AI_TABLE.update({f"{ai}{n}": (True, 6) for ai in range(310, 370) for n in range(10)})  # measures
+AI_TABLE.update({f"{ai}{n}": (False, 15) for ai in (390, 392) for n in range(10)})  # amounts
+AI_TABLE.update({f"{ai}{n}": (False, 18) for ai in (391, 393) for n in range(10)})  # amounts with currency
+AI_TABLE.update({f"394{n}": (True, 4) for n in range(10)})  # percentage discount
+AI_TABLE.update({f"395{n}": (True, 6) for n in range(10)})  # amount per unit
+
+BRACKETED_ELEMENT = re.compile(r"\((\d{2,4})\)([^(]*)")
+
+
+def parse_gs1(data, separators=(GROUP_SEPARATOR,)):
+    """Splits a GS1 element string into {<AI>:<value>} in a single pass.
+
+    Accepts the data as sent by a scanner - optionally starting with a symbology identifier, with
+    variable length elements terminated by one of separators - or the bracketed human readable
+    form, e.g. "(01)09501101530003(10)AB12". Raises ValueError if it isn't a valid element string.
+    """
+    if data.startswith("("):
+        return parse_bracketed(data)
+    if data.startswith(SYMBOLOGY_IDENTIFIERS):
+        data = data[3:]
+
+    elements = {}
+    index = 0
+    end = len(data)
+    while index < end:
+        if data[index] in separators:  # also allows a leading FNC1 and FNC1 after fixed length AIs
+            index += 1
+            continue
+        ai = match_ai(data, index)
+        fixed, length = AI_TABLE[ai]
+        start = index + len(ai)
+        if fixed:
+            stop = start + length
+            if stop > end:
+                raise ValueError(f"AI {ai} needs {length} characters")
+        else:
+            stop = min(end, start + length)
+            for separator in separators:
+                found = data.find(separator, start, stop)
+                if found != -1:
+                    stop = found
+        if stop == start:
+            raise ValueError(f"AI {ai} has no data")
+        elements[ai] = data[start:stop]
+        index = stop
+
+    if not elements:
+        raise ValueError("No GS1 elements found")
+    return elements
+
+
+def parse_bracketed(data):
+    elements = {}
+    index = 0
+    for match in BRACKETED_ELEMENT.finditer(data):
+        if match.start() != index:
+            break
+        ai, value = match.groups()
+        if ai not in AI_TABLE:
+            raise ValueError(f"Unknown AI {ai}")
+        fixed, length = AI_TABLE[ai]
+        if not value or len(value) > length or (fixed and len(value) != length):
+            raise ValueError(f"AI {ai} has invalid length data: {value}")
+        elements[ai] = value
+        index = match.end()
+    if index != len(data) or not elements:
+        raise ValueError(f"Not a bracketed GS1 element string at position {index}")
+    return elements
+
+
+def match_ai(data, index):
+    for length in (2, 3, 4):
+        ai = data[index : index + length]
+        if ai in AI_TABLE:
+            return ai
+    raise ValueError(f"No known AI at position {index}")
@@ -0,0 +1,203 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import collections
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("main.history")
+
+HISTORY_DIR = "/app/data/history"
+MAX_QUERY_ROWS = 1000
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS scans (time REAL, location_id TEXT, barcode TEXT, timestamp TEXT)",
+    "CREATE INDEX IF NOT EXISTS scans_barcode ON scans (barcode, time)",
+    "CREATE INDEX IF NOT EXISTS scans_location ON scans (location_id, time)",
+    "CREATE INDEX IF NOT EXISTS scans_time ON scans (time)",
+]
+
+
+class HistoryStore:
+    """Keeps the scans of a shard in a SQLite database (WAL mode) so that they can be looked up
+    by barcode, location and time range.
+
+    record() only appends to a bounded queue - a background thread inserts what is queued in
+    batches, so the store never holds up processing. Scans are dropped (and counted) while the
+    queue is full. Scans older than retention_days are deleted periodically and the space is
+    handed back with an incremental vacuum.
+    """
+
+    def __init__(self, history_conf, shard=0, clock=time.time):
+        directory = history_conf.get("directory", HISTORY_DIR)
+        self.path = os.path.join(directory, f"scans_{shard}.db")
+        self.queue_size = history_conf.get("queue_size", 10000)
+        self.batch_size = history_conf.get("batch_size", 1000)
+        self.flush_interval = history_conf.get("flush_interval", 1)
+        self.retention = history_conf.get("retention_days", 30) * 86400
+        self.compact_interval = history_conf.get("compact_interval", 3600)
+        self.clock = clock
+
+        self.queue = collections.deque()  # appended by record(), emptied by the writer thread
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.reader = None  # connection for queries, used by the owner's thread
+        self.next_compact = 0
+
+        self.written = 0
+        self.dropped = 0
+        self.deleted = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="history", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """Stops the writer once everything queued has been written (or timeout seconds have passed)"""
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def record(self, location_id, barcode, timestamp):
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append((self.clock(), location_id, barcode, timestamp))
+        if len(self.queue) >= self.batch_size:
+            self.wake.set()
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")  # only takes effect on a new database
+        connection.execute("PRAGMA journal_mode = WAL")  # queries don't wait for the writer
+        connection.execute("PRAGMA synchronous = NORMAL")
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        return connection
+
+    def run(self):
+        try:
+            connection = self.connect()
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Unable to open scan history at {self.path} - history disabled: {e}")
+            self.queue_size = 0
+            self.queue.clear()
+            return
+        while self.running or self.queue:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.write_queued(connection)
+                if self.clock() >= self.next_compact:
+                    self.next_compact = self.clock() + self.compact_interval
+                    self.compact(connection)
+            except sqlite3.Error as e:
+                logger.error(f"Unable to write scan history: {e}")
+        connection.close()
+
+    def write_queued(self, connection):
+        while self.queue:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            rows = [
+                (scan_time(timestamp, received), location_id, barcode, timestamp)
+                for received, location_id, barcode, timestamp in batch
+            ]
+            with connection:
+                connection.executemany("INSERT INTO scans VALUES (?, ?, ?, ?)", rows)
+            self.written += len(rows)
+
+    def compact(self, connection):
+        with connection:
+            deleted = connection.execute(
+                "DELETE FROM scans WHERE time < ?", (self.clock() - self.retention,)
+            ).rowcount
+        if deleted:
+            connection.execute("PRAGMA incremental_vacuum")
+            self.deleted += deleted
+            logger.info(f"Removed {deleted} scans older than {self.retention / 86400:g} days from history")
+
+    def query(self, barcode=None, location_id=None, start=None, end=None, limit=100):
+        """Most recent scans first. start and end are ISO8601 times or unix timestamps"""
+        conditions = []
+        parameters = []
+        for column, value in [("barcode", barcode), ("location_id", location_id)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        for condition, value in [("time >= ?", start), ("time <= ?", end)]:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(parse_time(value))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        parameters.append(min(int(limit), MAX_QUERY_ROWS))
+
+        if self.reader is None:
+            self.reader = sqlite3.connect(self.path)
+        try:
+            rows = self.reader.execute(
+                f"SELECT location_id, barcode, timestamp FROM scans {where} ORDER BY time DESC LIMIT ?",
+                parameters,
+            ).fetchall()
+        except sqlite3.Error as e:
+            raise ValueError(f"Unable to read scan history: {e}")
+        return [{"location": location_id, "barcode": barcode, "timestamp": timestamp}
+                for location_id, barcode, timestamp in rows]
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "queued": len(self.queue),
+            "dropped": self.dropped,
+            "deleted": self.deleted,
+        }
+
+    def log_stats(self):
+        if self.written or self.dropped:
+            logger.info(f"Scan history: {self.stats()}")
+
+
+def scan_time(timestamp, default):
+    try:
+        return datetime.datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_time(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid time {value} - expected ISO8601 or a unix timestamp")
@@ -0,0 +1,145 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import logging
+import os
+import struct
+import time
+
+logger = logging.getLogger("main.key_events")
+
+# Key event log format:
+#   header  b"KEYLOG01"
+#   L record - b"L" <uint16 location index> <uint16 length> <location id utf8>
+#   K record - b"K" <uint16 location index> <uint32 sec> <uint32 usec> <uint16 code> <int8 value>
+# Location ids are written once per file and then referred to by index.
+FILE_HEADER = b"KEYLOG01"
+LOCATION_RECORD = struct.Struct("<cHH")
+KEY_RECORD = struct.Struct("<cHIIHb")
+
+
+def event_timestamp(sec, usec):
+    # ISO8601 in local time from a kernel event timestamp
+    __dt = -1 * (
+        time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
+    )
+    tz = datetime.timezone(datetime.timedelta(seconds=__dt))
+
+    return (
+        datetime.datetime.fromtimestamp(sec, tz=tz)
+        + datetime.timedelta(microseconds=usec)
+    ).isoformat()
+
+
+def current_timestamp():
+    # for scans that don't come with a kernel event timestamp (e.g. network or serial readers)
+    now = time.time()
+    return event_timestamp(int(now), int(now % 1 * 1000000))
+
+
+class KeyEventRecorder:
+    """Writes raw scanner key events to a compact binary log - one file per day in directory,
+    named <prefix>_<date>.bin"""
+
+    def __init__(self, directory, flush_interval=1, prefix="keys"):
+        self.directory = directory
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.file = None
+        self.file_date = None
+        self.locations = {}  # <location_id>:<index> for the current file
+        self.next_flush = 0
+
+    def record(self, location_id, sec, usec, code, value):
+        date = time.strftime("%Y-%m-%d")
+        if date != self.file_date:
+            self.open_file(date)
+            if self.file is None:
+                return
+
+        index = self.locations.get(location_id)
+        if index is None:
+            index = len(self.locations)
+            self.locations[location_id] = index
+            encoded = str(location_id).encode()
+            self.file.write(LOCATION_RECORD.pack(b"L", index, len(encoded)) + encoded)
+
+        self.file.write(KEY_RECORD.pack(b"K", index, sec, usec, code, value))
+
+        now = time.monotonic()
+        if now >= self.next_flush:
+            self.next_flush = now + self.flush_interval
+            self.file.flush()
+
+    def open_file(self, date):
+        self.close()
+        self.file_date = date
+        self.locations = {}
+        filename = os.path.join(self.directory, f"{self.prefix}_{date}.bin")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            part = 0
+            while self.file is None:
+                try:
+                    self.file = open(filename, "xb")  # never truncates an existing log
+                except FileExistsError:  # continue today's log under a new name
+                    part += 1
+                    filename = os.path.join(self.directory, f"{self.prefix}_{date}_{part}.bin")
+            self.file.write(FILE_HEADER)
+            logger.info(f"Recording key events to {filename}")
+        except OSError as e:
+            logger.error(f"Unable to record key events to {filename}: {e}")
+            self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_key_events(filename):
+    """Yields (location_id, sec, usec, code, value) for each key event in a log file"""
+    locations = {}
+    with open(filename, "rb") as f:
+        if f.read(len(FILE_HEADER)) != FILE_HEADER:
+            raise ValueError(f"{filename} is not a key event log")
+        while True:
+            record_type = f.read(1)
+            if not record_type:
+                return
+            if record_type == b"L":
+                data = record_type + f.read(LOCATION_RECORD.size - 1)
+                if len(data) < LOCATION_RECORD.size:
+                    return  # truncated by a crash mid-write
+                _type, index, length = LOCATION_RECORD.unpack(data)
+                locations[index] = f.read(length).decode()
+            elif record_type == b"K":
+                data = record_type + f.read(KEY_RECORD.size - 1)
+                if len(data) < KEY_RECORD.size:
+                    return
+                _type, index, sec, usec, code, value = KEY_RECORD.unpack(data)
+                yield locations[index], sec, usec, code, value
+            else:
+                raise ValueError(f"Corrupt key event log {filename} at offset {f.tell() - 1}")
@@ -0,0 +1,221 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import logging
+import os
+import struct
+import zmq
+
+logger = logging.getLogger("main.links")
+
+POLICIES = ["block", "drop_oldest", "drop_newest", "spill"]
+SPILL_DIR = "/app/data/spill"
+
+DEFAULT_LINK_CONF = {
+    "ingestion": {"policy": "drop_oldest"},  # scanners -> blackboard, must never stall
+    "output": {"policy": "block"},  # blackboard -> service layer wrapper
+}
+
+
+def link_options(config, name):
+    """Backpressure options for the named link ([links.<name>] in the config)"""
+    options = dict(DEFAULT_LINK_CONF.get(name, {}))
+    options.update(config.get("links", {}).get(name, {}))
+    options["name"] = name
+    return options
+
+
+def connect_link(context, link_conf, socket_options=None):
+    # options are set before bind/connect - most, like the reconnect ones, only apply to later connects
+    socket = context.socket(link_conf["type"])
+    hwm = link_conf.get("hwm")
+    if hwm is not None:
+        socket.setsockopt(zmq.SNDHWM, hwm)
+        socket.setsockopt(zmq.RCVHWM, hwm)
+    for option, value in (socket_options or {}).items():
+        socket.setsockopt(option, value)
+    if link_conf["bind"]:
+        socket.bind(link_conf["address"])
+    else:
+        socket.connect(link_conf["address"])
+    return socket
+
+
+class LinkSender:
+    """Sends multipart messages on a ZMQ socket following a backpressure policy.
+
+    block - wait until the receiver has capacity (the zmq default)
+    drop_newest - never wait, discard new messages while the socket is at its high-water mark
+    drop_oldest - never wait, queue up to queue_size messages and discard the oldest ones
+    spill - never wait, queue up to queue_size messages then append to a file under /app/data
+            which is sent once the receiver catches up (and survives restarts)
+
+    Message order is kept - nothing new is sent while older messages are still queued.
+    Queued messages are sent by flush(), which the owner calls regularly.
+    """
+
+    def __init__(self, socket, link_conf, label=None, can_block=True):
+        self.socket = socket
+        self.label = label or link_conf.get("name", "link")
+        self.policy = link_conf.get("policy", "block")
+        if self.policy not in POLICIES:
+            logger.error(f"Unknown policy {self.policy} for link {self.label} - using block")
+            self.policy = "block"
+        if self.policy == "block" and not can_block:
+            logger.warning(f"Link {self.label} must not block - using drop_oldest")
+            self.policy = "drop_oldest"
+
+        self.queue_size = link_conf.get("queue_size", 10000)
+        self.queue = collections.deque()
+
+        self.spill_limit = link_conf.get("spill_limit", 64) * 1024 * 1024  # MB
+        self.spill_file = os.path.join(SPILL_DIR, f"{self.label}.spill")
+        self.spill_offset = 0
+        self.spill_size = 0
+        if self.policy == "spill":
+            self.find_spill()
+
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    @property
+    def pending(self):
+        return len(self.queue) > 0 or self.spill_size > 0
+
+    def send(self, frames):
+        if self.policy == "block":
+            self.socket.send_multipart(frames)
+            self.sent += 1
+            return
+
+        if self.pending:
+            self.flush()
+        if not self.pending and self.try_send(frames):
+            return
+        self.enqueue(frames)
+
+    def try_send(self, frames):
+        try:
+            self.socket.send_multipart(frames, zmq.NOBLOCK)
+            self.sent += 1
+            return True
+        except zmq.Again:
+            return False
+
+    def enqueue(self, frames):
+        if self.policy == "drop_newest":
+            self.dropped += 1
+        elif self.policy == "drop_oldest":
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(frames)
+        elif self.spill_size > 0 or len(self.queue) >= self.queue_size:
+            self.spill(frames)
+        else:
+            self.queue.append(frames)
+
+    def flush(self):
+        """Sends queued messages until the socket is full - returns True when nothing is left"""
+        while True:
+            if not self.queue and self.spill_size > 0:
+                self.unspill(self.queue_size)
+            if not self.queue:
+                return True
+            if not self.try_send(self.queue[0]):
+                return False
+            self.queue.popleft()
+
+    def spill(self, frames):
+        if self.spill_size >= self.spill_limit:
+            self.dropped += 1
+            return
+        record = [struct.pack("<I", len(frames))]
+        for frame in frames:
+            record.append(struct.pack("<I", len(frame)))
+            record.append(frame)
+        data = b"".join(record)
+        try:
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            with open(self.spill_file, "ab") as f:
+                f.write(data)
+            self.spill_size += len(data)
+            self.spilled += 1
+        except OSError as e:
+            logger.error(f"Unable to spill to {self.spill_file}: {e}")
+            self.dropped += 1
+
+    def unspill(self, count):
+        try:
+            with open(self.spill_file, "rb") as f:
+                f.seek(self.spill_offset)
+                for _ in range(count):
+                    header = f.read(4)
+                    if len(header) < 4:
+                        break
+                    (frame_count,) = struct.unpack("<I", header)
+                    frames = []
+                    for _ in range(frame_count):
+                        (length,) = struct.unpack("<I", f.read(4))
+                        frames.append(f.read(length))
+                    self.queue.append(frames)
+                self.spill_offset = f.tell()
+        except (OSError, struct.error) as e:
+            logger.error(f"Unable to read spilled messages from {self.spill_file}: {e}")
+            self.spill_offset = self.spill_size
+
+        if self.spill_offset >= self.spill_size:
+            self.clear_spill()
+
+    def find_spill(self):
+        # messages spilled before a restart are sent first
+        try:
+            self.spill_size = os.path.getsize(self.spill_file)
+            if self.spill_size:
+                logger.info(f"Found {self.spill_size} bytes of spilled messages for link {self.label}")
+        except OSError:
+            self.spill_size = 0
+
+    def clear_spill(self):
+        try:
+            os.remove(self.spill_file)
+        except OSError:
+            pass
+        self.spill_offset = 0
+        self.spill_size = 0
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "queued": len(self.queue),
+            "spilled_bytes": self.spill_size - self.spill_offset,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+        }
+
+    def log_stats(self):
+        if self.pending or self.dropped or self.spilled:
+            logger.info(f"Link {self.label} ({self.policy}): {self.stats()}")
@@ -0,0 +1,162 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import datetime
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+from utilities.flight_recorder import DIAGNOSTICS_DIR
+
+logger = logging.getLogger("main.diagnostics")
+
+
+class SamplingProfiler:
+    """Time bounded sampling profiler, started on SIGUSR2 or on request.
+
+    While running, a background thread samples the stacks of the block's other threads every
+    `interval` seconds. The stacks are written out as collapsed stacks (for flame graph tools)
+    along with a summary of the functions seen most often. Nothing runs while it is idle.
+    Optionally a tracemalloc snapshot diff over the same period is written too.
+    """
+
+    def __init__(self, block_name, config):
+        profiler_conf = config.get("diagnostics", {}).get("profiler", {})
+        self.block_name = block_name
+        self.directory = profiler_conf.get("directory", DIAGNOSTICS_DIR)
+        self.interval = profiler_conf.get("interval", 0.005)
+        self.default_duration = profiler_conf.get("duration", 30)
+        self.max_duration = profiler_conf.get("max_duration", 300)
+        self.trace_memory = profiler_conf.get("tracemalloc", False)
+        self.thread = None
+
+    def install(self):
+        """Starts a profile on SIGUSR2 - call in the block's own process"""
+        signal.signal(signal.SIGUSR2, self.signal_handler)
+
+    def signal_handler(self, _sig, _frame):
+        self.start()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=None, trace_memory=None):
+        """Returns the prefix of the files that will be written, None if a profile is already running"""
+        if self.running:
+            logger.warning(f"Profile of {self.block_name} already running")
+            return None
+        duration = min(duration or self.default_duration, self.max_duration)
+        trace_memory = self.trace_memory if trace_memory is None else trace_memory
+        prefix = os.path.join(
+            self.directory,
+            f"profile_{self.block_name}_{os.getpid()}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}",
+        )
+        self.thread = threading.Thread(
+            target=self.profile, args=(duration, trace_memory, prefix), name="profiler", daemon=True
+        )
+        self.thread.start()
+        logger.info(f"Profiling {self.block_name} for {duration}s")
+        return prefix
+
+    def profile(self, duration, trace_memory, prefix):
+        started_tracing = False
+        snapshot = None
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            snapshot = tracemalloc.take_snapshot()
+
+        stacks = collections.Counter()
+        samples = 0
+        own_id = threading.get_ident()
+        names = {}
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stacks[collapse_stack(names.get(thread_id, str(thread_id)), frame)] += 1
+            samples += 1
+            time.sleep(self.interval)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{prefix}.collapsed", "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            with open(f"{prefix}.txt", "w") as f:
+                f.write(summarise(stacks, samples, duration))
+            if snapshot is not None:
+                top = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+                with open(f"{prefix}.tracemalloc.txt", "w") as f:
+                    for stat in top[:50]:
+                        f.write(f"{stat}\n")
+        except OSError as e:
+            logger.error(f"Unable to write profile {prefix}: {e}")
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+        logger.info(f"Profile of {self.block_name} written to {prefix}.*")
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(thread_name, frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+def summarise(stacks, samples, duration, top=30):
+    self_counts = collections.Counter()
+    total_counts = collections.Counter()
+    for stack, count in stacks.items():
+        functions = stack.split(";")[1:]  # without the thread name
+        if not functions:
+            continue
+        self_counts[functions[-1]] += count
+        for function in set(functions):
+            total_counts[function] += count
+
+    lines = [f"{samples} samples over {duration}s", "", "self  total  function"]
+    for function, count in self_counts.most_common(top):
+        lines.append(f"{count:5d} {total_counts[function]:6d}  {function}")
+    lines += ["", "total  function"]
+    for function, count in total_counts.most_common(top):
+        lines.append(f"{count:6d}  {function}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,216 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import logging
+import re
+import time
+
+from utilities.ttl_cache import TTLCache
+from utilities.key_events import current_timestamp
+
+logger = logging.getLogger("main.scan_filters")
+
+
+class ScanDeduplicator:
+    """Suppresses repeat reads of the same barcode at a location within a time window.
+
+    The window can be set globally, per location and per variable (using the variable patterns
+    from the config). Each location keeps a TTLCache of recently seen barcodes. A repeat read
+    restarts the window, so a label left in front of a presentation-mode scanner is only
+    reported once.
+    """
+
+    def __init__(self, config, clock=time.monotonic):
+        dedup_conf = config.get("input", {}).get("dedup", {})
+        self.window = dedup_conf.get("window", 0)
+        self.max_entries = dedup_conf.get("max_entries", 256)
+        self.location_windows = dedup_conf.get("locations", {})  # <location_id>:<window>
+        variable_windows = dedup_conf.get("variables", {})  # <variable>:<window>
+
+        # first matching pattern decides the variable - same as the blackboard
+        self.variable_patterns = []
+        for entry_name, var in config.get("variable", {}).items():
+            name = var.get("name", entry_name)
+            pattern = var.get("pattern")
+            if pattern is not None and name in variable_windows:
+                self.variable_patterns.append((re.compile(pattern), variable_windows[name]))
+
+        self.enabled = (
+            self.window > 0
+            or any(window > 0 for window in self.location_windows.values())
+            or any(window > 0 for _pattern, window in self.variable_patterns)
+        )
+
+        self.clock = clock
+        self.caches = {}  # <location_id>:{<window>:TTLCache}
+        self.suppressed = {}  # <location_id>:<count>
+        self.passed = {}  # <location_id>:<count>
+
+    def get_window(self, location_id, barcode):
+        for pattern, window in self.variable_patterns:
+            if pattern.search(barcode):
+                return window
+        return self.location_windows.get(location_id, self.window)
+
+    def is_duplicate(self, location_id, barcode):
+        if not self.enabled:
+            return False
+
+        window = self.get_window(location_id, barcode)
+        if window <= 0:
+            self.passed[location_id] = self.passed.get(location_id, 0) + 1
+            return False
+
+        location_caches = self.caches.setdefault(location_id, {})
+        cache = location_caches.get(window)
+        if cache is None:
+            cache = TTLCache(self.max_entries, window, self.clock)
+            location_caches[window] = cache
+
+        duplicate = cache.get(barcode) is not None
+        cache.put(barcode, True)  # a repeat read restarts the window
+        if duplicate:
+            self.suppressed[location_id] = self.suppressed.get(location_id, 0) + 1
+        else:
+            self.passed[location_id] = self.passed.get(location_id, 0) + 1
+        return duplicate
+
+    def stats(self):
+        return {
+            location_id: {
+                "passed": self.passed.get(location_id, 0),
+                "suppressed": self.suppressed.get(location_id, 0),
+            }
+            for location_id in set(self.passed) | set(self.suppressed)
+        }
+
+    def log_stats(self):
+        if self.enabled and self.suppressed:
+            logger.info(f"Duplicate scan suppression: {self.stats()}")
+
+
+class DeviceRateLimiter:
+    """Per device token bucket, so one runaway scanner can't starve the other stations.
+
+    Each device may send `burst` scans at once and `rate` scans per second after that. A device
+    that has had `threshold` scans refused within `window` seconds (e.g. stuck in continuous mode
+    or with a jammed trigger) is quarantined - all its scans are dropped for `duration` seconds.
+    Quarantine and release produce alerts (see pop_alerts) which are sent on as messages.
+    """
+
+    def __init__(self, config, clock=time.monotonic):
+        limit_conf = config.get("input", {}).get("rate_limit", {})
+        self.rate = limit_conf.get("rate", 0)  # scans per second, 0 = off
+        self.burst = limit_conf.get("burst", 10)
+        quarantine_conf = limit_conf.get("quarantine", {})
+        self.quarantine_threshold = quarantine_conf.get("threshold", 50)  # 0 = never quarantine
+        self.quarantine_window = quarantine_conf.get("window", 60)
+        self.quarantine_duration = quarantine_conf.get("duration", 300)
+        self.enabled = self.rate > 0
+
+        self.clock = clock
+        self.buckets = {}  # <location_id>:[<tokens>,<last refill>]
+        self.refusals = {}  # <location_id>:deque of times scans were refused, within the window
+        self.quarantined = {}  # <location_id>:<release time>
+        self.alerts = []
+        self.limited = {}  # <location_id>:<count>
+        self.quarantine_dropped = {}  # <location_id>:<count>
+
+    def allow(self, location_id):
+        if not self.enabled:
+            return True
+        now = self.clock()
+        if location_id in self.quarantined:
+            self.quarantine_dropped[location_id] = self.quarantine_dropped.get(location_id, 0) + 1
+            return False
+
+        bucket = self.buckets.get(location_id)
+        if bucket is None:
+            bucket = self.buckets[location_id] = [self.burst, now]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+
+        self.limited[location_id] = self.limited.get(location_id, 0) + 1
+        refusals = self.refusals.setdefault(location_id, collections.deque())
+        refusals.append(now)
+        while refusals[0] <= now - self.quarantine_window:
+            refusals.popleft()
+        if self.quarantine_threshold and len(refusals) >= self.quarantine_threshold:
+            self.quarantine(location_id, now, len(refusals))
+        return False
+
+    def quarantine(self, location_id, now, refused):
+        self.quarantined[location_id] = now + self.quarantine_duration
+        self.refusals.pop(location_id, None)
+        self.quarantine_dropped[location_id] = 0
+        logger.warning(
+            f"Quarantined scanner at {location_id} for {self.quarantine_duration}s - "
+            f"{refused} scans over the rate limit in {self.quarantine_window}s"
+        )
+        self.alerts.append(make_alert(location_id, "quarantined", {
+            "refused_scans": refused,
+            "window": self.quarantine_window,
+            "duration": self.quarantine_duration,
+        }))
+
+    def release_due(self):
+        now = self.clock()
+        for location_id, release_time in list(self.quarantined.items()):
+            if now < release_time:
+                continue
+            del self.quarantined[location_id]
+            self.buckets[location_id] = [self.burst, now]
+            dropped = self.quarantine_dropped.get(location_id, 0)
+            logger.info(f"Released scanner at {location_id} from quarantine - {dropped} scans were dropped")
+            self.alerts.append(make_alert(location_id, "released", {"dropped_scans": dropped}))
+
+    def pop_alerts(self):
+        alerts, self.alerts = self.alerts, []
+        return alerts
+
+    def stats(self):
+        return {
+            location_id: {
+                "limited": self.limited.get(location_id, 0),
+                "quarantined": location_id in self.quarantined,
+            }
+            for location_id in self.limited
+        }
+
+    def log_stats(self):
+        if self.enabled and self.limited:
+            logger.info(f"Scanner rate limiting: {self.stats()}")
+
+
+def make_alert(location_id, alert, detail):
+    return {
+        "id": location_id,
+        "alert": alert,
+        "timestamp": current_timestamp(),
+        "detail": detail,
+    }
@@ -0,0 +1,59 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import functools
+import hashlib
+
+
+@functools.lru_cache(maxsize=4096)
+def shard_for(key, shard_count):
+    """Picks the shard for a key (e.g. a location id) using rendezvous hashing.
+
+    The result is stable across processes and restarts (unlike hash()) and when the shard
+    count changes only the keys that belonged to added or removed shards move.
+    """
+    if shard_count <= 1:
+        return 0
+    return max(range(shard_count), key=lambda shard: shard_weight(key, shard))
+
+
+def shard_weight(key, shard):
+    digest = hashlib.blake2b(f"{shard}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def partition(mapping, part, part_count, down=()):
+    """Returns the entries of a mapping (e.g. the scanner map) whose keys belong to one part.
+
+    Every key belongs to exactly one part, so workers computing their own part independently
+    never overlap and between them cover the whole mapping. Parts listed in down own nothing -
+    each of their keys goes to the part ranked next for it, so no other key moves.
+    """
+    live = [other for other in range(part_count) if other not in down]
+    if not down or not live:
+        return {key: value for key, value in mapping.items() if shard_for(key, part_count) == part}
+    return {
+        key: value for key, value in mapping.items()
+        if max(live, key=lambda other: shard_weight(key, other)) == part
+    }
@@ -0,0 +1,266 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import base64
+import collections
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zmq
+
+logger = logging.getLogger("main.sinks")
+
+POLICIES = ("block", "drop_oldest", "drop_newest")
+OUTPUT_DIR = "/app/data/outputs"
+BINARY_RECORD = struct.Struct("<HI")  # topic length, payload length
+
+
+class Sink:
+    """Base for the service layer sinks. Outputs are queued by put() and written by the sink's
+    own thread a batch at a time, so a slow or disconnected sink doesn't hold up the others.
+
+    When the queue is full the policy decides what happens:
+    block - wait for space (which in turn holds up the blackboard through its link)
+    drop_oldest / drop_newest - discard outputs
+    Subclasses implement write_batch() and optionally open(), idle() and close().
+    """
+
+    default_policy = "block"
+    idle_timeout = 0.05  # longest wait for outputs before idle() is called
+
+    def __init__(self, name, sink_conf):
+        self.name = name
+        self.policy = sink_conf.get("policy", self.default_policy)
+        if self.policy not in POLICIES:
+            logger.error(f"Unknown policy {self.policy} for sink {name} - using {self.default_policy}")
+            self.policy = self.default_policy
+        self.queue_size = sink_conf.get("queue_size", 10000)
+        self.batch_size = sink_conf.get("batch_size", 500)
+
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=f"sink_{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """Stops the thread once the queue is written (or timeout seconds have passed)"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def put(self, topic, payload, meta):
+        with self.condition:
+            if len(self.queue) >= self.queue_size:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return
+                if self.policy == "drop_oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                while len(self.queue) >= self.queue_size and self.running:
+                    self.condition.wait(0.1)
+            self.queue.append((topic, payload, meta))
+            self.condition.notify_all()
+
+    def take_batch(self):
+        with self.condition:
+            if not self.queue and self.running:
+                self.condition.wait(self.idle_timeout)
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            self.condition.notify_all()  # there is space for a blocked put()
+            return batch
+
+    def run(self):
+        try:
+            self.open()
+        except Exception as e:  # keep taking outputs so that put() never blocks for good
+            logger.error(f"Unable to open sink {self.name}: {e}")
+        while self.running or self.queue:
+            batch = self.take_batch()
+            if batch:
+                try:
+                    self.write_batch(batch)
+                    self.written += len(batch)
+                    self.batches += 1
+                except Exception as e:
+                    logger.error(f"Sink {self.name} failed to write {len(batch)} outputs: {e}")
+                    self.errors += 1
+                    self.dropped += len(batch)
+            self.idle()
+        self.close()
+
+    def open(self):
+        pass
+
+    def write_batch(self, batch):
+        """batch - list of (topic, payload bytes, meta)"""
+        raise NotImplementedError
+
+    def idle(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "batches": self.batches,
+            "queued": len(self.queue),
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def log_stats(self):
+        if self.written or self.dropped:
+            logger.info(f"Sink {self.name} ({self.policy}): {self.stats()}")
+
+
+class FileSink(Sink):
+    """Appends outputs to local files, e.g. as an audit log that doesn't depend on the broker.
+
+    Each batch is one write and one fsync (group commit), so the cost of syncing is shared by the
+    outputs in the batch. Files are named <name>_<date>_<n> and rotated daily or at max_size MB.
+    format jsonl - a {"topic":..., "payload":...} line per output (a json payload is written as is,
+                   others are written base64 encoded as "payload_base64" along with "content_type")
+    format binary - <uint16 topic length> <uint32 payload length> <topic> <payload> per output
+    """
+
+    def __init__(self, name, sink_conf):
+        super().__init__(name, sink_conf)
+        self.directory = sink_conf.get("directory", OUTPUT_DIR)
+        self.format = sink_conf.get("format", "jsonl")
+        self.max_size = sink_conf.get("max_size", 64) * 1024 * 1024
+        self.fsync = sink_conf.get("fsync", True)
+        self.extension = "jsonl" if self.format == "jsonl" else "bin"
+        self.file = None
+        self.file_date = None
+        self.file_size = 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write_batch(self, batch):
+        encode = self.encode_jsonl if self.format == "jsonl" else self.encode_binary
+        data = b"".join(encode(topic, payload, meta) for topic, payload, meta in batch)
+        file = self.current_file(len(data))
+        file.write(data)
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+        self.file_size += len(data)
+
+    @staticmethod
+    def encode_jsonl(topic, payload, meta):
+        if "content_type" in meta:  # not json - can't be embedded
+            return json.dumps({
+                "topic": topic,
+                "content_type": meta["content_type"],
+                "payload_base64": base64.b64encode(payload).decode(),
+            }).encode() + b"\n"
+        return b'{"topic": ' + json.dumps(topic).encode() + b', "payload": ' + payload + b"}\n"
+
+    @staticmethod
+    def encode_binary(topic, payload, _meta):
+        encoded_topic = topic.encode()
+        return BINARY_RECORD.pack(len(encoded_topic), len(payload)) + encoded_topic + payload
+
+    def current_file(self, size):
+        date = time.strftime("%Y-%m-%d")
+        if (
+            self.file is None
+            or date != self.file_date
+            or (self.file_size > 0 and self.file_size + size > self.max_size)
+        ):
+            self.rotate(date)
+        return self.file
+
+    def rotate(self, date):
+        if self.file is not None:
+            self.file.close()
+        index = 0
+        while os.path.exists(self.file_path(date, index)):
+            index += 1
+        path = self.file_path(date, index)
+        logger.info(f"Sink {self.name} writing to {path}")
+        self.file = open(path, "ab")
+        self.file_date = date
+        self.file_size = 0
+
+    def file_path(self, date, index):
+        return os.path.join(self.directory, f"{self.name}_{date}_{index}.{self.extension}")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ZMQPubSink(Sink):
+    """Publishes outputs on a ZMQ PUB socket for co-located consumers, without a broker.
+
+    Each output is a [topic, payload] multipart message so subscribers can filter on topic prefix.
+    PUB never waits for slow subscribers, so outputs are dropped rather than held up by default.
+    """
+
+    default_policy = "drop_oldest"
+
+    def __init__(self, name, sink_conf, context=None):
+        super().__init__(name, sink_conf)
+        self.address = sink_conf.get("address", "tcp://127.0.0.1:4300")
+        self.hwm = sink_conf.get("hwm", 10000)
+        self.context = context if context is not None else zmq.Context.instance()
+        self.socket = None
+
+    def open(self):
+        # made in the sink's thread - zmq sockets must only be used by one thread
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, self.hwm)
+        self.socket.bind(self.address)
+        logger.info(f"Sink {self.name} publishing on {self.address}")
+
+    def write_batch(self, batch):
+        for topic, payload, _meta in batch:
+            self.socket.send_multipart([topic.encode(), payload])
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close(linger=1000)
+            self.socket = None
@@ -0,0 +1,81 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import collections
+
+
+class TopicAliases:
+    """Sender side MQTT v5 topic alias table.
+
+    A topic is given an alias the second time it is published (so one-off topics don't push out
+    busy ones) - that publish carries the topic and the alias, later ones only the alias. When all
+    the aliases the broker allows are in use, the least recently used one is reassigned.
+    Aliases only last for a connection, so reset() must be called on every (re)connect.
+    """
+
+    def __init__(self, maximum=0):
+        self.maximum = maximum
+        self.aliases = collections.OrderedDict()  # <topic>:<alias>, least recently used first
+        self.candidates = collections.OrderedDict()  # topics published once, bounded
+        self.free = []  # aliases given up by forget()
+        self.hits = 0
+
+    def reset(self, maximum):
+        self.maximum = maximum
+        self.aliases.clear()
+        self.candidates.clear()
+        self.free.clear()
+
+    def alias_for(self, topic):
+        """Returns (topic to send, alias or None) - the topic to send is "" once the broker knows the alias"""
+        if self.maximum <= 0:
+            return topic, None
+        alias = self.aliases.get(topic)
+        if alias is not None:
+            self.aliases.move_to_end(topic)
+            self.hits += 1
+            return "", alias
+
+        if topic not in self.candidates:
+            self.candidates[topic] = True
+            if len(self.candidates) > 4 * self.maximum:
+                self.candidates.popitem(last=False)
+            return topic, None
+
+        del self.candidates[topic]
+        if self.free:
+            alias = self.free.pop()
+        elif len(self.aliases) < self.maximum:
+            alias = len(self.aliases) + 1
+        else:
+            _old_topic, alias = self.aliases.popitem(last=False)
+        self.aliases[topic] = alias
+        return topic, alias
+
+    def forget(self, topic):
+        # the publish setting up an alias wasn't sent, so the broker doesn't know it
+        alias = self.aliases.pop(topic, None)
+        if alias is not None:
+            self.free.append(alias)
@@ -0,0 +1,72 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Size bounded LRU cache where entries can also expire a fixed time after they are stored.
+
+    Lookups and inserts are O(1). Expired entries are removed lazily - on lookup and from the
+    least recently used end when new entries are stored - so the cache never needs a sweep.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # <key>:(<expiry>,<value>)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expiry, value = entry
+        if expiry is not None and expiry <= self.clock():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        now = self.clock()
+        expiry = now + self.ttl if self.ttl else None
+        self.entries[key] = (expiry, value)
+        self.entries.move_to_end(key)
+        self.prune(now)
+
+    def prune(self, now):
+        while self.entries:
+            expiry, _value = next(iter(self.entries.values()))
+            if expiry is None or expiry > now:
+                break
+            self.entries.popitem(last=False)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
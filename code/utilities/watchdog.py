@@ -0,0 +1,115 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import logging
+import os
+import resource
+import time
+import tracemalloc
+
+from utilities.flight_recorder import DIAGNOSTICS_DIR
+
+logger = logging.getLogger("main.diagnostics")
+
+RECYCLE_EXIT_CODE = 75  # a block exiting with this asked to be restarted to release memory
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, in KiB on linux
+
+
+class MemoryWatchdog:
+    """Periodically logs a block's RSS and the sizes of its main structures.
+
+    When RSS has grown by `growth_threshold` MB since the block started (or since the last
+    report) tracemalloc is started and, at the next check, the allocations made in between are
+    written to /app/data/diagnostics. When RSS passes `recycle_rss` MB check() returns True and
+    the block should save its state and exit with RECYCLE_EXIT_CODE so main restarts it.
+    """
+
+    def __init__(self, block_name, config, clock=time.monotonic):
+        memory_conf = config.get("diagnostics", {}).get("memory", {})
+        self.block_name = block_name
+        self.interval = memory_conf.get("interval", 60)
+        self.growth_threshold = memory_conf.get("growth_threshold", 0) * 1024 * 1024  # 0 = off
+        self.recycle_rss = memory_conf.get("recycle_rss", 0) * 1024 * 1024  # 0 = off
+        self.directory = memory_conf.get("directory", DIAGNOSTICS_DIR)
+        self.clock = clock
+        self.next_check = clock() + self.interval
+        self.baseline = None
+        self.snapshot = None
+
+    def due(self):
+        return self.clock() >= self.next_check
+
+    def check(self, sizes):
+        """sizes - {<structure>:<number of entries>}. Returns True if the block should recycle"""
+        self.next_check = self.clock() + self.interval
+        rss = rss_bytes()
+        if self.baseline is None:
+            self.baseline = rss
+        logger.info(f"{self.block_name} memory: rss={rss / 1048576:.1f}MB {sizes}")
+
+        if self.snapshot is not None:
+            self.write_growth_report(sizes)
+            self.baseline = rss
+        elif self.growth_threshold and rss - self.baseline > self.growth_threshold:
+            logger.warning(
+                f"{self.block_name} grew by {(rss - self.baseline) / 1048576:.1f}MB - tracing allocations"
+            )
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.snapshot = tracemalloc.take_snapshot()
+
+        if self.recycle_rss and rss > self.recycle_rss:
+            logger.warning(
+                f"{self.block_name} rss {rss / 1048576:.1f}MB is over the {self.recycle_rss / 1048576:.0f}MB limit"
+                " - requesting a recycle"
+            )
+            return True
+        return False
+
+    def write_growth_report(self, sizes):
+        top = tracemalloc.take_snapshot().compare_to(self.snapshot, "lineno")
+        self.snapshot = None
+        tracemalloc.stop()
+        filename = os.path.join(
+            self.directory,
+            f"memory_{self.block_name}_{os.getpid()}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(filename, "w") as f:
+                f.write(f"sizes: {sizes}\n\n")
+                for stat in top[:50]:
+                    f.write(f"{stat}\n")
+        except OSError as e:
+            logger.error(f"Unable to write memory report {filename}: {e}")
+            return
+        logger.warning(f"Memory growth of {self.block_name} written to {filename}")
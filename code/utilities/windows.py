@@ -0,0 +1,181 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import time
+
+FUNCTIONS = ("count", "distinct", "rate", "last")
+
+
+class WindowedOutput:
+    """Per location aggregates of an output's triggers over a time window.
+
+    The window is split into `buckets` slots (1 for a tumbling window) held in a fixed size ring,
+    so memory per location is bounded and nothing needs recomputing when a slot expires. Windows are
+    aligned to the clock (e.g. a 3600s window closes on the hour) and a location's window is dropped
+    once it has been empty for a whole window.
+    """
+
+    def __init__(self, config, clock=time.time):
+        window = config.get("window", {})
+        self.length = window.get("length", 60)
+        self.buckets = window.get("buckets", 10) if window.get("type", "tumbling") == "sliding" else 1
+        self.slot_length = self.length / self.buckets
+        self.max_distinct = window.get("max_distinct", 1000)  # per slot - bounds the distinct sets
+        self.publish = config.get("publish", "close")
+
+        self.functions = config.get("aggregate", {})  # <payload key>:{"function":..,"variable":..}
+        for key, spec in self.functions.items():
+            if spec.get("function", "count") not in FUNCTIONS:
+                raise ValueError(f"Unknown aggregate function for {key}: {spec.get('function')}")
+            if spec.get("function") in ("distinct", "last") and "variable" not in spec:
+                raise ValueError(f"Aggregate {key} needs a variable")
+        self.variables = {spec["variable"] for spec in self.functions.values() if "variable" in spec}
+
+        self.clock = clock
+        self.windows = {}  # <location_id>:[<slot>] ring
+        self.last_published = {}  # <location_id>:<aggregates> when publishing on change
+        self.next_close = self.slot_end(self.clock())
+
+    def slot_id(self, now):
+        return int(now // self.slot_length)
+
+    def slot_end(self, now):
+        return (self.slot_id(now) + 1) * self.slot_length
+
+    def record(self, location_id, blackboard):
+        """Adds a triggering update - returns the aggregates if they should be published now"""
+        slot_id = self.slot_id(self.clock())
+        ring = self.windows.get(location_id)
+        if ring is None:
+            # one spare slot so the window that just ended is kept until close_due publishes it
+            ring = self.windows[location_id] = [None] * (self.buckets + 1)
+        index = slot_id % len(ring)
+        slot = ring[index]
+        if slot is None or slot["id"] != slot_id:  # reuse the expired slot
+            slot = ring[index] = {"id": slot_id, "count": 0, "distinct": {}, "last": {}}
+        slot["count"] += 1
+        for variable in self.variables:
+            value = blackboard.get(variable)
+            if value is None:
+                continue
+            distinct = slot["distinct"].setdefault(variable, set())
+            if len(distinct) < self.max_distinct:
+                distinct.add(freeze(value))
+            slot["last"][variable] = value
+
+        if self.publish != "change":
+            return None
+        aggregates = self.aggregate(ring, slot_id)
+        if aggregates == self.last_published.get(location_id):
+            return None
+        self.last_published[location_id] = aggregates
+        return aggregates
+
+    def close_due(self):
+        """Returns [(<location_id>,<aggregates>)] for the windows that closed since the last call"""
+        now = self.clock()
+        if now < self.next_close:
+            return []
+        self.next_close = self.slot_end(now)
+        closed_slot = self.slot_id(now) - 1
+
+        closed = []
+        for location_id, ring in list(self.windows.items()):
+            slot_ids = [slot["id"] for slot in ring if slot is not None]
+            if min(slot_ids) > closed_slot:  # only scanned since next_close - nothing has closed for it yet
+                continue
+            aggregates = self.aggregate(ring, closed_slot)
+            if max(slot_ids) <= closed_slot and not self.slots_in_window(ring, closed_slot):
+                # idle - publish the empty window once then drop
+                del self.windows[location_id]
+                self.last_published.pop(location_id, None)
+            if self.publish == "close":
+                closed.append((location_id, aggregates))
+        return closed
+
+    def save(self):
+        """The open windows as json - restore() carries them over to a restarted shard"""
+        return {
+            "slot_length": self.slot_length,
+            "buckets": self.buckets,
+            "next_close": self.next_close,
+            "windows": {
+                location_id: [
+                    None if slot is None else {
+                        **slot, "distinct": {variable: list(values) for variable, values in slot["distinct"].items()}
+                    }
+                    for slot in ring
+                ]
+                for location_id, ring in self.windows.items()
+            },
+            "last_published": self.last_published,
+        }
+
+    def restore(self, state):
+        """Loads the windows from save() - returns False if they were saved with different window settings"""
+        if (state.get("slot_length"), state.get("buckets")) != (self.slot_length, self.buckets):
+            return False
+        for location_id, ring in state.get("windows", {}).items():
+            self.windows[location_id] = [
+                None if slot is None else {
+                    **slot, "distinct": {variable: set(values) for variable, values in slot["distinct"].items()}
+                }
+                for slot in ring
+            ]
+        self.last_published.update(state.get("last_published", {}))
+        # a window that ended while the shard was down is closed on the next close_due()
+        self.next_close = min(self.next_close, state.get("next_close", self.next_close))
+        return True
+
+    def slots_in_window(self, ring, end_slot):
+        first = end_slot - self.buckets
+        return sorted(
+            (slot for slot in ring if slot is not None and first < slot["id"] <= end_slot),
+            key=lambda slot: slot["id"],
+        )
+
+    def aggregate(self, ring, end_slot):
+        slots = self.slots_in_window(ring, end_slot)
+        aggregates = {}
+        for key, spec in self.functions.items():
+            function = spec.get("function", "count")
+            variable = spec.get("variable")
+            if function == "count":
+                aggregates[key] = sum(slot["count"] for slot in slots)
+            elif function == "rate":  # per `per` seconds, default per minute
+                count = sum(slot["count"] for slot in slots)
+                aggregates[key] = count * spec.get("per", 60) / self.length
+            elif function == "distinct":
+                aggregates[key] = len(set().union(*(slot["distinct"].get(variable, ()) for slot in slots)))
+            elif function == "last":
+                aggregates[key] = next(
+                    (slot["last"][variable] for slot in reversed(slots) if variable in slot["last"]), None
+                )
+        return aggregates
+
+
+def freeze(value):
+    # values can be lists or tables (e.g. GS1 or API set values) - stored in the sets as strings
+    return json.dumps(value, sort_keys=True, default=str)
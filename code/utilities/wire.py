@@ -0,0 +1,52 @@
+#
+#   This file is part of Shoestring Barcode Scanning Service Module.
+#   Copyright (c) 2024 Shoestring and University of Cambridge
+#
+#   Authors:
+#   Greg Hawkridge <ghawkridge@gmail.com>
+#
+#   Shoestring Barcode Scanning Service Module is free software:
+#   you can redistribute it and/or modify it under the terms of the
+#   GNU General Public License as published by the Free Software
+#   Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Shoestring Barcode Scanning Service Module is distributed in
+#   the hope that it will be useful, but WITHOUT ANY WARRANTY;
+#   without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Shoestring Barcode Scanning Service Module.
+#   If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import json
+
+# Wire format between the interpretation and service layer blocks.
+# Each output is three frames of a multipart message (a batch of outputs is one message):
+#   topic   - utf8 topic
+#   meta    - json object with anything the service layer needs besides the topic, b"" if none
+#   payload - the payload, already encoded - published as is
+FRAMES_PER_OUTPUT = 3
+
+
+def pack(outputs):
+    """outputs - iterable of (topic, payload bytes, meta dict or None). Returns the frames"""
+    frames = []
+    for topic, payload, meta in outputs:
+        frames.append(topic.encode())
+        frames.append(json.dumps(meta).encode() if meta else b"")
+        frames.append(payload)
+    return frames
+
+
+def unpack(frames):
+    """Yields (topic, payload bytes, meta dict) for each output in a message"""
+    if len(frames) % FRAMES_PER_OUTPUT:
+        raise ValueError(f"Malformed message - {len(frames)} frames is not a whole number of outputs")
+    for index in range(0, len(frames), FRAMES_PER_OUTPUT):
+        topic, meta, payload = frames[index:index + FRAMES_PER_OUTPUT]
+        yield bytes(topic).decode(), payload, json.loads(meta) if meta else {}
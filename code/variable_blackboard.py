@@ -28,113 +28,801 @@ import json
 import re
 import chevron
 import importlib
+import time
+import os
+import collections
+import concurrent.futures
+import sys
+
+from utilities.links import connect_link, LinkSender
+from utilities import wire
+from utilities.ttl_cache import TTLCache
+from utilities.gs1 import parse_gs1, GROUP_SEPARATOR
+from utilities.windows import WindowedOutput
+from utilities.sharding import shard_for
+from utilities.flight_recorder import FlightRecorder, dump_on_crash
+from utilities.profiler import SamplingProfiler
+from utilities.watchdog import MemoryWatchdog, RECYCLE_EXIT_CODE
+from utilities.history import HistoryStore
+from utilities.encodings import make_encoder, CONTENT_TYPES, DEFAULT_ENCODING
 
 context = zmq.Context()
 logger = logging.getLogger("main.interpretation")
 
+STATE_DIR = "/app/data/state"  # blackboard state is saved here when a shard recycles
+
+NOT_CACHED = object()
+
 
 class Blackboard(multiprocessing.Process):
-    def __init__(self, config, zmq_conf):
+    def __init__(self, config, zmq_conf, config_watcher=None, shard=0):
         super().__init__()
 
+        self.shard = shard  # locations are split between shards by utilities.sharding.shard_for
+        self.shard_count = config.get("blackboard", {}).get("shards", 1)
+        self.flight_recorder = FlightRecorder(f"blackboard_{shard}", config)
+        self.profiler = SamplingProfiler(f"blackboard_{shard}", config)
+        self.memory_watchdog = MemoryWatchdog(f"blackboard_{shard}", config)
+        self.state_file = os.path.join(STATE_DIR, f"blackboard_{shard}.json")
+        # set by main once the blocks before this one have stopped - exit when everything is passed on
+        self.drain_requested = multiprocessing.Event()
+
+        # least recently scanned locations are dropped beyond this
+        self.max_locations = config.get("blackboard", {}).get("max_locations", 10000)
+        self.evicted_locations = 0
+
+        # optional searchable record of the scans - written by its own thread
+        history_conf = config.get("blackboard", {}).get("history", {})
+        self.history = HistoryStore(history_conf, shard) if history_conf.get("enabled", False) else None
+
+        self._blackboard = {}  # <location_id>:{<variable>:<current value>}
+        self.trigger_tracking = {}
+        self.processes = {}
+        self.hook_caches = {}  # <process_name>:{"cache":TTLCache,"hits":<n>,"misses":<n>}
+        self.outputs = {}
+        self.windowed_outputs = {}  # <output_name>:WindowedOutput for outputs with type = aggregate
+        self.apply_config(config)
+
+        self.singles_to_clear = set()
+
+        reload_conf = config.get("blackboard", {}).get("reload", {})
+        self.config_watcher = (
+            config_watcher if reload_conf.get("enabled", True) else None
+        )
+        self.reload_interval = reload_conf.get("interval", 5)
+        self.next_reload_check = 0
+
+        self.stats_interval = config.get("blackboard", {}).get("stats_interval", 60)
+        # alerts from ingestion e.g. when a runaway scanner is quarantined
+        self.alert_topic = (
+            config.get("input", {}).get("rate_limit", {}).get("alert_topic", "{{location_id}}/alerts/scanner")
+        )
+        self.next_stats = 0
+
+        # max messages processed per wakeup, their outputs are sent together
+        self.batch_size = config.get("blackboard", {}).get("batch", {}).get("max_messages", 1)
+        self.batch_stats = {
+            "batches": 0,
+            "messages": 0,
+            "outputs": 0,
+            "busy_time": 0.0,
+            "largest_batch": 0,
+        }
+
+        # hooks with execution = thread | process run in pools so they don't hold up other locations
+        self.hook_conf = config.get("blackboard", {}).get("hooks", {})
+        self.thread_pool = None
+        self.process_pool = None
+        self.jobs_in_pool = []
+        self.hung_hooks = []  # timed out hooks still occupying a pool worker
+        self.waiting_messages = {}  # <location_id>:deque of messages waiting for a hook to finish
+        self.wakeup_read = None
+        self.wakeup_write = None
+
+        self.zmq_conf = zmq_conf
+        self.zmq_in = None
+        self.zmq_out = None
+        self.sender = None
+        self.poller = None
+        self.zmq_api = None  # optional REP socket for state queries
+
+    def apply_config(self, config):
+        # build everything before touching self so that a bad config leaves the running one intact
         # <variable>: single | retain | static
         # single | retain | static : [<variable>]
         # <variable>:<pattern>
         # <variable>:<current value>
-        self.variable_fmap, self.variable_rmap, self.patterns, self._base_blackboard = (
+        variable_fmap, variable_rmap, patterns, base_blackboard = (
             process_variable_config(config["variable"])
         )
-        self._blackboard = {}
-        self.variable_rmap["single"].append("timestamp")  # always a single use
-
-        self.process_package = config["processing"].get("directory", None)
-        self.process_for_variable = reverse_map_processing(
-            config["processing"].get("process", {})
+        variable_rmap["single"].append("timestamp")  # always a single use
+        gs1_variables = map_gs1_variables(config["variable"])  # <AI>:[<variable>]
+        gs1_separators = tuple(
+            config.get("blackboard", {}).get("gs1", {}).get("separators", [GROUP_SEPARATOR])
         )
-        self.processes = config["processing"].get(
+
+        process_package = config["processing"].get("directory", None)
+        processes = config["processing"].get(
             "process", {}
-        )  # <variable>: [<functions>]
+        )  # <process_name>: <process details>
+        process_for_variable = reverse_map_processing(processes)  # <variable>: [<process_name>]
+        # process outputs can be the input of other processes - refuse configs where they form a cycle
+        process_order = order_processes(processes, process_for_variable)
+        downstream_processes = map_downstream_processes(
+            processes, process_for_variable, process_order
+        )  # <variable>: [<process_name>] in the order they run
+        process_position = {name: index for index, name in enumerate(process_order)}
         # Todo: run hooks after initial blackboard setup
+        # caches survive a reload if their process is unchanged
+        hook_caches = {
+            name: (
+                self.hook_caches[name]
+                if name in self.hook_caches and self.processes.get(name) == details
+                else make_hook_cache(details["cache"])
+            )
+            for name, details in processes.items()
+            if "cache" in details
+        }
 
-        self.triggered_by_variable = reverse_map_triggers(
+        triggered_by_variable = reverse_map_triggers(
             config["output"]
         )  # <variable>:[output_name]
-        self.outputs = {
+        outputs = {
             item["name"]: item for item in config["output"]
         }  # <output_name>:<output>
-        self.trigger_tracking = {item["name"]: set() for item in config["output"]}
+        trigger_tracking = {
+            name: self.trigger_tracking.get(name, set()).intersection(
+                output.get("triggers", [])
+            )
+            for name, output in outputs.items()
+        }
+        # payload encoders are made once per encoding in use - json unless the output picks another
+        encodings = {output.get("encoding", DEFAULT_ENCODING) for output in outputs.values()}
+        encoders = {encoding: make_encoder(encoding) for encoding in encodings | {DEFAULT_ENCODING}}
+        # windows survive a reload if their output is unchanged
+        windowed_outputs = {
+            name: (
+                self.windowed_outputs[name]
+                if name in self.windowed_outputs and self.outputs.get(name) == output
+                else WindowedOutput(output)
+            )
+            for name, output in outputs.items()
+            if output.get("type") == "aggregate"
+        }
 
-        self.singles_to_clear = set()
+        known_variables = set(variable_fmap.keys())
+        known_variables.update(["timestamp", "location_id"])
+        for process_details in processes.values():
+            known_variables.update(process_details.get("output_as", []))
 
-        self.zmq_conf = zmq_conf
-        self.zmq_in = None
-        self.zmq_out = None
+        blackboards = {
+            location_id: migrate_blackboard(
+                old_blackboard, base_blackboard, variable_fmap, known_variables
+            )
+            for location_id, old_blackboard in self._blackboard.items()
+        }
+
+        # swap in
+        self.variable_fmap = variable_fmap
+        self.known_variables = known_variables
+        self.variable_rmap = variable_rmap
+        self.patterns = patterns
+        self.gs1_variables = gs1_variables
+        self.gs1_separators = gs1_separators
+        self._base_blackboard = base_blackboard
+        self.process_package = process_package
+        self.processes = processes
+        self.process_for_variable = process_for_variable
+        self.downstream_processes = downstream_processes
+        self.process_position = process_position
+        self.hook_caches = hook_caches
+        self.triggered_by_variable = triggered_by_variable
+        self.outputs = outputs
+        self.encoders = encoders
+        self.windowed_outputs = windowed_outputs
+        self.trigger_tracking = trigger_tracking
+        self._blackboard = blackboards
 
-    def blackboard(self,key):
-        if key not in self._blackboard:
-            self._blackboard[key] = self._base_blackboard
-        return self._blackboard
+    def check_reload(self):
+        if self.config_watcher is None:
+            return
+        now = time.monotonic()
+        if now < self.next_reload_check:
+            return
+        self.next_reload_check = now + self.reload_interval
+
+        new_config = self.config_watcher.check()
+        if new_config is None:
+            return
+        try:
+            self.apply_config(new_config)
+            logger.info("Applied reloaded config")
+            self.flight_recorder.record("reload", True)
+        except Exception as e:
+            self.flight_recorder.record("reload", False, repr(e))
+            logger.error(f"Reloaded config could not be applied - keeping current config: {e}")
+
+    def blackboard(self, key):
+        # re-inserted on every use so the least recently used location is always first
+        board = self._blackboard.pop(key, None)
+        if board is None:
+            board = dict(self._base_blackboard)
+        self._blackboard[key] = board
+        if len(self._blackboard) > self.max_locations:
+            self.evict_location()
+        return board
+
+    def evict_location(self):
+        busy = set(self.waiting_messages)  # locations with a hook running in a pool
+        for location_id in self._blackboard:
+            if location_id not in busy:
+                del self._blackboard[location_id]
+                self.evicted_locations += 1
+                logger.debug(f"Dropped state of location {location_id} - over max_locations")
+                return
 
     def do_connect(self):
-        self.zmq_in = context.socket(self.zmq_conf["in"]["type"])
-        if self.zmq_conf["in"]["bind"]:
-            self.zmq_in.bind(self.zmq_conf["in"]["address"])
-        else:
-            self.zmq_in.connect(self.zmq_conf["in"]["address"])
+        self.zmq_in = connect_link(context, self.zmq_conf["in"])
+        self.zmq_out = connect_link(context, self.zmq_conf["out"])
+        self.sender = LinkSender(
+            self.zmq_out, self.zmq_conf["out"], f"{self.zmq_conf['out']['name']}_{self.shard}"
+        )
 
-        self.zmq_out = context.socket(self.zmq_conf["out"]["type"])
-        if self.zmq_conf["out"]["bind"]:
-            self.zmq_out.bind(self.zmq_conf["out"]["address"])
-        else:
-            self.zmq_out.connect(self.zmq_conf["out"]["address"])
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.poller = zmq.Poller()
+        self.poller.register(self.zmq_in, zmq.POLLIN)
+        self.poller.register(self.wakeup_read, zmq.POLLIN)
+        if "api" in self.zmq_conf:
+            self.zmq_api = connect_link(context, self.zmq_conf["api"])
+            self.poller.register(self.zmq_api, zmq.POLLIN)
 
+    @dump_on_crash
     def run(self):
+        self.profiler.install()
         self.do_connect()
-        logger.info("connected")
+        self.load_state()
+        if self.history is not None:
+            self.history.start()
+        logger.info(f"shard {self.shard} connected")
         while True:
-            # get barcode
-            msg = self.get_input_message()
-            try:
-                id = msg["id"]
-                blackboard = self.blackboard(id)
-                blackboard["location_id"] = id
-                
-                barcode = msg["barcode"]
-                timestamp = msg["timestamp"]
-                blackboard["timestamp"] = timestamp
-            except KeyError:
-                logger.warning(f"Message did not not have required keys: {msg}")
+            self.check_reload()
+            self.housekeeping()
+            # get barcodes - everything queued up to the batch limit
+            messages = self.get_input_messages()
+            start = time.monotonic()
+            outputs = []
+            # finish messages whose hooks ran in a pool
+            completed = self.collect_completed_hooks(outputs)
+            self.close_windows(outputs)
+            for msg in messages:
+                self.handle_message(msg, outputs)
+            if not messages and not completed and not outputs:
+                if self.drain_requested.is_set() and self.is_drained():
+                    self.finish()
+                    return
                 continue
-            # extract variable
-            variable, value = self.extract_variable(barcode)
-            # apply to Blackboard
-            blackboard[variable] = value
-            # process hooks
-            new_vars = self.process_hooks(variable, value)
-            blackboard.update(new_vars)
-            # evaluate triggers
-            triggered_set = []
-            updated_vars = list(new_vars.keys())
-            updated_vars.append(variable)
-            for var in updated_vars:
-                triggered_set.extend(self.get_triggered(var))
-            # form outputs
-            outputs = self.get_outputs(triggered_set, blackboard)
-            # clear single use
-            self.clear_singles(blackboard)
             # dispatch outputs
             self.dispatch(outputs)
+            self.record_batch(len(messages), len(outputs), time.monotonic() - start)
 
-    def get_input_message(self):
-        while self.zmq_in.poll(1000, zmq.POLLIN) == 0:  # blocks until a message arrives
-            pass
+    def handle_message(self, msg, outputs, inline_only=False):
+        # messages for a location wait while an earlier one from that location is in a hook pool
+        location_id = msg.get("id")
+        self.flight_recorder.record("in", location_id, msg.get("barcode"))
+        if "alert" in msg:  # not a scan - sent on straight away
+            outputs.append(self.form_alert(msg))
+            return
+        if self.history is not None:
+            self.history.record(location_id, msg.get("barcode"), msg.get("timestamp"))
+        if location_id in self.waiting_messages:
+            self.waiting_messages[location_id].append(msg)
+            return
+        job = self.begin_message(msg)
+        if job is None:
+            return
+        if not self.advance_job(job, outputs, inline_only):
+            self.waiting_messages[location_id] = collections.deque()
+
+    def process_message(self, msg):
+        """Processes a message to completion, running all hooks inline - returns the outputs"""
+        outputs = []
+        job = self.begin_message(msg)
+        if job is not None:
+            self.advance_job(job, outputs, inline_only=True)
+        return outputs
+
+    def begin_message(self, msg):
+        try:
+            id = msg["id"]
+            blackboard = self.blackboard(id)
+            blackboard["location_id"] = id
+
+            barcode = msg["barcode"]
+            timestamp = msg["timestamp"]
+            blackboard["timestamp"] = timestamp
+        except KeyError:
+            logger.warning(f"Message did not not have required keys: {msg}")
+            return None
+        # extract variables - usually one, several for a GS1 barcode
+        scanned = []
+        for variable, value in self.extract_variables(barcode):
+            # apply to Blackboard
+            blackboard[variable] = value
+            scanned.append(variable)
+        return self.new_job(id, blackboard, scanned)
+
+    def new_job(self, location_id, blackboard, scanned):
+        return {
+            "location_id": location_id,
+            "blackboard": blackboard,
+            "scanned": scanned,
+            "remaining": self.processes_for_update(scanned),  # hooks still to run
+            "new_vars": {},
+            "changed": [],  # derived variables whose value changed
+        }
+
+    def processes_for_update(self, variables):
+        if len(variables) == 1:
+            return list(self.downstream_processes.get(variables[0], []))
+        affected = set()
+        for variable in variables:
+            affected.update(self.downstream_processes.get(variable, []))
+        return sorted(affected, key=self.process_position.get)
+
+    def advance_job(self, job, outputs, inline_only=False):
+        """Runs the job's remaining hooks and then forms its outputs.
+        Returns False if the job is waiting on a hook running in a pool"""
+        if not self.run_hooks(job, inline_only):
+            return False
+
+        blackboard = job["blackboard"]
+        blackboard.update(job["new_vars"])
+        # evaluate triggers - derived variables only trigger if their value changed
+        triggered_set = []
+        updated_vars = job["changed"] + job["scanned"]
+        for var in updated_vars:
+            triggered_set.extend(self.get_triggered(var))
+        # form outputs
+        outputs.extend(self.get_outputs(triggered_set, blackboard))
+        # clear single use
+        self.clear_singles(blackboard)
+        return True
+
+    def run_hooks(self, job, inline_only=False):
+        """Runs the job's remaining hooks - returns False if it is waiting on a hook running in a pool"""
+        while job["remaining"]:
+            process_name = job["remaining"].pop(0)
+            process_details = self.processes[process_name]
+            var_name = process_details["apply_to"]
+            if var_name not in job["scanned"] and var_name not in job["changed"]:
+                continue  # input unchanged so the current result still stands
+            var_value = self.job_value(job, var_name)
+            execution = process_details.get("execution", "inline")
+            if execution == "inline" or inline_only:
+                self.update_job(job, self.run_process(process_name, var_name, var_value))
+            else:
+                result = self.cache_get(process_name, var_name, var_value)
+                if result is not NOT_CACHED:
+                    self.update_job(
+                        job, map_outputs(process_details.get("output_as", []), result)
+                    )
+                    continue
+                self.submit_process(job, process_name, execution, var_name, var_value)
+                return False
+        return True
+
+    def job_value(self, job, var_name):
+        if var_name in job["new_vars"]:
+            return job["new_vars"][var_name]
+        return job["blackboard"].get(var_name)
+
+    def update_job(self, job, new_vars):
+        for var_name, value in new_vars.items():
+            if value != self.job_value(job, var_name) and var_name not in job["changed"]:
+                job["changed"].append(var_name)
+            job["new_vars"][var_name] = value
+
+    def submit_process(self, job, process_name, execution, var_name, var_value):
+        self.flight_recorder.record("hook_submit", process_name, var_name, execution)
+        process_details = self.processes[process_name]
+        if execution == "process":
+            if self.process_pool is None:
+                self.process_pool = concurrent.futures.ProcessPoolExecutor(self.hook_conf.get("processes", 2))
+            executor = self.process_pool
+        else:
+            if self.thread_pool is None:
+                self.thread_pool = concurrent.futures.ThreadPoolExecutor(self.hook_conf.get("threads", 4))
+            executor = self.thread_pool
+
+        job["pending"] = {
+            "process_name": process_name,
+            "input": (var_name, var_value),
+            "details": process_details,  # kept in case the config is reloaded meanwhile
+            "call": (
+                self.process_package,
+                process_details.get("module", None),
+                var_name,
+                var_value,
+                process_details.get("extra_args", []),
+            ),
+        }
+        self.start_hook(job["pending"], executor)
+        self.jobs_in_pool.append(job)
+
+    def start_hook(self, pending, executor):
+        timeout = pending["details"].get("timeout", 5)
+        pending["pool"] = executor
+        pending["future"] = executor.submit(call_hook, *pending["call"])
+        pending["deadline"] = time.monotonic() + timeout if timeout else None
+        pending["future"].add_done_callback(self.wake)
+
+    def wake(self, _future):
+        # called from the pool's thread - interrupts the poll in get_input_messages
         try:
-            msg = self.zmq_in.recv(zmq.NOBLOCK)
-            logger.debug(f"got {msg}")
-            return json.loads(msg)
-        except zmq.ZMQError:
+            os.write(self.wakeup_write, b"\0")
+        except BlockingIOError:
+            pass  # already pending
+
+    def collect_completed_hooks(self, outputs):
+        if not self.jobs_in_pool:
+            return False
+        try:
+            os.read(self.wakeup_read, 4096)
+        except BlockingIOError:
             pass
-        return {}
+
+        now = time.monotonic()
+        completed = []
+        for job in self.jobs_in_pool:
+            pending = job["pending"]
+            future = pending["future"]
+            process_name = pending["process_name"]
+            process_details = pending["details"]
+            var_name, var_value = pending["input"]
+            if future.done():
+                try:
+                    result = future.result()
+                    self.flight_recorder.record("hook_done", process_name, var_name)
+                    self.log_result(process_name, var_name, result)
+                    if self.processes.get(process_name) == process_details:  # not changed by a reload
+                        self.cache_put(process_name, var_name, var_value, result)
+                except Exception as e:
+                    self.flight_recorder.record("hook_error", process_name, var_name, repr(e))
+                    logger.error(f"Processing {process_name} for {var_name} lead to exception {e}")
+                    result = process_details.get("fallback", [])
+            elif pending["deadline"] is not None and now >= pending["deadline"]:
+                self.flight_recorder.record("hook_timeout", process_name, var_name)
+                if future.cancel():
+                    logger.warning(f"Processing {process_name} for {var_name} timed out - using fallback")
+                else:  # already running - the worker stays busy until the hook returns
+                    self.hung_hooks.append(pending)
+                    logger.warning(
+                        f"Processing {process_name} for {var_name} timed out - using fallback, "
+                        f"{len(self.hung_hooks)} pool workers are stuck in timed out hooks"
+                    )
+                result = process_details.get("fallback", [])
+            else:
+                continue
+            self.update_job(job, map_outputs(process_details.get("output_as", []), result))
+            completed.append(job)
+
+        for job in completed:
+            self.jobs_in_pool.remove(job)
+            # the board is replaced if the config was reloaded while the hook ran
+            job["blackboard"] = self.blackboard(job["location_id"])
+            job["blackboard"]["location_id"] = job["location_id"]
+            if self.advance_job(job, outputs):
+                self.release_location(job["location_id"], outputs)
+        if self.hung_hooks:
+            self.replace_stuck_pools()
+        return len(completed) > 0
+
+    def replace_stuck_pools(self):
+        """A running hook can't be stopped, so once every worker of a pool is stuck in a timed out hook
+        the pool is abandoned and the hooks queued on it moved to a new one"""
+        self.hung_hooks = [pending for pending in self.hung_hooks if not pending["future"].done()]
+        for name, size in [("thread_pool", self.hook_conf.get("threads", 4)),
+                           ("process_pool", self.hook_conf.get("processes", 2))]:
+            pool = getattr(self, name)
+            if pool is None or sum(pending["pool"] is pool for pending in self.hung_hooks) < size:
+                continue
+            logger.error(f"All {size} workers of the hook {name} are stuck in timed out hooks - replacing it")
+            self.flight_recorder.record("hook_pool_replaced", name)
+            setattr(self, name, None)
+            pool.shutdown(wait=False)
+            queued = [
+                job["pending"] for job in self.jobs_in_pool
+                if job["pending"]["pool"] is pool and job["pending"]["future"].cancel()
+            ]
+            if queued:
+                if name == "thread_pool":
+                    self.thread_pool = concurrent.futures.ThreadPoolExecutor(size)
+                else:
+                    self.process_pool = concurrent.futures.ProcessPoolExecutor(size)
+                for pending in queued:
+                    self.start_hook(pending, getattr(self, name))
+
+    def release_location(self, location_id, outputs):
+        waiting = self.waiting_messages.pop(location_id, collections.deque())
+        while waiting:
+            self.handle_message(waiting.popleft(), outputs)
+            if location_id in self.waiting_messages:  # waiting on a hook again
+                self.waiting_messages[location_id].extend(waiting)
+                return
+
+    def next_hook_deadline(self):
+        deadlines = [
+            job["pending"]["deadline"]
+            for job in self.jobs_in_pool
+            if job["pending"]["deadline"] is not None
+        ]
+        return min(deadlines) if deadlines else None
+
+    def close_windows(self, outputs):
+        for name, windowed_output in self.windowed_outputs.items():
+            for location_id, aggregates in windowed_output.close_due():
+                # read only - closing a window is not a use of the location, so the LRU order is kept
+                board = self._blackboard.get(location_id, self._base_blackboard)
+                outputs.append(self.form_output(name, board, aggregates))
+        self.singles_to_clear.clear()  # not cleared by window outputs
+
+    def record_batch(self, message_count, output_count, duration):
+        stats = self.batch_stats
+        stats["batches"] += 1
+        stats["messages"] += message_count
+        stats["outputs"] += output_count
+        stats["busy_time"] += duration
+        stats["largest_batch"] = max(stats["largest_batch"], message_count)
+        self.flight_recorder.record("batch", message_count, output_count, duration)
+        self.flight_recorder.check_latency("batch", duration)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Processed {message_count} messages into {output_count} outputs in {duration * 1000:.2f}ms"
+            )
+
+    def housekeeping(self):
+        if self.sender.pending:
+            self.sender.flush()
+        # not while hooks are running - their messages would be lost by a recycle
+        if self.memory_watchdog.due() and not self.jobs_in_pool:
+            if self.memory_watchdog.check(self.structure_sizes()):
+                self.recycle()
+        now = time.monotonic()
+        if now >= self.next_stats:
+            self.next_stats = now + self.stats_interval
+            if self.batch_stats["batches"]:
+                logger.info(f"Shard {self.shard} processing: {self.batch_stats}")
+            self.sender.log_stats()
+            if self.history is not None:
+                self.history.log_stats()
+            for process_name, entry in self.hook_caches.items():
+                logger.info(
+                    f"Process {process_name} cache: {entry['hits']} hits, {entry['misses']} misses, "
+                    f"{len(entry['cache'])} entries"
+                )
+
+    def structure_sizes(self):
+        return {
+            "locations": len(self._blackboard),
+            "evicted_locations": self.evicted_locations,
+            "waiting_messages": sum(len(waiting) for waiting in self.waiting_messages.values()),
+            "hung_hooks": len(self.hung_hooks),
+            "cached_results": sum(len(entry["cache"]) for entry in self.hook_caches.values()),
+            "window_locations": sum(len(output.windows) for output in self.windowed_outputs.values()),
+            "queued_outputs": len(self.sender.queue),
+            "queued_history": len(self.history.queue) if self.history is not None else 0,
+        }
+
+    def is_drained(self):
+        return not self.jobs_in_pool and not self.waiting_messages and not self.sender.pending
+
+    def finish(self):
+        for pool in [self.thread_pool, self.process_pool]:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        if self.history is not None:
+            self.history.stop()
+        logger.info(f"Shard {self.shard} finished - all its outputs are sent")
+
+    def recycle(self):
+        """Saves the state and exits so that main restarts the shard with fresh memory"""
+        self.drain_input()
+        self.save_state()
+        deadline = time.monotonic() + 5
+        while not self.sender.flush() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for pool in [self.thread_pool, self.process_pool]:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        if self.history is not None:
+            self.history.stop()
+        logger.warning(f"Shard {self.shard} recycling to release memory")
+        sys.exit(RECYCLE_EXIT_CODE)
+
+    def drain_input(self):
+        """Processes the messages already queued on the input, running hooks inline, so that none
+        are lost when the shard exits"""
+        outputs = []
+        count = 0
+        while True:
+            try:
+                msg = self.zmq_in.recv(zmq.NOBLOCK)
+            except zmq.ZMQError:  # drained
+                break
+            try:
+                msg = json.loads(msg)
+            except ValueError:
+                logger.warning(f"Received message that was not valid json: {msg}")
+                continue
+            self.handle_message(msg, outputs, inline_only=True)
+            count += 1
+        self.dispatch(outputs)
+        if count:
+            logger.info(f"Processed {count} queued messages before exiting")
+
+    def save_state(self):
+        state = {
+            "blackboard": self._blackboard,
+            "trigger_tracking": {name: sorted(seen) for name, seen in self.trigger_tracking.items()},
+            "windows": {name: output.save() for name, output in self.windowed_outputs.items()},
+        }
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            with open(f"{self.state_file}.tmp", "w") as f:
+                json.dump(state, f, default=str)
+            os.replace(f"{self.state_file}.tmp", self.state_file)
+        except OSError as e:
+            logger.error(f"Unable to save state to {self.state_file}: {e}")
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            os.remove(self.state_file)  # only restored once
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Unable to load saved state from {self.state_file}: {e}")
+            return
+        # the config may have been changed since it was saved
+        for location_id, old_blackboard in state.get("blackboard", {}).items():
+            self._blackboard[location_id] = migrate_blackboard(
+                old_blackboard, self._base_blackboard, self.variable_fmap, self.known_variables
+            )
+        for name, seen in state.get("trigger_tracking", {}).items():
+            if name in self.trigger_tracking:
+                self.trigger_tracking[name].update(
+                    set(seen).intersection(self.outputs[name].get("triggers", []))
+                )
+        for name, saved in state.get("windows", {}).items():
+            if name in self.windowed_outputs and not self.windowed_outputs[name].restore(saved):
+                logger.warning(f"Window settings of output {name} changed - its open windows were not restored")
+        logger.info(f"Restored state of {len(state.get('blackboard', {}))} locations")
+
+    def get_input_messages(self):
+        timeout = 50 if self.sender.pending else 1000  # retry queued outputs promptly
+        deadline = self.next_hook_deadline()
+        if deadline is not None:
+            timeout = max(0, min(timeout, int((deadline - time.monotonic()) * 1000) + 1))
+        for windowed_output in self.windowed_outputs.values():  # windows close on wall clock time
+            timeout = max(0, min(timeout, int((windowed_output.next_close - time.time()) * 1000) + 1))
+        events = dict(self.poller.poll(timeout))
+        if self.zmq_api in events:  # served between batches so never concurrent with processing
+            self.handle_requests()
+        if self.zmq_in not in events:  # no message - return so that housekeeping can run
+            return []
+        messages = []
+        while len(messages) < self.batch_size:
+            try:
+                msg = self.zmq_in.recv(zmq.NOBLOCK)
+            except zmq.ZMQError:  # drained
+                break
+            try:
+                messages.append(json.loads(msg))
+            except ValueError:
+                logger.warning(f"Received message that was not valid json: {msg}")
+        return messages
+
+    def handle_requests(self):
+        while True:
+            try:
+                request = self.zmq_api.recv(zmq.NOBLOCK)
+            except zmq.ZMQError:  # drained
+                return
+            reply = self.handle_request(request)
+            self.zmq_api.send(json.dumps(reply, default=str).encode())
+
+    def handle_request(self, request):
+        self.flight_recorder.record("api", request)
+        commands = {
+            "get": self.api_get,
+            "list": self.api_list,
+            "triggers": self.api_triggers,
+            "set": self.api_set,
+            "profile": self.api_profile,
+            "history": self.api_history,
+        }
+        try:
+            request = json.loads(request)
+            command = commands.get(request.get("command"))
+            if command is None:
+                raise ValueError(f"Unknown command, expected one of {list(commands)}")
+            return {"ok": True, "result": command(request)}
+        except (ValueError, AttributeError, TypeError, KeyError) as e:
+            logger.warning(f"Refused API request {request}: {e}")
+            return {"ok": False, "error": str(e)}
+
+    def api_get(self, request):
+        location_id = request.get("location")
+        self.check_location_shard(location_id)
+        if location_id not in self._blackboard:
+            raise ValueError(f"No scans yet from location {location_id}")
+        return dict(self._blackboard[location_id])
+
+    def api_list(self, _request):
+        return {location_id: dict(blackboard) for location_id, blackboard in self._blackboard.items()}
+
+    def api_triggers(self, _request):
+        return {
+            name: {
+                "triggers": output.get("triggers", []),
+                "trigger_policy": output.get("trigger_policy", "any"),
+                "seen": sorted(self.trigger_tracking.get(name, [])),
+            }
+            for name, output in self.outputs.items()
+        }
+
+    def api_set(self, request):
+        location_id = request.get("location")
+        variable = request.get("variable")
+        if variable not in self.variable_rmap["retain"] and variable not in self.variable_rmap["static"]:
+            raise ValueError(f"Only retained and static variables can be set - not {variable}")
+        self.check_location_shard(location_id)
+        if location_id in self.waiting_messages:
+            # its derived variables are about to be replaced by the pooled hook's results
+            raise ValueError(f"Location {location_id} is processing a scan - try again")
+        blackboard = self.blackboard(location_id)
+        blackboard["location_id"] = location_id
+        blackboard[variable] = request.get("value")
+        # derived variables are brought up to date, hooks run in this request even if pooled
+        job = self.new_job(location_id, blackboard, [variable])
+        self.run_hooks(job, inline_only=True)
+        blackboard.update(job["new_vars"])
+        logger.info(f"Set {variable}={request.get('value')} for {location_id} via API")
+        return dict(blackboard)
+
+    def api_profile(self, request):
+        duration = request.get("duration")
+        if duration is not None and (isinstance(duration, bool) or not isinstance(duration, (int, float))
+                                     or not duration > 0):
+            raise ValueError("duration must be a positive number of seconds")
+        prefix = self.profiler.start(duration, request.get("tracemalloc"))
+        if prefix is None:
+            raise ValueError("A profile is already running")
+        return {"files": prefix}
+
+    def api_history(self, request):
+        if self.history is None:
+            raise ValueError("Scan history is not enabled")
+        location_id = request.get("location")
+        if location_id is not None:
+            self.check_location_shard(location_id)
+        barcode = request.get("barcode")
+        if barcode is not None and not isinstance(barcode, str):
+            raise ValueError("barcode must be a string")
+        limit = request.get("limit", 100)
+        if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+            raise ValueError("limit must be a positive integer")
+        return self.history.query(barcode, location_id, request.get("start"), request.get("end"), limit)
+
+    def check_location_shard(self, location_id):
+        if not isinstance(location_id, str):
+            raise ValueError("Request needs a location")
+        shard = shard_for(location_id, self.shard_count)
+        if shard != self.shard:
+            raise ValueError(f"Location {location_id} is handled by shard {shard}")
 
     def extract_variable(self, barcode):
         found_variable = None
@@ -148,11 +836,36 @@ class Blackboard(multiprocessing.Process):
         logger.debug(f"Extracted {found_variable}={value}")
         return found_variable, value
 
+    def extract_variables(self, barcode):
+        """Returns [(<variable>,<value>)] - from the first matching pattern or,
+        if none match, from the GS1 elements of the barcode"""
+        variable, value = self.extract_variable(barcode)
+        if variable is None and self.gs1_variables:
+            found = self.extract_gs1_variables(barcode)
+            if found:
+                return found
+        return [(variable, value)]
+
+    def extract_gs1_variables(self, barcode):
+        try:
+            elements = parse_gs1(barcode, self.gs1_separators)
+        except ValueError as e:
+            logger.debug(f"Barcode {barcode} is not GS1: {e}")
+            return []
+        found = []
+        for ai, value in elements.items():
+            for variable in self.gs1_variables.get(ai, []):
+                found.append((variable, value))
+        logger.debug(f"Extracted GS1 variables {found}")
+        return found
+
     def process_hooks(self, var_name, var_value):
-        if var_name not in self.process_for_variable:
-            return {}
+        new_vars = {}
+        for process_name in self.process_for_variable.get(var_name, []):
+            new_vars.update(self.run_process(process_name, var_name, var_value))
+        return new_vars
 
-        process_name = self.process_for_variable[var_name]
+    def run_process(self, process_name, var_name, var_value):
         process_details = self.processes[process_name]
         extra_args = process_details.get("extra_args", [])
         package_name = self.process_package
@@ -166,6 +879,10 @@ class Blackboard(multiprocessing.Process):
             )
             return {}
 
+        result = self.cache_get(process_name, var_name, var_value)
+        if result is not NOT_CACHED:
+            return map_outputs(process_outputs, result)
+
         try:
             hook_module = importlib.import_module(f"{package_name}.{module_name}")
             logger.debug(f"Imported {hook_module}")
@@ -177,28 +894,45 @@ class Blackboard(multiprocessing.Process):
             return {}
 
         try:
+            start = time.monotonic()
             result = hook_module.function(var_name, var_value, extra_args)
-            if result:
-                logger.info(
-                    f"Processing for {var_name} in module {package_name}.{module_name} resulted in {result}"
-                )
-            else:
-                logger.debug(
-                    f"Processing for {var_name} in module {package_name}.{module_name} did return"
-                )
-                result = []
+            self.flight_recorder.record("hook", process_name, var_name, time.monotonic() - start)
+            self.log_result(process_name, var_name, result)
+            self.cache_put(process_name, var_name, var_value, result)
         except Exception as e:
-            result = []
+            self.flight_recorder.record("hook_error", process_name, var_name, repr(e))
+            result = process_details.get("fallback", [])
             logger.error(
                 f"Processing for {var_name} in module {package_name}.{module_name} lead to exception{e}"
             )
 
-        lo = len(process_outputs)
-        lr = len(result)
-        compress_expand_result = result[0:lo]
-        compress_expand_result.extend([None] * (lo - lr))
-        out = dict(zip(process_outputs, compress_expand_result))
-        return out
+        return map_outputs(process_outputs, result)
+
+    def cache_get(self, process_name, var_name, var_value):
+        """Returns the cached result of the process for this input or NOT_CACHED"""
+        entry = self.hook_caches.get(process_name)
+        if entry is None:
+            return NOT_CACHED
+        key = hook_cache_key(var_name, var_value, self.processes[process_name])
+        result = entry["cache"].get(key, NOT_CACHED)
+        if result is NOT_CACHED:
+            entry["misses"] += 1
+        else:
+            entry["hits"] += 1
+        return result
+
+    def cache_put(self, process_name, var_name, var_value, result):
+        # only called with results the function returned - fallbacks are never cached
+        entry = self.hook_caches.get(process_name)
+        if entry is not None:
+            key = hook_cache_key(var_name, var_value, self.processes[process_name])
+            entry["cache"].put(key, result)
+
+    def log_result(self, process_name, var_name, result):
+        if result:
+            logger.info(f"Processing {process_name} for {var_name} resulted in {result}")
+        else:
+            logger.debug(f"Processing {process_name} for {var_name} did return")
 
     def get_triggered(self, variable):
         base_set = self.triggered_by_variable.get(variable, [])
@@ -219,30 +953,108 @@ class Blackboard(multiprocessing.Process):
 
     def get_outputs(self, triggered_set, blackboard):
         outputs = []
+        recorded = set()  # an update counts once even if several of its variables are triggers
         for triggered_output in triggered_set:
+            if triggered_output in self.windowed_outputs:
+                if triggered_output in recorded:
+                    continue
+                recorded.add(triggered_output)
+                aggregates = self.windowed_outputs[triggered_output].record(
+                    blackboard["location_id"], blackboard
+                )
+                if aggregates is not None:  # publishing on change
+                    outputs.append(self.form_output(triggered_output, blackboard, aggregates))
+                continue
             outputs.append(self.form_output(triggered_output,blackboard))
         logger.debug(f"Outputs are {outputs}")
         return outputs
 
-    def form_output(self, name, blackboard):
+    def form_output(self, name, blackboard, aggregates=None):
         config = self.outputs[name]
         topic = chevron.render(config["topic"], blackboard)
         payload = {}
-        for key, variable in config["payload"].items():
+        for key, variable in config.get("payload", {}).items():
             payload[key] = blackboard.get(variable)
             if variable in self.variable_rmap["single"]:
                 self.singles_to_clear.add(variable)
-        return {"topic": topic, "payload": payload}
+        if aggregates is not None:
+            payload.update(aggregates)
+        output_msg = {"topic": topic, "payload": payload}
+        meta = {}
+        if "sinks" in config:  # otherwise the service layer's default sinks are used
+            meta["sinks"] = config["sinks"]
+        encoding = config.get("encoding", DEFAULT_ENCODING)
+        if encoding != DEFAULT_ENCODING:
+            meta["encoding"] = encoding
+            meta["content_type"] = CONTENT_TYPES[encoding]
+        if meta:
+            output_msg["meta"] = meta
+        return output_msg
+
+    def form_alert(self, msg):
+        location_id = msg.get("id")
+        variables = dict(self._blackboard.get(location_id, self._base_blackboard))
+        variables["location_id"] = location_id
+        payload = {
+            "location_id": location_id,
+            "alert": msg["alert"],
+            "timestamp": msg.get("timestamp"),
+            **msg.get("detail", {}),
+        }
+        return {"topic": chevron.render(self.alert_topic, variables), "payload": payload}
 
     def clear_singles(self,blackboard):
         for var in self.singles_to_clear:
             blackboard[var] = None
+        self.singles_to_clear.clear()  # only the outputs of this message used them
 
     def dispatch(self, outputs):
+        if not outputs:
+            return
         for output_msg in outputs:
-            logger.debug(f"Dispatching {output_msg}")
-            # send
-            self.zmq_out.send_json(output_msg)
+            self.flight_recorder.record("out", output_msg["topic"])
+        # one multipart message per batch - the payloads are encoded once, here, and published as is
+        self.sender.send(wire.pack(
+            (output_msg["topic"], self.encode_payload(output_msg), output_msg.get("meta"))
+            for output_msg in outputs
+        ))
+
+    def encode_payload(self, output_msg):
+        encoding = output_msg.get("meta", {}).get("encoding", DEFAULT_ENCODING)
+        return self.encoders[encoding](output_msg["payload"])
+
+
+def call_hook(package_name, module_name, var_name, var_value, extra_args):
+    # runs in a thread or process pool worker
+    hook_module = importlib.import_module(f"{package_name}.{module_name}")
+    return hook_module.function(var_name, var_value, extra_args)
+
+
+def make_hook_cache(cache_conf):
+    return {
+        "cache": TTLCache(cache_conf.get("size", 256), cache_conf.get("ttl")),
+        "hits": 0,
+        "misses": 0,
+    }
+
+
+def hook_cache_key(var_name, var_value, process_details):
+    # values (e.g. GS1 or API set values) and extra_args can hold lists and tables,
+    # so both are frozen into strings
+    value = json.dumps(var_value, sort_keys=True, default=str)
+    extra_args = json.dumps(process_details.get("extra_args", []), sort_keys=True)
+    return (var_name, value, extra_args)
+
+
+def map_outputs(process_outputs, result):
+    # fit the result to the output_as variables - missing values are None
+    if not result:
+        result = []
+    lo = len(process_outputs)
+    lr = len(result)
+    compress_expand_result = list(result[0:lo])
+    compress_expand_result.extend([None] * (lo - lr))
+    return dict(zip(process_outputs, compress_expand_result))
 
 
 def process_variable_config(variables):
@@ -280,15 +1092,77 @@ def process_variable_config(variables):
     return fmap, rmap, patterns, initial_blackboard
 
 
+def map_gs1_variables(variables):
+    gs1_variables = {}
+    for entry_name, var in variables.items():
+        if var.get("source") == "gs1":
+            gs1_variables.setdefault(var["ai"], []).append(var.get("name", entry_name))
+    return gs1_variables
+
+
+def migrate_blackboard(old_blackboard, base_blackboard, variable_fmap, known_variables):
+    # keep the state of variables that still exist, static variables always take the new config value
+    new_blackboard = dict(base_blackboard)
+    for variable, value in old_blackboard.items():
+        if variable not in known_variables:
+            continue
+        if variable_fmap.get(variable) == "static":
+            continue
+        new_blackboard[variable] = value
+    return new_blackboard
+
+
 def reverse_map_processing(processes):
     rmap = {}
     for process_name, process_details in processes.items():
         variable = process_details.get("apply_to", None)
         if variable:
-            rmap[variable] = process_name
+            rmap.setdefault(variable, []).append(process_name)
     return rmap
 
 
+def order_processes(processes, process_for_variable):
+    """Orders the processes so each runs after the processes that produce its input.
+    Raises ValueError if processes depend on each other in a cycle"""
+    dependants = {name: [] for name in processes}
+    waiting_on = {name: 0 for name in processes}
+    for name, details in processes.items():
+        for variable in set(details.get("output_as", [])):
+            for dependant in process_for_variable.get(variable, []):
+                dependants[name].append(dependant)
+                waiting_on[dependant] += 1
+
+    ready = collections.deque(name for name, count in waiting_on.items() if count == 0)
+    order = []
+    while ready:
+        name = ready.popleft()
+        order.append(name)
+        for dependant in dependants[name]:
+            waiting_on[dependant] -= 1
+            if waiting_on[dependant] == 0:
+                ready.append(dependant)
+
+    if len(order) < len(processes):
+        cycle = sorted(name for name, count in waiting_on.items() if count > 0)
+        raise ValueError(f"Processes depend on each other in a cycle: {cycle}")
+    return order
+
+
+def map_downstream_processes(processes, process_for_variable, process_order):
+    position = {name: index for index, name in enumerate(process_order)}
+    downstream = {}
+    for variable in process_for_variable:
+        found = set()
+        to_visit = [variable]
+        while to_visit:
+            for name in process_for_variable.get(to_visit.pop(), []):
+                if name not in found:
+                    found.add(name)
+                    to_visit.extend(processes[name].get("output_as", []))
+        downstream[variable] = sorted(found, key=position.get)
+    return downstream
+
+
 def reverse_map_triggers(outputs):
     rmap = {}
     for output in outputs:
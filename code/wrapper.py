@@ -22,23 +22,44 @@
 #   If not, see <https://www.gnu.org/licenses/>.
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import multiprocessing
+import collections
 import logging
 import zmq
-import json
 import chevron
 import time
+import sys
 from urllib.parse import urljoin
 
+from utilities.links import connect_link
+from utilities import wire
+from utilities.sinks import Sink, FileSink, ZMQPubSink
+from utilities.topic_aliases import TopicAliases
+from utilities.flight_recorder import FlightRecorder, dump_on_crash
+from utilities.profiler import SamplingProfiler
+from utilities.watchdog import MemoryWatchdog, RECYCLE_EXIT_CODE
+
 context = zmq.Context()
 logger = logging.getLogger("main.wrapper")
 
+SINK_TYPES = ['mqtt', 'file', 'zmq']
 
-class MQTTServiceWrapper(multiprocessing.Process):
-    def __init__(self, config, zmq_conf):
-        super().__init__()
 
-        mqtt_conf = config['service_layer']['mqtt']
+class MQTTSink(Sink):
+    """Publishes outputs to the MQTT broker - reconnection happens in the sink's own thread, so
+    the other sinks carry on while the broker is unreachable.
+
+    With version = 5 the client uses MQTT v5: topic aliases for busy topics (QoS 0 only - messages
+    resent after a reconnect can't rely on the old connection's aliases), a persistent session
+    when session_expiry is set and user properties / content type on each message.
+    """
+
+    idle_timeout = 0  # waiting happens in the mqtt client loop instead
+
+    def __init__(self, name, mqtt_conf, flight_recorder):
+        super().__init__(name, mqtt_conf)
         self.url = mqtt_conf['broker']
         self.port = int(mqtt_conf['port'])
 
@@ -48,17 +69,18 @@ class MQTTServiceWrapper(multiprocessing.Process):
         self.backoff = mqtt_conf['reconnect']['backoff']
         self.limit = mqtt_conf['reconnect']['limit']
         self.constants = []
+        self.flight_recorder = flight_recorder
+        self.client = None
 
-        # declarations
-        self.zmq_conf = zmq_conf
-        self.zmq_in = None
-
-    def do_connect(self):
-        self.zmq_in = context.socket(self.zmq_conf['type'])
-        if self.zmq_conf["bind"]:
-            self.zmq_in.bind(self.zmq_conf["address"])
-        else:
-            self.zmq_in.connect(self.zmq_conf["address"])
+        self.version = mqtt_conf.get('version', 3)
+        self.client_id = mqtt_conf.get('client_id', '')
+        self.qos = mqtt_conf.get('qos', 0)
+        self.session_expiry = mqtt_conf.get('session_expiry', 0)  # seconds, 0 = clean session
+        self.alias_limit = mqtt_conf.get('topic_aliases', 100) if self.qos == 0 else 0
+        self.topic_aliases = TopicAliases()
+        self.user_properties = [
+            (str(key), str(value)) for key, value in mqtt_conf.get('user_properties', {}).items()
+        ]
 
     def mqtt_connect(self, client, first_time=False):
         timeout = self.initial
@@ -66,7 +88,7 @@ class MQTTServiceWrapper(multiprocessing.Process):
         while exceptions:
             try:
                 if first_time:
-                    client.connect(self.url, self.port, 60)
+                    client.connect(self.url, self.port, 60, **self.connect_options())
                 else:
                     logger.error("Attempting to reconnect...")
                     client.reconnect()
@@ -81,33 +103,187 @@ class MQTTServiceWrapper(multiprocessing.Process):
                 else:
                     timeout = self.limit
 
-    def on_disconnect(self, client, _userdata, rc):
+    def connect_options(self):
+        if self.version != 5:
+            return {}
+        properties = Properties(PacketTypes.CONNECT)
+        if self.session_expiry:
+            # the broker keeps the session (and QoS>0 messages in flight) over a reconnect
+            properties.SessionExpiryInterval = self.session_expiry
+        return {"clean_start": not self.session_expiry, "properties": properties}
+
+    def on_connect(self, _client, _userdata, flags, rc, properties=None):
+        # v5 only - aliases start afresh on every connection, up to the number the broker allows
+        broker_maximum = getattr(properties, "TopicAliasMaximum", 0) if properties is not None else 0
+        self.topic_aliases.reset(min(broker_maximum, self.alias_limit))
+        self.flight_recorder.record("connect", str(rc), flags.get("session present"))
+        logger.info(
+            f"MQTT v5 session {'resumed' if flags.get('session present') else 'started'} "
+            f"(rc:{rc}, {self.topic_aliases.maximum} topic aliases)"
+        )
+
+    def on_disconnect(self, client, _userdata, rc, _properties=None):
+        self.flight_recorder.record("disconnect", rc)
+        # aliases end with the connection - topics are sent in full until on_connect sets them up again
+        self.topic_aliases.reset(0)
         if rc != 0:
             logger.error(f"Unexpected MQTT disconnection (rc:{rc}), reconnecting...")
             self.mqtt_connect(client)
 
-    def run(self):
-        self.do_connect()
-
-        client = mqtt.Client()
+    def open(self):
+        if self.version == 5:
+            # a persistent session is found by the client id, so it needs to be set
+            self.client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5)
+            self.client.on_connect = self.on_connect
+        else:
+            self.client = mqtt.Client()
         # client.on_connect = self.on_connect
         # client.on_message = self.on_message
-        client.on_disconnect = self.on_disconnect
+        self.client.on_disconnect = self.on_disconnect
 
         # self.client.tls_set('ca.cert.pem',tls_version=2)
         logger.info(f'connecting to {self.url}:{self.port}')
-        self.mqtt_connect(client, True)
+        self.mqtt_connect(self.client, True)
+
+    def write_batch(self, batch):
+        for topic, msg_payload, meta in batch:
+            logger.debug(f'pub topic:{topic} msg:{msg_payload}')
+            if self.version == 5:
+                info = self.publish_v5(topic, msg_payload, meta)
+            else:
+                info = self.client.publish(topic, msg_payload, self.qos)
+            self.flight_recorder.record("publish", topic, info.rc)
+
+    def publish_v5(self, topic, msg_payload, meta):
+        properties = Properties(PacketTypes.PUBLISH)
+        topic_sent, alias = self.topic_aliases.alias_for(topic)
+        if alias is not None:
+            properties.TopicAlias = alias
+        if "content_type" in meta:
+            properties.ContentType = meta["content_type"]
+        user_properties = list(self.user_properties)
+        if "encoding" in meta:
+            user_properties.append(("encoding", meta["encoding"]))
+        if user_properties:
+            properties.UserProperty = user_properties
+        info = self.client.publish(topic_sent, msg_payload, self.qos, properties=properties)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and topic_sent:
+            self.topic_aliases.forget(topic)
+        return info
+
+    def idle(self):
+        if self.client is not None:
+            self.client.loop(0 if self.queue else 0.05)
+
+    def close(self):
+        if self.client is not None:
+            self.client.loop(1)  # finish sending
+
 
+class MQTTServiceWrapper(multiprocessing.Process):
+    """Service layer - takes the outputs from the blackboard and hands them to the sinks.
+
+    Outputs go to the sinks listed in service_layer.sinks (["mqtt"] by default) unless the output
+    names its own sinks, which the blackboard passes on in the output's meta.
+    """
+
+    def __init__(self, config, zmq_conf):
+        super().__init__()
+
+        self.service_conf = config['service_layer']
+        self.default_sinks = self.service_conf.get('sinks', ['mqtt'])
+        self.sink_names = set(self.default_sinks)
+        for output in config.get('output', []):
+            self.sink_names.update(output.get('sinks', []))
+        # configured sections are built too - a reloaded config may send outputs to them
+        self.sink_names.update(name for name in SINK_TYPES if isinstance(self.service_conf.get(name), dict))
+        self.stats_interval = self.service_conf.get('stats_interval', 60)
+
+        self.flight_recorder = FlightRecorder("wrapper", config)
+        self.profiler = SamplingProfiler("wrapper", config)
+        self.memory_watchdog = MemoryWatchdog("wrapper", config)
+        # set by main once the blackboard shards have stopped - exit when the sinks have written everything
+        self.drain_requested = multiprocessing.Event()
+        self.drain_timeout = 60
+
+        # declarations
+        self.zmq_conf = zmq_conf
+        self.zmq_in = None
+        self.sinks = {}
+        self.unknown_sinks = collections.Counter()  # <sink name>:<outputs dropped>
+
+    def do_connect(self):
+        self.zmq_in = connect_link(context, self.zmq_conf)
+
+    def make_sinks(self):
+        # made in run() - each sink has a thread, which must be started in this block's process
+        sinks = {}
+        for name in self.sink_names:
+            sink_conf = self.service_conf.get(name, {})
+            if name == 'mqtt':
+                sinks[name] = MQTTSink(name, sink_conf, self.flight_recorder)
+            elif name == 'file':
+                sinks[name] = FileSink(name, sink_conf)
+            elif name == 'zmq':
+                sinks[name] = ZMQPubSink(name, sink_conf, context)
+            else:
+                logger.error(f"Unknown sink {name} - outputs sent to it are dropped")
+        return sinks
+
+    def route(self, topic, msg_payload, meta):
+        for name in meta.get('sinks', self.default_sinks):
+            sink = self.sinks.get(name)
+            if sink is not None:
+                sink.put(topic, msg_payload, meta)
+                continue
+            if name not in self.unknown_sinks:
+                logger.error(f"Output {topic} sent to sink {name}, which is not configured - dropped")
+            self.unknown_sinks[name] += 1
+
+    @dump_on_crash
+    def run(self):
+        self.profiler.install()
+        self.do_connect()
+
+        self.sinks = self.make_sinks()
+        for sink in self.sinks.values():
+            sink.start()
+
+        next_stats = time.monotonic() + self.stats_interval
         run = True
         while run:
             while self.zmq_in.poll(50, zmq.POLLIN):
                 try:
-                    msg = self.zmq_in.recv(zmq.NOBLOCK)
-                    msg_json = json.loads(msg)
-                    topic = msg_json['topic']
-                    msg_payload = msg_json['payload']
-                    logger.debug(f'pub topic:{topic} msg:{msg_payload}')
-                    client.publish(topic, json.dumps(msg_payload))
+                    frames = self.zmq_in.recv_multipart(zmq.NOBLOCK)
                 except zmq.ZMQError:
-                    pass
-            client.loop(0.05)
+                    continue
+                # the blackboard batches outputs - payloads arrive encoded and are passed on untouched
+                start = time.monotonic()
+                try:
+                    outputs = list(wire.unpack(frames))
+                except ValueError as e:
+                    logger.error(f"Dropped message from blackboard: {e}")
+                    continue
+                for topic, msg_payload, meta in outputs:
+                    self.route(topic, msg_payload, meta)
+                self.flight_recorder.check_latency("publish", time.monotonic() - start)
+
+            if self.drain_requested.is_set():  # nothing more arrived within the poll
+                for sink in self.sinks.values():
+                    sink.stop(self.drain_timeout)
+                logger.info("Wrapper finished - all outputs are written")
+                return
+
+            if time.monotonic() >= next_stats:
+                next_stats = time.monotonic() + self.stats_interval
+                for sink in self.sinks.values():
+                    sink.log_stats()
+                if self.unknown_sinks:
+                    logger.warning(f"Outputs dropped for unknown sinks: {dict(self.unknown_sinks)}")
+            if self.memory_watchdog.due() and self.memory_watchdog.check(
+                {f"{name}_queued": len(sink.queue) for name, sink in self.sinks.items()}
+            ):
+                for sink in self.sinks.values():
+                    sink.stop()  # finish sending before main restarts this block
+                logger.warning("Wrapper recycling to release memory")
+                sys.exit(RECYCLE_EXIT_CODE)